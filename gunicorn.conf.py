@@ -0,0 +1,60 @@
+# Gunicorn configuration of the production server (SERVER_MODE=production in start_server.sh).
+#
+# The app is created once in the master process (preload_app): the ML models and the maps
+# in PRELOAD_MAPS are loaded before the workers are forked and are shared by them
+# copy-on-write. Each worker pins its torch threads to its own set of cores and starts the
+# background threads (map watcher, inference scheduler, query image writer) after the fork.
+#
+# The /metrics counters are kept per worker: each scrape reports the worker that served it.
+# The workers save query images to their own segment files under data/query_data.
+#
+# CUDA cannot be used across a fork: on GPU servers set GUNICORN_PRELOAD=false so that
+# each worker loads its own models.
+
+import os
+
+wsgi_app = "spatial_server.server:create_app(start_services=False)"
+bind = "0.0.0.0:8001"
+
+num_cpus = len(os.sched_getaffinity(0))
+workers = int(os.getenv("WORKERS", max(1, num_cpus // 8)))
+# Threads per worker. Concurrent requests of a worker share its micro-batches.
+worker_class = "gthread"
+threads = int(os.getenv("WORKER_THREADS", 8))
+# Localization can take seconds on cold maps; map building runs in the background job queue
+timeout = 300
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() == "true"
+
+if os.getenv("HTTPS", "false").lower() == "true":
+    certfile = "/ssl/cert.pem"
+    keyfile = "/ssl/key.pem"
+
+# Cores of the machine, split into one slot per worker
+_cpus = sorted(os.sched_getaffinity(0))
+
+
+def pre_fork(server, worker):
+    # Give the new worker the core slot that no running worker uses
+    used_slots = {
+        getattr(other, "cpu_slot", None) for other in server.WORKERS.values()
+    }
+    worker.cpu_slot = next(
+        slot for slot in range(server.num_workers + 1) if slot not in used_slots
+    )
+
+
+def post_fork(server, worker):
+    import torch
+
+    cpus_per_worker = max(1, len(_cpus) // server.num_workers)
+    start = (worker.cpu_slot * cpus_per_worker) % len(_cpus)
+    cpus = _cpus[start : start + cpus_per_worker]
+    os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(len(cpus))
+    server.log.info(f"Worker {worker.pid} pinned to cores {cpus[0]}-{cpus[-1]}")
+
+
+def post_worker_init(worker):
+    from spatial_server.server import start_background_services
+
+    start_background_services(worker.wsgi)
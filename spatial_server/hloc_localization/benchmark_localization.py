@@ -0,0 +1,205 @@
+"""
+Module to be run as a script to benchmark the localization of a map on a directory of
+query images: latency per stage, throughput, success rate and pose error.
+
+Query images are the query_image.* files in the subdirectories of the query directory,
+by default the images_with_pose directory of the map written by save_image_pose. The
+A-Frame camera pose saved with an image in location_data.pkl is used as ground truth.
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import glob
+import json
+import os
+from pathlib import Path
+import pickle
+import time
+
+import numpy as np
+
+from . import load_cache, localizer
+from .inference_scheduler import InferenceScheduler
+from spatial_server.server import shared_data
+
+# (translation in map units, rotation in degrees) thresholds of the pose recall
+POSE_THRESHOLDS = [(0.25, 2), (0.5, 5), (1.0, 10)]
+
+
+def _get_queries(query_dir):
+    """
+    List of (image path, ground truth (4,4) A-Frame pose or None)
+    """
+    queries = []
+    for img_path in sorted(glob.glob(os.path.join(query_dir, "*", "query_image.*"))):
+        ground_truth_pose = None
+        location_data_file = Path(img_path).parent / "location_data.pkl"
+        if location_data_file.exists():
+            with open(location_data_file, "rb") as f:
+                location_data = pickle.load(f)
+            ground_truth_pose = (
+                np.array(location_data["aframe_camera_matrix_world"]).reshape((4, 4)).T
+            )
+        queries.append((img_path, ground_truth_pose))
+    return queries
+
+
+def _get_pose_error(pose, ground_truth_pose):
+    """
+    Translation error and rotation error in degrees between two (4,4) poses
+    """
+    pose = np.array(pose)
+    translation_error = np.linalg.norm(pose[:3, 3] - ground_truth_pose[:3, 3])
+    relative_rotation = ground_truth_pose[:3, :3].T @ pose[:3, :3]
+    cos_angle = np.clip((np.trace(relative_rotation) - 1) / 2, -1.0, 1.0)
+    return translation_error, np.degrees(np.arccos(cos_angle))
+
+
+def _percentiles(values):
+    values = np.asarray(values)
+    return {
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "p99": float(np.percentile(values, 99)),
+        "mean": float(values.mean()),
+    }
+
+
+def _localize(img_path, map_name):
+    start = time.perf_counter()
+    result = localizer.localize(img_path, map_name)
+    return result, 1000 * (time.perf_counter() - start)
+
+
+def benchmark_localization(map_name, query_dir, concurrency, repeat, batch_window_ms):
+    load_cache.load_ml_models(shared_data)
+    load_cache.load_db_data(shared_data)
+    if batch_window_ms > 0:
+        shared_data["inference_scheduler"] = InferenceScheduler(
+            shared_data, max_batch_size=concurrency, max_wait_ms=batch_window_ms
+        )
+
+    queries = _get_queries(query_dir)
+    if len(queries) == 0:
+        raise ValueError(f"No query images found in {query_dir}")
+    print(f"Found {len(queries)} query images in {query_dir}")
+
+    # Load the map and warm up the models outside of the measurement
+    _localize(queries[0][0], map_name)
+
+    run_queries = queries * repeat
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outputs = list(
+            executor.map(lambda query: _localize(query[0], map_name), run_queries)
+        )
+    wall_time = time.perf_counter() - start
+
+    stage_timings = {}
+    pose_errors = []
+    num_with_ground_truth = 0
+    for (_, ground_truth_pose), (result, _) in zip(run_queries, outputs):
+        for stage, milliseconds in result.get("timings", {}).items():
+            stage_timings.setdefault(stage, []).append(milliseconds)
+        if ground_truth_pose is not None:
+            num_with_ground_truth += 1
+            if result["success"]:
+                pose_errors.append(_get_pose_error(result["pose"], ground_truth_pose))
+
+    report = {
+        "map_name": map_name,
+        "num_queries": len(run_queries),
+        "concurrency": concurrency,
+        "batch_window_ms": batch_window_ms,
+        "throughput": len(run_queries) / wall_time,
+        "success_rate": float(np.mean([result["success"] for result, _ in outputs])),
+        "latency_ms": _percentiles([latency for _, latency in outputs]),
+        "stage_latency_ms": {
+            stage: _percentiles(values) for stage, values in stage_timings.items()
+        },
+    }
+    if num_with_ground_truth:
+        errors = np.array(pose_errors).reshape((-1, 2))
+        report["pose_error"] = {
+            "num_queries": num_with_ground_truth,
+            "median_translation": (
+                float(np.median(errors[:, 0])) if len(errors) else None
+            ),
+            "median_rotation_deg": (
+                float(np.median(errors[:, 1])) if len(errors) else None
+            ),
+            # Fraction of the queries with ground truth localized within each threshold
+            "recall": {
+                f"{t}/{r}deg": float(
+                    np.sum((errors[:, 0] <= t) & (errors[:, 1] <= r))
+                    / num_with_ground_truth
+                )
+                for t, r in POSE_THRESHOLDS
+            },
+        }
+    return report
+
+
+def _print_report(report):
+    print(
+        f"{report['num_queries']} queries, concurrency {report['concurrency']}: "
+        f"{report['throughput']:.2f} images/s, success rate {report['success_rate']:.3f}"
+    )
+    rows = [("total", report["latency_ms"])] + sorted(
+        report["stage_latency_ms"].items()
+    )
+    for stage, latency in rows:
+        print(
+            f"  {stage:<10} p50 {latency['p50']:8.2f} ms  p95 {latency['p95']:8.2f} ms"
+            f"  p99 {latency['p99']:8.2f} ms"
+        )
+    if "pose_error" in report:
+        pose_error = report["pose_error"]
+        print(
+            f"Pose error on {pose_error['num_queries']} queries with ground truth: "
+            f"median translation {pose_error['median_translation']}, "
+            f"median rotation {pose_error['median_rotation_deg']} deg"
+        )
+        for threshold, recall in pose_error["recall"].items():
+            print(f"  within {threshold}: {recall:.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the localization latency and accuracy on a map"
+    )
+    parser.add_argument("--map_name", type=str, required=True, help="Name of the map")
+    parser.add_argument(
+        "--query_dir",
+        type=str,
+        default=None,
+        help="Directory with one subdirectory per query image. "
+        "Defaults to the images_with_pose directory of the map.",
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=1, help="Number of concurrent requests"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="Number of times each image is localized"
+    )
+    parser.add_argument(
+        "--batch_window_ms",
+        type=float,
+        default=0,
+        help="Micro-batching window of the inference scheduler. 0 localizes each request directly.",
+    )
+    parser.add_argument(
+        "--output", type=str, default=None, help="Path to save the report as JSON"
+    )
+    args = parser.parse_args()
+
+    query_dir = args.query_dir or os.path.join(
+        "data", "map_data", args.map_name, "images_with_pose"
+    )
+    report = benchmark_localization(
+        args.map_name, query_dir, args.concurrency, args.repeat, args.batch_window_ms
+    )
+    _print_report(report)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,112 @@
+"""
+Module to be run as a script to compare the recall@k and latency of the IVF retrieval
+index against exact search on the global descriptors of a map.
+
+The db descriptors of a random sample of db images are used as queries and the query
+image itself is excluded from the results.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from . import feature_store, load_cache
+from .retrieval_index import ExactIndex, IVFIndex
+
+
+def _search_without_self(index, query_descriptors, query_idxs, k, **kwargs):
+    """
+    Search every query on its own, as in serving, and time each search
+    """
+    results, latencies = [], []
+    for query, query_idx in zip(query_descriptors, query_idxs):
+        start = time.perf_counter()
+        _, db_idxs = index.search(query[None], k + 1, **kwargs)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        latencies.append(time.perf_counter() - start)
+        results.append([idx for idx in db_idxs[0] if idx != query_idx][:k])
+    return results, np.array(latencies) * 1000
+
+
+def _print_latency(label, latencies):
+    print(
+        f"{label}: mean {latencies.mean():.2f} ms, "
+        f"p50 {np.percentile(latencies, 50):.2f} ms, "
+        f"p95 {np.percentile(latencies, 95):.2f} ms"
+    )
+
+
+def benchmark_retrieval(map_name, num_queries, k, num_probes_list, num_lists=None):
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    db_global_descriptors_path = load_cache.get_map_data_paths(map_name)[
+        "db_global_descriptors"
+    ]
+    db_image_names, db_global_descriptors = feature_store.load_descriptor_snapshot(
+        db_global_descriptors_path
+    )
+    db_global_descriptors = torch.from_numpy(db_global_descriptors).to(device)
+    print(f"Loaded {len(db_image_names)} global descriptors for {map_name}")
+
+    rng = np.random.default_rng(0)
+    query_idxs = rng.choice(
+        len(db_image_names), min(num_queries, len(db_image_names)), replace=False
+    )
+    query_descriptors = db_global_descriptors[torch.from_numpy(query_idxs).to(device)]
+
+    exact_index = ExactIndex(db_global_descriptors)
+    exact_results, exact_latencies = _search_without_self(
+        exact_index, query_descriptors, query_idxs, k
+    )
+    _print_latency("Exact", exact_latencies)
+
+    start = time.perf_counter()
+    ivf_index = IVFIndex(db_global_descriptors, num_lists=num_lists)
+    print(
+        f"Built IVF index with {ivf_index.num_lists} lists in {time.perf_counter() - start:.2f} s"
+    )
+
+    for num_probes in num_probes_list:
+        ivf_results, ivf_latencies = _search_without_self(
+            ivf_index, query_descriptors, query_idxs, k, num_probes=num_probes
+        )
+        recall = np.mean(
+            [
+                len(set(ivf) & set(exact)) / max(len(exact), 1)
+                for ivf, exact in zip(ivf_results, exact_results)
+            ]
+        )
+        _print_latency(
+            f"IVF num_probes={num_probes} recall@{k} {recall:.3f}", ivf_latencies
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the IVF retrieval index against exact search"
+    )
+    parser.add_argument("--map_name", type=str, required=True, help="Name of the map")
+    parser.add_argument(
+        "--num_queries", type=int, default=500, help="Number of db images used as queries"
+    )
+    parser.add_argument("--k", type=int, default=10, help="Number of retrieved images")
+    parser.add_argument(
+        "--num_probes",
+        type=int,
+        nargs="+",
+        default=[4, 8, 16, 32],
+        help="Numbers of IVF lists scanned per query",
+    )
+    parser.add_argument(
+        "--num_lists",
+        type=int,
+        default=None,
+        help="Number of IVF lists. Defaults to the value used for serving.",
+    )
+    args = parser.parse_args()
+
+    benchmark_retrieval(
+        args.map_name, args.num_queries, args.k, args.num_probes, args.num_lists
+    )
@@ -1,3 +1,81 @@
+import os
+
 LOCAL_FEATURE_EXTRACTOR = "superpoint_aachen"
 GLOBAL_DESCRIPTOR_EXTRACTOR = "netvlad"
 MATCHER = "superglue"
+
+# Number of db images retrieved with the global descriptors for each query
+NUM_RETRIEVED_IMAGES = 10
+
+# Adaptive localization: the retrieved db images are cut to those whose NetVLAD score is within
+# ADAPTIVE_RETRIEVAL_MARGIN of the best score (at least ADAPTIVE_MIN_RETRIEVED), and they are matched
+# ADAPTIVE_MATCH_CHUNK_SIZE at a time in score order until the query has ADAPTIVE_MIN_CORRESPONDENCES
+# 2D-3D correspondences. Off matches all NUM_RETRIEVED_IMAGES db images.
+ADAPTIVE_LOCALIZATION = os.getenv("ADAPTIVE_LOCALIZATION", "false").lower() == "true"
+ADAPTIVE_RETRIEVAL_MARGIN = 0.1
+ADAPTIVE_MIN_RETRIEVED = 3
+ADAPTIVE_MATCH_CHUNK_SIZE = 2
+ADAPTIVE_MIN_CORRESPONDENCES = 200
+
+# Early rejection of queries that do not look at the map, before matching. Thresholds are calibrated
+# per map from its db images: a query is rejected if it has fewer keypoints than
+# EARLY_REJECTION_KEYPOINT_RATIO times the 5th percentile of the db images' keypoint counts, or if its
+# best retrieval score is below EARLY_REJECTION_SCORE_RATIO times the 5th percentile of the db images'
+# best scores against the other db images. Off by default: the thresholds are heuristics and a query
+# rejected by mistake gets no pose at all.
+EARLY_REJECTION = os.getenv("EARLY_REJECTION", "false").lower() == "true"
+EARLY_REJECTION_KEYPOINT_RATIO = 0.1
+EARLY_REJECTION_SCORE_RATIO = 0.6
+# Number of db images used to calibrate the retrieval score threshold
+EARLY_REJECTION_CALIBRATION_IMAGES = 256
+
+# Maximum number of images / image pairs run through a model in one forward pass
+EXTRACTION_BATCH_SIZE = 8
+MATCHER_BATCH_SIZE = 16
+
+# Map building: number of processes extracting the features of the db images, each running the models
+# with EXTRACTION_THREADS_PER_WORKER torch threads and decoding images ahead in EXTRACTION_PREFETCH_THREADS
+# threads. 0 uses hloc's single process extraction (one process with fused extraction).
+EXTRACTION_WORKERS = int(os.getenv("EXTRACTION_WORKERS", 0))
+EXTRACTION_THREADS_PER_WORKER = int(os.getenv("EXTRACTION_THREADS_PER_WORKER", 4))
+EXTRACTION_PREFETCH_THREADS = 2
+# Map building: extract the local features and global descriptors in one pass that reads and decodes each
+# image once, instead of one hloc extraction per model. Opt-in: it replaces hloc's extraction with our
+# own, which is worth it when the image decoding is a large part of the extraction time.
+FUSED_EXTRACTION = os.getenv("FUSED_EXTRACTION", "false").lower() == "true"
+# Map building: match the image pairs in batches of MATCHER_BATCH_SIZE, keeping the features of the images
+# in memory until their last pair (at most BUILD_MATCHING_CACHE_IMAGES images), instead of hloc's one pair at
+# a time matching. Opt-in: it replaces hloc's matching with our own.
+BATCHED_BUILD_MATCHING = os.getenv("BATCHED_BUILD_MATCHING", "false").lower() == "true"
+BUILD_MATCHING_CACHE_IMAGES = 256
+
+# Memory budget in bytes for the data of the maps loaded for localization.
+# The least recently used maps are evicted when the budget is exceeded.
+MAP_CACHE_MAX_BYTES = int(os.getenv("MAP_CACHE_MAX_BYTES", 4 * 1024**3))
+# Number of maps loaded in parallel at startup
+PRELOAD_WORKERS = int(os.getenv("PRELOAD_WORKERS", 8))
+# A map whose files changed is reloaded by a request once they have not changed for
+# MAP_RELOAD_DEBOUNCE seconds, so that a map being written is not read half way through.
+# Until then, and if the reload fails, the loaded data is used.
+MAP_RELOAD_DEBOUNCE = 2.0
+
+# Approximate nearest neighbour (IVF) index for the global descriptor retrieval.
+# Maps with fewer db images than RETRIEVAL_IVF_MIN_IMAGES use exact search (0 always uses exact search).
+RETRIEVAL_IVF_MIN_IMAGES = int(os.getenv("RETRIEVAL_IVF_MIN_IMAGES", 5000))
+# Number of lists is RETRIEVAL_IVF_LISTS_FACTOR * sqrt(number of db images)
+RETRIEVAL_IVF_LISTS_FACTOR = 4
+# Number of lists scanned per query. Higher values give better recall but slower retrieval.
+RETRIEVAL_IVF_NUM_PROBES = 16
+RETRIEVAL_IVF_NUM_ITERATIONS = 20
+
+# Pose prior localization: default search radius around the prior position (in map units)
+# and the number of PnP inliers below which the query falls back to global retrieval.
+POSE_PRIOR_RADIUS = 10.0
+POSE_PRIOR_MIN_INLIERS = 30
+
+# Cross-map localization: number of db images retrieved from the stacked index of all maps
+# to score the maps, and number of top-scoring maps on which matching and PnP are run.
+CROSS_MAP_NUM_RETRIEVED_IMAGES = 50
+CROSS_MAP_NUM_CANDIDATE_MAPS = 2
+# Number of stacked indexes (one per set of maps) kept in memory
+CROSS_MAP_INDEX_CACHE_SIZE = 4
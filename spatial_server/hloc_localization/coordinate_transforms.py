@@ -34,3 +34,14 @@ def get_aframe_pose_matrix(hloc_camera_matrix, dataset_name):
     )
 
     return blender_camera_matrix_in_aframe.tolist()
+
+
+def convert_aframe_to_hloc_position(aframe_position):
+    """
+    Convert a position in the A-Frame frame to the hloc (reconstruction) frame.
+    Inverse of the conversion of the camera position in get_aframe_pose_matrix;
+    the hloc to blender conversion only changes the rotation.
+    """
+    blender_to_aframe = convert_blender_to_aframe_frame(np.eye(4))
+    position = np.append(np.asarray(aframe_position, dtype=np.float64), 1.0)
+    return (np.linalg.inv(blender_to_aframe) @ position)[:3]
@@ -0,0 +1,296 @@
+"""
+Flat, memory-mapped store of the local features of a map's db images.
+
+The store is built once from the map's local features h5 file and holds contiguous
+keypoints, scores and descriptors arrays plus an index of offsets keyed by image name.
+The arrays are memory-mapped, so all processes serving the map share the same pages
+and reading the features of a db image is an O(1) slice without opening the h5 file.
+
+The global descriptors of the db images get a similar snapshot: one contiguous
+(N, D) descriptor matrix and the array of image names, both memory-mapped, so that
+loading a map does not walk its global descriptors h5 file.
+
+Stores and snapshots are written to a new versioned directory and published by
+atomically replacing a symlink, under a file lock so that only one process builds them.
+Readers resolve the symlink once and keep the version they opened.
+"""
+
+from contextlib import contextmanager
+import fcntl
+import os
+from pathlib import Path
+import shutil
+import time
+
+import h5py
+import numpy as np
+
+from third_party.hloc.hloc.utils.io import list_h5_names
+
+FEATURE_KEYS = ("keypoints", "scores", "descriptors")
+
+
+def get_store_path(features_path):
+    """
+    Directory of the feature store that is built from the features h5 file
+    """
+    features_path = Path(features_path)
+    return features_path.parent / (features_path.stem + "_store")
+
+
+def is_stale(features_path, store_path=None, index_filename="index.npz"):
+    """
+    The store is stale if it does not exist or is older than the features h5 file
+    """
+    store_path = get_store_path(features_path) if store_path is None else store_path
+    index_path = Path(store_path) / index_filename
+    if not index_path.exists():
+        return True
+    return os.path.getmtime(index_path) < os.path.getmtime(features_path)
+
+
+def _new_version_path(path):
+    """
+    Unique directory to write a new version of the store or snapshot at path to
+    """
+    return path.with_name(f"{path.name}.v{time.time_ns()}_{os.getpid()}")
+
+
+def _get_version_paths(path):
+    return sorted(path.parent.glob(f"{path.name}.v*"))
+
+
+def _publish_version(version_path, path):
+    """
+    Point the symlink at path to the new version directory, atomically.
+    Versions older than the one that is replaced are deleted. The replaced version
+    is kept for the processes that resolved the symlink just before the swap, and
+    processes that have the older files mapped keep reading them.
+    """
+    previous_name = os.readlink(path) if path.is_symlink() else None
+    if path.exists() and not path.is_symlink():
+        # Directory written before stores were versioned
+        shutil.rmtree(path)
+    link_path = path.with_name(f"{path.name}.link{os.getpid()}")
+    if link_path.is_symlink():
+        link_path.unlink()
+    os.symlink(version_path.name, link_path)
+    os.replace(link_path, path)
+
+    for old_path in _get_version_paths(path):
+        if old_path.name not in (version_path.name, previous_name):
+            shutil.rmtree(old_path, ignore_errors=True)
+
+
+@contextmanager
+def _build_lock(path):
+    """
+    Exclusive lock of the store or snapshot at path, held while a version is built and
+    published so that processes never delete a version that another one is writing
+    """
+    with open(path.with_name(f"{path.name}.lock"), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def _build_if_stale(path, is_stale, build):
+    """
+    Build the store or snapshot at path if it is stale. Processes that find it stale at the
+    same time build it once: the others wait for the lock and find it up to date.
+    """
+    if not is_stale():
+        return
+    with _build_lock(path):
+        if is_stale():
+            build()
+
+
+def _list_names(h5_path):
+    names = list_h5_names(h5_path)
+    if len(names) == 0:
+        raise ValueError(f"No images in {h5_path}")
+    return names
+
+
+def build_feature_store(features_path, store_path=None):
+    """
+    Write the features in the h5 file to a flat store.
+    The store is written to a new version directory first and then published,
+    so readers never see a partially written store.
+    """
+    features_path = Path(features_path)
+    store_path = get_store_path(features_path) if store_path is None else Path(store_path)
+    with _build_lock(store_path):
+        return _build_feature_store(features_path, store_path)
+
+
+def _build_feature_store(features_path, store_path):
+    names = _list_names(features_path)
+
+    with h5py.File(str(features_path), "r", libver="latest") as fd:
+        # First pass: number of keypoints per image, descriptor dimension and dtypes
+        counts = np.array([fd[name]["keypoints"].shape[0] for name in names])
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        first = fd[names[0]]
+        shapes = {
+            "keypoints": (offsets[-1], 2),
+            "scores": (offsets[-1],),
+            "descriptors": (offsets[-1], first["descriptors"].shape[0]),
+        }
+
+        tmp_path = _new_version_path(store_path)
+        os.makedirs(tmp_path)
+        arrays = {
+            key: np.lib.format.open_memmap(
+                tmp_path / f"{key}.npy",
+                mode="w+",
+                dtype=first[key].dtype,
+                shape=shapes[key],
+            )
+            for key in FEATURE_KEYS
+        }
+
+        # Second pass: copy the features of every image into the flat arrays.
+        # Descriptors are stored (D, N) in the h5 file and transposed to be contiguous per image.
+        image_sizes = np.zeros((len(names), 2), dtype=np.int64)
+        for idx, name in enumerate(names):
+            grp = fd[name]
+            start, end = offsets[idx], offsets[idx + 1]
+            arrays["keypoints"][start:end] = grp["keypoints"].__array__()
+            arrays["scores"][start:end] = grp["scores"].__array__()
+            arrays["descriptors"][start:end] = grp["descriptors"].__array__().T
+            image_sizes[idx] = grp["image_size"].__array__()
+
+    for array in arrays.values():
+        array.flush()
+    del arrays
+    np.savez(
+        tmp_path / "index.npz",
+        names=np.array(names),
+        offsets=offsets,
+        image_sizes=image_sizes,
+    )
+
+    _publish_version(tmp_path, store_path)
+    print(f"Built feature store for {len(names)} images at {store_path}")
+    return store_path
+
+
+class FeatureStore:
+    """
+    Read-only, memory-mapped view of a feature store
+    """
+
+    def __init__(self, store_path):
+        # The version the symlink points to now, even if a newer one is published later
+        self.store_path = Path(os.path.realpath(store_path))
+        with np.load(self.store_path / "index.npz") as index:
+            self.names = index["names"]
+            self.offsets = index["offsets"]
+            self.image_sizes = index["image_sizes"]
+        self.name_to_idx = {name: idx for idx, name in enumerate(self.names)}
+        self.arrays = {
+            key: np.load(self.store_path / f"{key}.npy", mmap_mode="r")
+            for key in FEATURE_KEYS
+        }
+
+    def __contains__(self, name):
+        return name in self.name_to_idx
+
+    def __len__(self):
+        return len(self.names)
+
+    def get(self, name):
+        """
+        Features of one db image in the same layout as hloc's features h5 file
+        """
+        idx = self.name_to_idx[name]
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        return {
+            "keypoints": self.arrays["keypoints"][start:end],
+            "scores": self.arrays["scores"][start:end],
+            "descriptors": self.arrays["descriptors"][start:end].T,
+            "image_size": self.image_sizes[idx],
+        }
+
+
+def load_feature_store(features_path):
+    """
+    Open the feature store of a features h5 file, (re)building it if it is stale
+    """
+    store_path = get_store_path(features_path)
+    _build_if_stale(
+        store_path,
+        lambda: is_stale(features_path, store_path),
+        lambda: _build_feature_store(Path(features_path), store_path),
+    )
+    return FeatureStore(store_path)
+
+
+def get_snapshot_path(global_descriptors_path):
+    """
+    Directory of the snapshot of the global descriptors h5 file
+    """
+    global_descriptors_path = Path(global_descriptors_path)
+    return global_descriptors_path.parent / (
+        global_descriptors_path.stem + "_snapshot"
+    )
+
+
+def build_descriptor_snapshot(global_descriptors_path, snapshot_path=None):
+    """
+    Write the global descriptors in the h5 file to one contiguous float32 matrix
+    and an array of image names, in the same order
+    """
+    global_descriptors_path = Path(global_descriptors_path)
+    if snapshot_path is None:
+        snapshot_path = get_snapshot_path(global_descriptors_path)
+    snapshot_path = Path(snapshot_path)
+    with _build_lock(snapshot_path):
+        return _build_descriptor_snapshot(global_descriptors_path, snapshot_path)
+
+
+def _build_descriptor_snapshot(global_descriptors_path, snapshot_path):
+    names = _list_names(global_descriptors_path)
+
+    tmp_path = _new_version_path(snapshot_path)
+    os.makedirs(tmp_path)
+    with h5py.File(str(global_descriptors_path), "r", libver="latest") as fd:
+        dim = fd[names[0]]["global_descriptor"].shape[-1]
+        descriptors = np.lib.format.open_memmap(
+            tmp_path / "descriptors.npy",
+            mode="w+",
+            dtype=np.float32,
+            shape=(len(names), dim),
+        )
+        for idx, name in enumerate(names):
+            descriptors[idx] = fd[name]["global_descriptor"].__array__()
+    descriptors.flush()
+    del descriptors
+    # Written last: its presence marks a complete snapshot
+    np.save(tmp_path / "names.npy", np.array(names))
+
+    _publish_version(tmp_path, snapshot_path)
+    print(f"Built descriptor snapshot for {len(names)} images at {snapshot_path}")
+    return snapshot_path
+
+
+def load_descriptor_snapshot(global_descriptors_path):
+    """
+    Memory-mapped (names, (N, D) descriptors) of a global descriptors h5 file,
+    (re)building the snapshot if it is stale.
+    The descriptors are mapped copy-on-write so that they can back a torch tensor.
+    """
+    snapshot_path = get_snapshot_path(global_descriptors_path)
+    _build_if_stale(
+        snapshot_path,
+        lambda: is_stale(global_descriptors_path, snapshot_path, "names.npy"),
+        lambda: _build_descriptor_snapshot(
+            Path(global_descriptors_path), snapshot_path
+        ),
+    )
+    # The version the symlink points to now, even if a newer one is published later
+    snapshot_path = Path(os.path.realpath(snapshot_path))
+    names = np.load(snapshot_path / "names.npy")
+    descriptors = np.load(snapshot_path / "descriptors.npy", mmap_mode="c")
+    return names, descriptors
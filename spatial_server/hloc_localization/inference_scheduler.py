@@ -0,0 +1,106 @@
+"""
+Micro-batching scheduler for concurrent localization requests.
+
+Requests from concurrent threads are queued and a single worker thread takes them
+in micro-batches: the first queued request waits at most max_wait_ms for others
+to arrive, up to max_batch_size requests. Each model then runs once per batch and
+the results are handed back to the waiting requests through futures.
+"""
+
+from collections import Counter
+from concurrent.futures import Future
+import queue
+import threading
+import time
+
+from . import pipeline
+
+
+class InferenceScheduler:
+    def __init__(self, shared_data, max_batch_size, max_wait_ms):
+        self.shared_data = shared_data
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.stats_lock = threading.Lock()
+        self.num_requests = 0
+        self.num_batches = 0
+        self.batch_sizes = Counter()
+        self.total_wait = 0.0
+        self.max_observed_wait = 0.0
+
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, image, map_data, prior=None):
+        """
+        Queue an RGB image to be localized against the map.
+        Returns a future with the (ret, log) localization result.
+        """
+        future = Future()
+        self.queue.put((time.monotonic(), image, map_data, prior, future))
+        return future
+
+    def _run(self):
+        while True:
+            first = self.queue.get()
+            batch = [first]
+            deadline = first[0] + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._record_batch(batch)
+            self._run_batch(batch)
+
+    def _record_batch(self, batch):
+        start = time.monotonic()
+        with self.stats_lock:
+            self.num_requests += len(batch)
+            self.num_batches += 1
+            self.batch_sizes[len(batch)] += 1
+            for queued_at, *_ in batch:
+                wait = start - queued_at
+                self.total_wait += wait
+                self.max_observed_wait = max(self.max_observed_wait, wait)
+
+    def _run_batch(self, batch):
+        queued_ats, images, map_datas, priors, futures = zip(*batch)
+        start = time.monotonic()
+        try:
+            results = pipeline.localize_queries(
+                list(images), list(map_datas), self.shared_data, priors=list(priors)
+            )
+        except Exception as e:
+            if len(batch) == 1:
+                futures[0].set_exception(e)
+                return
+            # Run the requests one by one so that only the failing one gets the error
+            for item in batch:
+                self._run_batch([item])
+            return
+
+        for future, queued_at, result in zip(futures, queued_ats, results):
+            result[1]["timings"]["queue"] = start - queued_at
+            future.set_result(result)
+
+    def info(self):
+        with self.stats_lock:
+            return {
+                "queue_depth": self.queue.qsize(),
+                "num_requests": self.num_requests,
+                "num_batches": self.num_batches,
+                "batch_sizes": dict(sorted(self.batch_sizes.items())),
+                "mean_wait_ms": (
+                    1000 * self.total_wait / self.num_requests
+                    if self.num_requests
+                    else 0.0
+                ),
+                "max_wait_ms": 1000 * self.max_observed_wait,
+                "max_batch_size": self.max_batch_size,
+                "batch_window_ms": 1000 * self.max_wait,
+            }
@@ -6,19 +6,34 @@ TODO: This is a hack to avoid loading model in every request. Find a better way
 from pathlib import Path
 import os
 
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import time
+
 import numpy as np
 import torch
 
-from . import config
+from . import config, feature_store, pipeline, reconstruction_data
+from .map_cache import MapCache
+from .retrieval_index import build_retrieval_index
+from .stacked_index import StackedIndexCache
 from third_party.hloc.hloc import (
     extract_features,
     match_features,
     extractors,
     matchers,
-    pairs_from_retrieval,
 )
 from third_party.hloc.hloc.utils.base_model import dynamic_load
-from third_party.hloc.hloc.utils.io import list_h5_names
+
+# Version of each loaded map data, increased every time a map is (re)loaded
+_map_versions = itertools.count()
+
+# File bumped when a job changed a map, so that every server process reloads it
+RELOAD_MARKER_FILENAME = "reload_marker"
+
+
+class NoMapsError(Exception):
+    pass
 
 
 def load_ml_models(shared_data):
@@ -53,34 +68,278 @@ def load_ml_models(shared_data):
     print(f'Loaded {match_features_conf["model"]["name"]} model')
 
 
-def load_db_data(shared_data):
+def _get_map_data_nbytes(map_data):
     """
-    Load map data into the shared_data dictionary
+    Memory used by the map data. The memory-mapped local features are shared
+    through the page cache and only their index is counted.
     """
-    if not os.path.exists("data/map_data"):
-        return
-    map_names_list = os.listdir("data/map_data")
-    shared_data["db_global_descriptors"] = {}
-    shared_data["db_image_names"] = {}
+    db_global_descriptors = map_data["db_global_descriptors"]
+    db_local_features = map_data["db_local_features"]
+    return (
+        map_data["reconstruction"]["nbytes"]
+        + map_data["retrieval_index"].nbytes
+        + db_global_descriptors.element_size() * db_global_descriptors.nelement()
+        + map_data["db_image_names"].nbytes
+        + db_local_features.names.nbytes
+        + db_local_features.offsets.nbytes
+        + db_local_features.image_sizes.nbytes
+    )
 
-    device = "cuda" if torch.cuda.is_available() else "cpu"
 
-    # Load global descriptors for all maps
+def get_map_data_paths(dataset_name):
+    """
+    Paths of the files in the map's hloc_data directory that the map data is read from
+    """
     global_descriptor_conf = extract_features.confs[config.GLOBAL_DESCRIPTOR_EXTRACTOR]
-    for dataset_name in map_names_list:
+    local_feature_conf = extract_features.confs[config.LOCAL_FEATURE_EXTRACTOR]
+
+    dataset = Path(os.path.join("data", "map_data", dataset_name, "hloc_data"))
+    cameras_path, images_path, points3D_path = reconstruction_data.get_model_file_paths(
+        reconstruction_data.get_reconstruction_path(dataset_name)
+    )
+    return {
+        "db_global_descriptors": (
+            dataset / global_descriptor_conf["output"]
+        ).with_suffix(".h5"),
+        "db_local_features": (dataset / local_feature_conf["output"]).with_suffix(
+            ".h5"
+        ),
+        "cameras": cameras_path,
+        "images": images_path,
+        "points3D": points3D_path,
+    }
+
+
+def _get_reload_marker_path(dataset_name):
+    return os.path.join("data", "map_data", dataset_name, RELOAD_MARKER_FILENAME)
+
+
+def get_reload_marker(dataset_name):
+    """
+    Signature of the map's reload marker file, None if the map was never marked
+    """
+    try:
+        stat = os.stat(_get_reload_marker_path(dataset_name))
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns)
+
+
+def mark_map_changed(dataset_name):
+    """
+    Replace the map's reload marker file. Every server process that has the map loaded
+    reloads it on its next use, whatever files of the map changed.
+    """
+    marker_path = _get_reload_marker_path(dataset_name)
+    tmp_path = f"{marker_path}.tmp{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        f.write(str(time.time_ns()))
+    os.replace(tmp_path, marker_path)
+
+
+def load_map_data(dataset_name):
+    """
+    Load the data of one map that is needed for localization
+    """
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    map_data_paths = get_map_data_paths(dataset_name)
+    # Read first, so that a map changed while it is loaded is loaded again
+    reload_marker = get_reload_marker(dataset_name)
+
+    # Memory-mapped snapshot of the global descriptors. Built from the h5 file if needed.
+    db_image_names, db_global_descriptors = feature_store.load_descriptor_snapshot(
+        map_data_paths["db_global_descriptors"]
+    )
+    db_global_descriptors = torch.from_numpy(db_global_descriptors).to(device)
+    retrieval_index = build_retrieval_index(db_global_descriptors)
+
+    # Memory-mapped local features of the db images. Built from the h5 file if needed.
+    db_local_features = feature_store.load_feature_store(
+        map_data_paths["db_local_features"]
+    )
+
+    # Parsed SfM reconstruction for the 2D-3D lookup
+    reconstruction = reconstruction_data.load_reconstruction_data(
+        reconstruction_data.get_reconstruction_path(dataset_name)
+    )
+
+    map_data = {
+        "db_global_descriptors": db_global_descriptors,
+        "db_image_names": db_image_names,
+        "db_image_idxs": {name: idx for idx, name in enumerate(db_image_names)},
+        "retrieval_index": retrieval_index,
+        "db_local_features": db_local_features,
+        "reconstruction": reconstruction,
+        # Thresholds of the early rejection, calibrated on first use
+        # (pipeline.get_rejection_thresholds)
+        "rejection_thresholds": None,
+        "reload_marker": reload_marker,
+        "version": next(_map_versions),
+    }
+    map_data["nbytes"] = _get_map_data_nbytes(map_data)
+    print(f"Loaded map data for {dataset_name}")
+    return map_data
+
+
+def list_map_names():
+    """
+    Names of the maps in data/map_data that have hloc data
+    """
+    if not os.path.exists("data/map_data"):
+        return []
+    return sorted(
+        dataset_name
+        for dataset_name in os.listdir("data/map_data")
+        if os.path.isdir(os.path.join("data", "map_data", dataset_name, "hloc_data"))
+    )
+
+
+def preload_maps(shared_data, dataset_names):
+    """
+    Load maps into the cache ahead of their first request.
+    dataset_names is a comma separated string of map names, or "*" for all maps.
+    """
+    if dataset_names.strip() == "*":
+        dataset_names = list_map_names()
+    else:
+        dataset_names = [name.strip() for name in dataset_names.split(",") if name.strip()]
+
+    def preload_map(dataset_name):
         try:
-            dataset = Path(os.path.join("data", "map_data", dataset_name, "hloc_data"))
-            db_global_descriptors_path = (
-                dataset / global_descriptor_conf["output"]
-            ).with_suffix(".h5")
-            db_image_names = np.array(list_h5_names(db_global_descriptors_path))
-            db_global_descriptors = pairs_from_retrieval.get_descriptors(
-                db_image_names, db_global_descriptors_path
-            )
-            db_global_descriptors = db_global_descriptors.to(device)
-            shared_data["db_global_descriptors"][dataset_name] = db_global_descriptors
-            shared_data["db_image_names"][dataset_name] = db_image_names
-            print(f"Loaded global descriptors for {dataset_name}")
+            get_map_data(shared_data, dataset_name)
         except Exception as e:
-            print(f"Error loading global descriptors for {dataset_name}: {e}")
-            continue
+            print(f"Error preloading map data for {dataset_name}: {e}")
+
+    # Maps are read in parallel; most of the time is spent in file reads
+    with ThreadPoolExecutor(max_workers=config.PRELOAD_WORKERS) as executor:
+        list(executor.map(preload_map, dataset_names))
+
+
+@torch.no_grad()
+def warm_up_models(shared_data):
+    """
+    Run the models once on a random image so that the first request does not pay
+    for the lazy initialization of torch and CUDA
+    """
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    image = np.random.default_rng(0).integers(0, 255, (480, 640, 3), dtype=np.uint8)
+    features = pipeline.extract_local_features(
+        [image],
+        shared_data["local_features_extractor_model"],
+        extract_features.confs[config.LOCAL_FEATURE_EXTRACTOR],
+        device,
+    )
+    pipeline.extract_global_descriptors(
+        [image],
+        shared_data["global_descriptor_model"],
+        extract_features.confs[config.GLOBAL_DESCRIPTOR_EXTRACTOR],
+        device,
+    )
+    pipeline.match_pairs(
+        shared_data["matcher_model"], [(features[0], features[0])], device
+    )
+    print("Warmed up the models")
+
+
+def warm_up_maps(shared_data):
+    """
+    Build the retrieval indexes and calibrate the rejection thresholds of the loaded maps.
+    Both run torch compute, so maps preloaded before the gunicorn workers fork get them
+    in each worker, after the fork.
+    """
+    for dataset_name, map_data in shared_data["map_cache"].items():
+        pipeline.get_rejection_thresholds(map_data)
+        print(f"Warmed up map data for {dataset_name}")
+
+
+def load_db_data(shared_data):
+    """
+    Set up the map data cache in the shared_data dictionary.
+    Maps are loaded lazily on their first localization request. If the cache
+    already exists, all loaded maps are dropped so that they are read again.
+    """
+    if "map_cache" in shared_data:
+        shared_data["map_cache"].clear()
+        shared_data["stacked_index_cache"].clear()
+        return
+    stacked_index_cache = StackedIndexCache()
+    shared_data["stacked_index_cache"] = stacked_index_cache
+    shared_data["map_cache"] = MapCache(
+        load_map_data,
+        config.MAP_CACHE_MAX_BYTES,
+        on_drop=stacked_index_cache.invalidate,
+    )
+
+
+def _get_map_signature(dataset_name):
+    """
+    Version of the map's reconstruction files and its reload marker
+    """
+    return (
+        reconstruction_data.get_reconstruction_version(
+            reconstruction_data.get_reconstruction_path(dataset_name)
+        ),
+        get_reload_marker(dataset_name),
+    )
+
+
+def _is_map_data_stale(map_data, signature):
+    return signature != (map_data["reconstruction"]["version"], map_data["reload_marker"])
+
+
+def get_map_data(shared_data, dataset_name):
+    """
+    Get the data of a map, loading it if it is not in the cache.
+    The map is reloaded if its reconstruction was rewritten or a job marked it changed
+    since it was loaded, once its files have stopped changing for MAP_RELOAD_DEBOUNCE
+    seconds. The loaded data is served until then and if the reload fails.
+    """
+    map_cache = shared_data["map_cache"]
+    map_data = map_cache.get(dataset_name)
+    signature = _get_map_signature(dataset_name)
+    if not _is_map_data_stale(map_data, signature):
+        return map_data
+
+    # Signature of the changed files and since when they are unchanged
+    now = time.monotonic()
+    pending = map_data.get("pending_signature")
+    if pending is None or pending[0] != signature:
+        map_data["pending_signature"] = (signature, now)
+        return map_data
+    if now - pending[1] < config.MAP_RELOAD_DEBOUNCE:
+        return map_data
+
+    print(f"Map data changed for {dataset_name}")
+    reloaded = map_cache.reload(
+        dataset_name,
+        is_stale=lambda current: _is_map_data_stale(
+            current, _get_map_signature(dataset_name)
+        ),
+        keep_on_error=True,
+    )
+    if not reloaded:
+        # Try again after another debounce interval
+        map_data["pending_signature"] = (signature, now)
+    return map_cache.get(dataset_name)
+
+
+def reload_map_data(shared_data, dataset_name):
+    """
+    Refresh the data of one map after it was rebuilt or modified.
+    Only this map is read again, and only if it is currently loaded.
+    """
+    if shared_data["map_cache"].reload(dataset_name):
+        print(f"Reloaded map data for {dataset_name}")
+
+
+def get_stacked_index(shared_data, dataset_names=None):
+    """
+    Stacked retrieval index over the given maps, loading them if needed, or over all
+    maps if no maps are given. There is one cached index per set of maps.
+    """
+    if not dataset_names:
+        dataset_names = list_map_names()
+        if len(dataset_names) == 0:
+            raise NoMapsError("No maps are available")
+    map_datas = [get_map_data(shared_data, name) for name in dataset_names]
+    return shared_data["stacked_index_cache"].get(list(dataset_names), map_datas)
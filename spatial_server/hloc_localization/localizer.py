@@ -1,16 +1,13 @@
 import numpy as np
-import os
-from pathlib import Path
-import pycolmap
 from scipy.spatial.transform import Rotation
-import torch
-
-from third_party.hloc.hloc import extract_features, pairs_from_retrieval, match_features
-from third_party.hloc.hloc.localize_sfm import QueryLocalizer, pose_from_cluster
-from third_party.hloc.hloc import fast_localize
-
-from . import config
-from .coordinate_transforms import get_aframe_pose_matrix
+import time
+
+from . import config, load_cache, metrics, pipeline
+from .coordinate_transforms import (
+    convert_aframe_to_hloc_position,
+    get_aframe_pose_matrix,
+)
+from .result_cache import image_hash
 from spatial_server.server import shared_data
 
 
@@ -30,43 +27,16 @@ def _rot_from_qvec(qvec):
     return Rotation.from_quat([qvec[1], qvec[2], qvec[3], qvec[0]])
 
 
-def get_hloc_camera_matrix_from_image(img_path, dataset_name, shared_data=shared_data):
-
-    local_feature_conf = extract_features.confs[config.LOCAL_FEATURE_EXTRACTOR]
-    global_descriptor_conf = extract_features.confs[config.GLOBAL_DESCRIPTOR_EXTRACTOR]
-
-    # Dataset paths
-    dataset = Path(os.path.join("data", "map_data", dataset_name, "hloc_data"))
-    db_local_features_path = (dataset / local_feature_conf["output"]).with_suffix(".h5")
-    # Use the scaled reconstruction if it exists
-    db_reconstruction = dataset / "scaled_sfm_reconstruction"
-    if not db_reconstruction.exists():
-        db_reconstruction = dataset / "sfm_reconstruction"
-
-    # Query data dirs
-    img_path = Path(img_path)
-    query_image_name = os.path.basename(img_path)
-    query_processing_data_dir = Path(os.path.dirname(img_path))
-
-    ret, log = fast_localize.localize(
-        query_processing_data_dir=query_processing_data_dir,
-        query_image_name=query_image_name,
-        device="cuda" if torch.cuda.is_available() else "cpu",
-        local_feature_conf=local_feature_conf,
-        local_features_extractor_model=shared_data["local_features_extractor_model"],
-        global_descriptor_conf=global_descriptor_conf,
-        global_descriptor_model=shared_data["global_descriptor_model"],
-        db_global_descriptors=shared_data["db_global_descriptors"][dataset_name],
-        db_image_names=shared_data["db_image_names"][dataset_name],
-        db_local_features_path=db_local_features_path,
-        matcher_model=shared_data["matcher_model"],
-        db_reconstruction=db_reconstruction,
-    )
-
-    ret["num_keypoints"] = int(log["keypoints_query"].shape[0])
-
-    ret["num_inliers/num_keypoints"] = float(
-        log["PnP_ret"]["num_inliers"] / log["keypoints_query"].shape[0]
+def _get_hloc_camera_matrix(ret, log):
+    """
+    Add the keypoint statistics and stage timings to the localization result and
+    convert the estimated pose to a (4,4) camera matrix
+    """
+    ret["timings"] = log["timings"]
+    num_keypoints = int(log["keypoints_query"].shape[0])
+    ret["num_keypoints"] = num_keypoints
+    ret["num_inliers/num_keypoints"] = (
+        float(log["PnP_ret"]["num_inliers"] / num_keypoints) if num_keypoints else 0.0
     )
 
     hloc_camera_matrix = None
@@ -81,16 +51,76 @@ def get_hloc_camera_matrix_from_image(img_path, dataset_name, shared_data=shared
     return hloc_camera_matrix, ret
 
 
-def localize(img_path, dataset_name):
+def _get_hloc_prior(prior_pose, prior_radius):
+    """
+    Convert an A-Frame camera pose prior to a (position, radius) prior in the hloc frame
+    """
+    if prior_pose is None:
+        return None
+    position = convert_aframe_to_hloc_position(np.asarray(prior_pose)[:3, 3])
+    if prior_radius is None:
+        prior_radius = config.POSE_PRIOR_RADIUS
+    return position, prior_radius
 
-    hloc_camera_matrix, ret = get_hloc_camera_matrix_from_image(img_path, dataset_name)
 
+def get_hloc_camera_matrices(
+    images, dataset_name, shared_data=shared_data, prior_pose=None, prior_radius=None
+):
+    """
+    Localize decoded RGB images against the map in one batch.
+    prior_pose is an optional (4,4) A-Frame camera matrix near which the images were taken
+    and prior_radius the search radius around it.
+    Returns a list of (hloc_camera_matrix, ret) tuples, one per image.
+    """
+    map_data = load_cache.get_map_data(shared_data, dataset_name)
+    prior = _get_hloc_prior(prior_pose, prior_radius)
+
+    scheduler = shared_data.get("inference_scheduler")
+    if scheduler is not None:
+        # Run in micro-batches together with the concurrent requests
+        futures = [scheduler.submit(image, map_data, prior) for image in images]
+        results = [future.result() for future in futures]
+    else:
+        results = pipeline.localize_images(
+            images, shared_data, map_data, priors=[prior] * len(images)
+        )
+
+    return [_get_hloc_camera_matrix(ret, log) for ret, log in results]
+
+
+def get_hloc_camera_matrix_from_image(img_path, dataset_name, shared_data=shared_data):
+    start = time.perf_counter()
+    image = pipeline.read_image(img_path)
+    decode_time = time.perf_counter() - start
+    hloc_camera_matrix, ret = get_hloc_camera_matrices(
+        [image], dataset_name, shared_data
+    )[0]
+    ret["timings"]["decode"] = decode_time
+    return hloc_camera_matrix, ret
+
+
+def get_hloc_camera_matrices_from_images(
+    img_paths, dataset_name, shared_data=shared_data
+):
+    images = [pipeline.read_image(img_path) for img_path in img_paths]
+    return get_hloc_camera_matrices(images, dataset_name, shared_data)
+
+
+def _get_localization_result(hloc_camera_matrix, ret, dataset_name, timings=None):
+    """
+    Convert the localization result to the response format and record its stage timings.
+    timings has the time in seconds of the stages run before the localization, e.g. decode.
+    The "timings" of the result are in milliseconds.
+    """
+    timings = {**(timings or {}), **ret.get("timings", {})}
     if ret["success"]:
+        start = time.perf_counter()
         pose_matrix = get_aframe_pose_matrix(
             hloc_camera_matrix=hloc_camera_matrix,
             dataset_name=dataset_name,
         )
-        return {
+        timings["transform"] = time.perf_counter() - start
+        result = {
             "success": True,
             "pose": pose_matrix,
             "num_inliers": int(ret["num_inliers"]),
@@ -99,4 +129,120 @@ def localize(img_path, dataset_name):
             "num_keypoints": ret["num_keypoints"],
         }
     else:
-        return {"success": False, "pose": None, "confidence": 0}
+        result = {"success": False, "pose": None, "confidence": 0}
+        if "rejected" in ret:
+            # The query was rejected before matching, e.g. it looks at a blank wall
+            result["reason"] = ret["rejected"]
+            metrics.REJECTIONS.inc((dataset_name, ret["rejected"]))
+
+    metrics.record_localization(dataset_name, timings, ret["success"])
+    result["timings"] = {stage: 1000 * seconds for stage, seconds in timings.items()}
+    return result
+
+
+def localize(img_path, dataset_name):
+
+    hloc_camera_matrix, ret = get_hloc_camera_matrix_from_image(img_path, dataset_name)
+
+    return _get_localization_result(hloc_camera_matrix, ret, dataset_name)
+
+
+def localize_image(
+    image, dataset_name, prior_pose=None, prior_radius=None, timings=None
+):
+    """
+    Localize a decoded RGB image. The image never touches the disk.
+    """
+    return localize_batch(
+        [image], dataset_name, prior_pose, prior_radius, [timings]
+    )[0]
+
+
+def localize_image_across_maps(image, dataset_names=None, timings=None):
+    """
+    Localize a decoded RGB image against several maps: the given maps, or all
+    maps if none are given. Raises load_cache.NoMapsError if there are no maps. The result includes the name of the matched map.
+    """
+    stacked_index = load_cache.get_stacked_index(shared_data, dataset_names)
+    dataset_name, ret, log = pipeline.localize_across_maps(
+        [image], stacked_index, shared_data
+    )[0]
+    if dataset_name is None:
+        timings = {**(timings or {}), **log["timings"]}
+        return {
+            "success": False,
+            "pose": None,
+            "confidence": 0,
+            "map_name": None,
+            "timings": {stage: 1000 * seconds for stage, seconds in timings.items()},
+        }
+
+    hloc_camera_matrix, ret = _get_hloc_camera_matrix(ret, log)
+    result = _get_localization_result(hloc_camera_matrix, ret, dataset_name, timings)
+    result["map_name"] = dataset_name if ret["success"] else None
+    return result
+
+
+def _get_cached_results(images, dataset_name, timings_list):
+    """
+    Look the images up in the result cache.
+    Returns the cached result or None for each image, and the key to cache it with.
+    """
+    result_cache = shared_data["result_cache"]
+    map_version = load_cache.get_map_data(shared_data, dataset_name)["version"]
+    results, keys = [], []
+    for image, timings in zip(images, timings_list):
+        start = time.perf_counter()
+        key = (dataset_name, map_version, image_hash(image))
+        cached_result = result_cache.get(*key)
+        keys.append(key)
+        if cached_result is None:
+            results.append(None)
+            continue
+        timings = {**(timings or {}), "result_cache": time.perf_counter() - start}
+        metrics.record_localization(dataset_name, timings, cached_result["success"])
+        results.append(
+            {
+                **cached_result,
+                "cached": True,
+                "timings": {stage: 1000 * seconds for stage, seconds in timings.items()},
+            }
+        )
+    return results, keys
+
+
+def localize_batch(
+    images, dataset_name, prior_pose=None, prior_radius=None, timings_list=None
+):
+    """
+    Localize decoded RGB images against the map in one batch.
+    With the result cache enabled, frames that are effectively unchanged since a
+    recent successful localization get the cached result. Requests with a pose prior
+    bypass the cache since the prior changes which db images are matched.
+    """
+    if timings_list is None:
+        timings_list = [None] * len(images)
+
+    results = [None] * len(images)
+    cache_keys = None
+    if "result_cache" in shared_data and prior_pose is None:
+        results, cache_keys = _get_cached_results(images, dataset_name, timings_list)
+
+    idxs = [i for i, result in enumerate(results) if result is None]
+    if len(idxs) == 0:
+        return results
+    hloc_results = get_hloc_camera_matrices(
+        [images[i] for i in idxs],
+        dataset_name,
+        prior_pose=prior_pose,
+        prior_radius=prior_radius,
+    )
+    for i, (hloc_camera_matrix, ret) in zip(idxs, hloc_results):
+        results[i] = _get_localization_result(
+            hloc_camera_matrix, ret, dataset_name, timings_list[i]
+        )
+        # Failures and rejections are not cached: the next frame may localize
+        if cache_keys is not None and results[i]["success"]:
+            cached_result = {k: v for k, v in results[i].items() if k != "timings"}
+            shared_data["result_cache"].put(*cache_keys[i], cached_result)
+    return results
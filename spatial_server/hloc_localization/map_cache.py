@@ -0,0 +1,186 @@
+"""
+LRU cache of the per-map data used for localization.
+
+Maps are loaded on their first localization request and kept in memory until the
+total size of the loaded maps exceeds the byte budget, at which point the least
+recently used maps are evicted.
+"""
+
+from collections import OrderedDict
+import threading
+
+
+class MapCache:
+    def __init__(self, load_map_data, max_bytes, on_drop=None):
+        """
+        load_map_data: function that loads the data of one map given its name.
+            It returns a dictionary with an "nbytes" entry with the size of the data.
+        max_bytes: memory budget for all loaded maps. The most recently used map is
+            always kept, even if it is larger than the budget by itself.
+        on_drop: optional function called with the name of a map whose data was evicted,
+            reloaded or invalidated, so that data derived from it can be dropped too
+        """
+        self.load_map_data = load_map_data
+        self.max_bytes = max_bytes
+        self.on_drop = on_drop
+        self.maps = OrderedDict()
+        self.lock = threading.Lock()
+        # One lock per map being loaded, with the number of requests using it, so that
+        # concurrent requests for a map load it only once. Removed when no request uses it.
+        self.loading_locks = {}
+        self.counts = {
+            "hits": 0,
+            "loads": 0,
+            "load_errors": 0,
+            "reloads": 0,
+            "evictions": 0,
+        }
+
+    def get(self, dataset_name):
+        with self.lock:
+            if dataset_name in self.maps:
+                self.maps.move_to_end(dataset_name)
+                self.counts["hits"] += 1
+                return self.maps[dataset_name]
+            loading_lock = self._use_loading_lock(dataset_name)
+
+        try:
+            with loading_lock:
+                # Another request may have loaded the map while waiting for the lock
+                with self.lock:
+                    if dataset_name in self.maps:
+                        self.maps.move_to_end(dataset_name)
+                        self.counts["hits"] += 1
+                        return self.maps[dataset_name]
+
+                try:
+                    map_data = self.load_map_data(dataset_name)
+                except Exception:
+                    with self.lock:
+                        self.counts["load_errors"] += 1
+                    raise
+
+                with self.lock:
+                    self.maps[dataset_name] = map_data
+                    self.counts["loads"] += 1
+                    evicted = self._evict()
+                self._dropped(evicted)
+                return map_data
+        finally:
+            self._release_loading_lock(dataset_name)
+
+    def _use_loading_lock(self, dataset_name):
+        """
+        Loading lock of a map, created on first use. Called with the lock held.
+        """
+        entry = self.loading_locks.setdefault(dataset_name, [threading.Lock(), 0])
+        entry[1] += 1
+        return entry[0]
+
+    def _release_loading_lock(self, dataset_name):
+        # Remove the loading lock once no request uses it, e.g. after an unknown map failed to load
+        with self.lock:
+            entry = self.loading_locks[dataset_name]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.loading_locks[dataset_name]
+
+    def _evict(self):
+        """
+        Evict the least recently used maps while over the budget. Called with the lock held.
+        Returns the names of the evicted maps.
+        """
+        evicted = []
+        while len(self.maps) > 1 and self.nbytes() > self.max_bytes:
+            dataset_name, _ = self.maps.popitem(last=False)
+            self.counts["evictions"] += 1
+            evicted.append(dataset_name)
+            print(f"Evicted map data for {dataset_name}")
+        return evicted
+
+    def _dropped(self, dataset_names):
+        # Called without the lock held
+        if self.on_drop is not None:
+            for dataset_name in dataset_names:
+                self.on_drop(dataset_name)
+
+    def items(self):
+        """
+        (name, map data) of the loaded maps, from the least to the most recently used
+        """
+        with self.lock:
+            return list(self.maps.items())
+
+    def nbytes(self):
+        return sum(map_data["nbytes"] for map_data in self.maps.values())
+
+    def reload(self, dataset_name, is_stale=None, keep_on_error=False):
+        """
+        Read the data of a loaded map again and swap it in, keeping its position in the LRU.
+        Maps that are not loaded are left alone since they are read on their next use.
+        is_stale: optional function of the loaded map data. The map is only read again if
+            it returns True once the loading lock is held, so concurrent requests that saw
+            the same stale data reload it once.
+        keep_on_error: keep serving the loaded data if reading the map fails, instead of
+            dropping it.
+        Returns whether the loaded data is up to date.
+        """
+        with self.lock:
+            if dataset_name not in self.maps:
+                return False
+            loading_lock = self._use_loading_lock(dataset_name)
+
+        try:
+            with loading_lock:
+                if is_stale is not None:
+                    with self.lock:
+                        map_data = self.maps.get(dataset_name)
+                    if map_data is None:
+                        return False
+                    if not is_stale(map_data):
+                        return True
+
+                try:
+                    map_data = self.load_map_data(dataset_name)
+                except Exception as e:
+                    print(f"Error reloading map data for {dataset_name}: {e}")
+                    with self.lock:
+                        self.counts["load_errors"] += 1
+                        if keep_on_error:
+                            return False
+                        # Drop the old data. The map is loaded again on its next use.
+                        self.maps.pop(dataset_name, None)
+                    self._dropped([dataset_name])
+                    return False
+
+                evicted = []
+                with self.lock:
+                    if dataset_name in self.maps:
+                        self.maps[dataset_name] = map_data
+                        self.counts["reloads"] += 1
+                        evicted = self._evict()
+                self._dropped([dataset_name] + evicted)
+                return True
+        finally:
+            self._release_loading_lock(dataset_name)
+
+    def invalidate(self, dataset_name):
+        """
+        Drop a map from the cache. It is loaded again on its next use.
+        """
+        with self.lock:
+            self.maps.pop(dataset_name, None)
+        self._dropped([dataset_name])
+
+    def clear(self):
+        with self.lock:
+            self.maps.clear()
+
+    def info(self):
+        with self.lock:
+            return {
+                "maps": {name: data["nbytes"] for name, data in self.maps.items()},
+                "nbytes": self.nbytes(),
+                "max_bytes": self.max_bytes,
+                **self.counts,
+            }
@@ -0,0 +1,159 @@
+"""
+Batched SuperGlue matching of the image pairs of a map build.
+
+hloc's match_features.main matches one pair at a time and reads the features of both
+images from the h5 file for every pair, so with 20 covisible neighbours per image the
+features of each image are read about 40 times. Here the images are ordered by a
+breadth-first walk of the pair graph, so that images sharing pairs are close in the
+order, and the pairs are grouped by their first image in that order. The features of an
+image are kept in memory until its last pair is matched, and the pairs are run through
+the matcher in batches with the localization pipeline's match_pairs. Only pairs
+with the same image sizes and keypoint counts share a batch, so the matches are the same
+as hloc's.
+
+The matches are written to an hloc matches h5 file. Pairs already in the file are
+skipped, like hloc does.
+"""
+
+from collections import OrderedDict, defaultdict, deque
+
+import h5py
+import numpy as np
+import torch
+
+from third_party.hloc.hloc import matchers
+from third_party.hloc.hloc.match_features import find_unique_new_pairs
+from third_party.hloc.hloc.utils.base_model import dynamic_load
+from third_party.hloc.hloc.utils.io import names_to_pair
+from third_party.hloc.hloc.utils.parsers import parse_retrieval
+
+from .. import config, pipeline
+
+
+class _FeatureCache:
+    """
+    Cache of the features of the images, read from the open features h5 file. Images are
+    discarded once they are no longer needed, or least recently used first beyond
+    max_images.
+    """
+
+    def __init__(self, fd, max_images):
+        self.fd = fd
+        self.max_images = max_images
+        self.features = OrderedDict()
+        self.num_reads = 0
+
+    def get(self, name):
+        features = self.features.get(name)
+        if features is not None:
+            self.features.move_to_end(name)
+            return features
+
+        group = self.fd[name]
+        features = {
+            key: group[key].__array__()
+            for key in ("keypoints", "scores", "descriptors", "image_size")
+        }
+        self.num_reads += 1
+        self.features[name] = features
+        if len(self.features) > self.max_images:
+            self.features.popitem(last=False)
+        return features
+
+    def discard(self, name):
+        self.features.pop(name, None)
+
+
+def _order_pairs(pairs):
+    """
+    Order the pairs so that the pairs of an image follow each other and images sharing
+    pairs are close: the images are numbered in breadth-first order of the pair graph,
+    and the pairs sorted by the numbers of their images
+    """
+    neighbours = defaultdict(set)
+    for name0, name1 in pairs:
+        neighbours[name0].add(name1)
+        neighbours[name1].add(name0)
+
+    order = {}
+    for root in sorted(neighbours):
+        if root in order:
+            continue
+        order[root] = len(order)
+        queue = deque([root])
+        while queue:
+            for name in sorted(neighbours[queue.popleft()]):
+                if name not in order:
+                    order[name] = len(order)
+                    queue.append(name)
+
+    return sorted(
+        pairs,
+        key=lambda pair: sorted((order[pair[0]], order[pair[1]])),
+    )
+
+
+@torch.no_grad()
+def match_pairs_batched(
+    conf,
+    pairs_path,
+    features_path,
+    matches_path,
+    batch_size=config.MATCHER_BATCH_SIZE,
+    cache_size=config.BUILD_MATCHING_CACHE_IMAGES,
+):
+    """
+    Match the image pairs of pairs_path with the features of features_path and an
+    hloc matcher conf, and write the matches to matches_path
+    """
+    pairs = parse_retrieval(pairs_path)
+    pairs = [(name0, name1) for name0, names1 in pairs.items() for name1 in names1]
+    pairs = find_unique_new_pairs(pairs, matches_path)
+    if len(pairs) == 0:
+        print(f"Skipping the matching: all pairs are in {matches_path}")
+        return matches_path
+    pairs = _order_pairs(pairs)
+    # Index of the last pair of each image, after which its features are discarded
+    last_uses = {}
+    for i, pair in enumerate(pairs):
+        for name in pair:
+            last_uses[name] = i
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    Model = dynamic_load(matchers, conf["model"]["name"])
+    model = Model(conf["model"]).eval().to(device)
+
+    # Several batches per chunk, so that pairs of the same image sizes can be grouped
+    chunk_size = batch_size * 8
+    print(f"Matching {len(pairs)} pairs in batches of {batch_size}")
+    with h5py.File(str(features_path), "r", libver="latest") as features_fd, h5py.File(
+        str(matches_path), "a", libver="latest"
+    ) as fd:
+        cache = _FeatureCache(features_fd, cache_size)
+        for start in range(0, len(pairs), chunk_size):
+            chunk = pairs[start : start + chunk_size]
+            results = pipeline.match_pairs(
+                model,
+                [(cache.get(name0), cache.get(name1)) for name0, name1 in chunk],
+                device,
+                batch_size,
+            )
+            for (name0, name1), (matches, scores) in zip(chunk, results):
+                pair = names_to_pair(name0, name1)
+                if pair in fd:
+                    del fd[pair]
+                group = fd.create_group(pair)
+                # Same dtypes as hloc's match_features
+                group.create_dataset("matches0", data=matches.astype(np.int16))
+                group.create_dataset(
+                    "matching_scores0", data=scores.astype(np.float16)
+                )
+            for name0, name1 in chunk:
+                for name in (name0, name1):
+                    if last_uses[name] < start + chunk_size:
+                        cache.discard(name)
+
+    print(
+        f"Matched {len(pairs)} pairs, reading the features of {cache.num_reads} images"
+    )
+    return matches_path
@@ -0,0 +1,157 @@
+"""
+Stage-level checkpoints of the map building.
+
+Each stage of a build writes a manifest to <hloc_data>/checkpoints/<stage>.json with
+the content hashes of its inputs and outputs and its configuration. A stage whose
+manifest is complete and whose inputs, configuration and outputs still match is
+skipped, so re-running a build only repeats the stages after the first changed one,
+and a build that crashed resumes from the stage it was in.
+
+A stage that was interrupted is resumed with its partial outputs if its inputs and
+configuration are unchanged (hloc skips the images and pairs it already processed),
+otherwise its outputs are deleted and it runs from scratch.
+
+The files are hashed once: like git's index, the manifests keep the size and
+modification time of every hashed file and its hash is reused while they match.
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+import shutil
+
+MANIFEST_VERSION = 1
+
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _remove(path):
+    path = Path(path)
+    if path.is_symlink():
+        # Versioned feature store or snapshot; its versions are replaced by the next build
+        path.unlink()
+    elif path.is_dir():
+        shutil.rmtree(path)
+    elif path.exists():
+        path.unlink()
+
+
+class BuildCheckpoints:
+    def __init__(self, checkpoint_dir):
+        self.checkpoint_dir = Path(checkpoint_dir)
+        # Absolute file path to {"size", "mtime_ns", "sha256"}, seeded from the manifests
+        self.file_hashes = {}
+        if self.checkpoint_dir.exists():
+            for manifest_path in self.checkpoint_dir.glob("*.json"):
+                manifest = self._read_manifest(manifest_path)
+                if manifest is not None:
+                    self.file_hashes.update(manifest["files"])
+
+    def _read_manifest(self, manifest_path):
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if manifest.get("version") != MANIFEST_VERSION:
+            return None
+        return manifest
+
+    def _write_manifest(self, stage, manifest):
+        self.checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        manifest_path = self.checkpoint_dir / f"{stage}.json"
+        tmp_path = manifest_path.with_suffix(f".json.tmp{os.getpid()}")
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, manifest_path)
+
+    def _file_hash(self, path, files):
+        key = str(path.resolve())
+        stat = path.stat()
+        entry = self.file_hashes.get(key)
+        if (
+            entry is None
+            or entry["size"] != stat.st_size
+            or entry["mtime_ns"] != stat.st_mtime_ns
+        ):
+            entry = {
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "sha256": _hash_file(path),
+            }
+            self.file_hashes[key] = entry
+        files[key] = entry
+        return entry["sha256"]
+
+    def fingerprint(self, path, files):
+        """
+        Content hash of a file or of a directory tree (names and contents), None if
+        the path does not exist. The hashed files are added to files.
+        """
+        path = Path(path)
+        if path.is_file():
+            return self._file_hash(path, files)
+        if not path.is_dir():
+            return None
+        digest = hashlib.sha256()
+        for file_path in sorted(p for p in path.rglob("*") if p.is_file()):
+            digest.update(str(file_path.relative_to(path)).encode())
+            digest.update(self._file_hash(file_path, files).encode())
+        return digest.hexdigest()
+
+    def run(self, stage, function, inputs, outputs, config=None):
+        """
+        Run function() for a stage unless its last run completed with the same inputs,
+        configuration and outputs. inputs and outputs map names to paths, config is
+        JSON-serializable. Returns whether the stage was run.
+        """
+        config = json.loads(json.dumps(config, sort_keys=True, default=str))
+        files = {}
+        input_hashes = {
+            name: self.fingerprint(path, files) for name, path in inputs.items()
+        }
+        previous = self._read_manifest(self.checkpoint_dir / f"{stage}.json")
+        same_inputs = (
+            previous is not None
+            and previous["inputs"] == input_hashes
+            and previous["config"] == config
+        )
+
+        if same_inputs and previous["complete"]:
+            output_hashes = {
+                name: self.fingerprint(path, {}) for name, path in outputs.items()
+            }
+            if previous["outputs"] == output_hashes:
+                print(f"Skipping stage {stage}: inputs and outputs are unchanged")
+                return False
+
+        # Resume an interrupted run from its partial outputs if its inputs are unchanged
+        resume = same_inputs and not previous["complete"]
+        if not resume:
+            for path in outputs.values():
+                _remove(path)
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "stage": stage,
+            "inputs": input_hashes,
+            "config": config,
+            "complete": False,
+            "files": files,
+        }
+        self._write_manifest(stage, manifest)
+
+        function()
+
+        manifest["outputs"] = {
+            name: self.fingerprint(path, files) for name, path in outputs.items()
+        }
+        manifest["complete"] = True
+        self._write_manifest(stage, manifest)
+        return True
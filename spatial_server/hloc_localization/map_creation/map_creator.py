@@ -17,17 +17,33 @@ from third_party.hloc.hloc import (
     triangulation,
 )
 
-from .. import config, load_cache
+from .. import config, feature_store, load_cache
 from spatial_server.server import shared_data
+from spatial_server.utils.job_queue import set_stage
 from spatial_server.utils.run_command import run_command
 from spatial_server.utils.print_log import print_log
-from . import map_aligner, map_cleaner, kiri_engine, polycam, video, polycam2
+from . import (
+    batched_matching,
+    build_checkpoint,
+    map_aligner,
+    map_cleaner,
+    parallel_extraction,
+    kiri_engine,
+    polycam,
+    video,
+    polycam2,
+)
 
 
 def create_map_from_colmap_data(
     ns_process_output_dir=None, colmap_model_path=None, image_dir=None, output_dir=None,
     manhattan_align=True, elevate=True, clean=True
 ):
+    """
+    Build the hloc map of a COLMAP reconstruction, skipping the stages whose checkpoints
+    are up to date. A failed stage, including the triangulation, raises so that the map
+    building job fails instead of succeeding without a map.
+    """
 
     # Build the hloc map and features
     assert ns_process_output_dir is not None or (
@@ -55,19 +71,136 @@ def create_map_from_colmap_data(
         hloc_output_dir / "sfm_reconstruction"
     )  # Path to reconstructed SfM
 
+    # Each stage is skipped if its inputs, configuration and outputs are unchanged since
+    # its last run, and resumed if it was interrupted
+    checkpoints = build_checkpoint.BuildCheckpoints(hloc_output_dir / "checkpoints")
+
     # Feature extraction
-    ## Extract local features in each data set image using Superpoint
-    print("Extracting local features using Superpoint..")
     local_feature_conf = extract_features.confs[config.LOCAL_FEATURE_EXTRACTOR]
-    local_features_path = extract_features.main(
-        conf=local_feature_conf, image_dir=image_dir, export_dir=hloc_output_dir
+    local_features_path = hloc_output_dir / f"{local_feature_conf['output']}.h5"
+    global_descriptor_conf = extract_features.confs[config.GLOBAL_DESCRIPTOR_EXTRACTOR]
+    global_descriptors_path = (
+        hloc_output_dir / f"{global_descriptor_conf['output']}.h5"
     )
 
-    print("Extracting global descriptors using NetVLad..")
-    ## Extract global descriptors from each image using NetVLad
-    global_descriptor_conf = extract_features.confs[config.GLOBAL_DESCRIPTOR_EXTRACTOR]
-    global_descriptors_path = extract_features.main(
-        conf=global_descriptor_conf, image_dir=image_dir, export_dir=hloc_output_dir
+    if config.FUSED_EXTRACTION:
+        ## Extract the local features (Superpoint) and global descriptors (NetVLad) of
+        ## each data set image in one pass that reads each image once
+        def extract_all_features():
+            print("Extracting local features and global descriptors (fused)..")
+            set_stage("features")
+            parallel_extraction.extract_features_parallel(
+                [(local_feature_conf, False), (global_descriptor_conf, True)],
+                image_dir,
+                hloc_output_dir,
+                num_workers=max(1, config.EXTRACTION_WORKERS),
+                # Without sharding, the one worker uses all the cores
+                num_threads=(
+                    config.EXTRACTION_THREADS_PER_WORKER
+                    if config.EXTRACTION_WORKERS > 0
+                    else None
+                ),
+            )
+
+        checkpoints.run(
+            "features",
+            extract_all_features,
+            inputs={"images": image_dir},
+            outputs={
+                "features": local_features_path,
+                "descriptors": global_descriptors_path,
+                "partial_features": parallel_extraction.get_parts_path(
+                    local_features_path
+                ),
+                "partial_descriptors": parallel_extraction.get_parts_path(
+                    global_descriptors_path
+                ),
+            },
+            config={"local": local_feature_conf, "global": global_descriptor_conf},
+        )
+
+    else:
+        ## Extract local features in each data set image using Superpoint
+        def extract_local_features():
+            print("Extracting local features using Superpoint..")
+            set_stage("local_features")
+            if config.EXTRACTION_WORKERS > 0:
+                parallel_extraction.extract_features_sharded(
+                    local_feature_conf, image_dir, hloc_output_dir
+                )
+            else:
+                extract_features.main(
+                    conf=local_feature_conf, image_dir=image_dir, export_dir=hloc_output_dir
+                )
+
+        checkpoints.run(
+            "local_features",
+            extract_local_features,
+            inputs={"images": image_dir},
+            outputs={
+                "features": local_features_path,
+                "partial_features": parallel_extraction.get_parts_path(
+                    local_features_path
+                ),
+            },
+            config=local_feature_conf,
+        )
+
+        ## Extract global descriptors from each image using NetVLad
+        def extract_global_descriptors():
+            print("Extracting global descriptors using NetVLad..")
+            set_stage("global_descriptors")
+            if config.EXTRACTION_WORKERS > 0:
+                parallel_extraction.extract_features_sharded(
+                    global_descriptor_conf,
+                    image_dir,
+                    hloc_output_dir,
+                    global_descriptors=True,
+                )
+            else:
+                extract_features.main(
+                    conf=global_descriptor_conf,
+                    image_dir=image_dir,
+                    export_dir=hloc_output_dir,
+                )
+
+        checkpoints.run(
+            "global_descriptors",
+            extract_global_descriptors,
+            inputs={"images": image_dir},
+            outputs={
+                "descriptors": global_descriptors_path,
+                "partial_descriptors": parallel_extraction.get_parts_path(
+                    global_descriptors_path
+                ),
+            },
+            config=global_descriptor_conf,
+        )
+
+    ## Write the local features to the memory-mapped feature store used for localization
+    def build_feature_store():
+        print("Building the local feature store..")
+        set_stage("feature_store")
+        feature_store.build_feature_store(local_features_path)
+
+    checkpoints.run(
+        "feature_store",
+        build_feature_store,
+        inputs={"features": local_features_path},
+        outputs={"store": feature_store.get_store_path(local_features_path)},
+    )
+
+    ## Write the global descriptors to the memory-mapped snapshot used for localization
+    def build_descriptor_snapshot():
+        print("Building the global descriptor snapshot..")
+        set_stage("descriptor_snapshot")
+        feature_store.build_descriptor_snapshot(global_descriptors_path)
+
+    checkpoints.run(
+        "descriptor_snapshot",
+        build_descriptor_snapshot,
+        inputs={"descriptors": global_descriptors_path},
+        outputs={"snapshot": feature_store.get_snapshot_path(global_descriptors_path)},
     )
 
     # Create SfM model using the local features just extracted
@@ -78,53 +211,107 @@ def create_map_from_colmap_data(
     ## Create matching pairs:
     ## Instead of creating image pairs by exhaustively searching through all possible pairs, we leverage the
     ## existing colmap model and form pairs by selecting the top 20 most covisibile neighbors for each image
-    print("Forming pairs from covisibility..")
-    pairs_from_covisibility.main(
-        model=colmap_model_path, output=sfm_pairs_path, num_matched=20
+    def form_pairs():
+        print("Forming pairs from covisibility..")
+        set_stage("pairs")
+        pairs_from_covisibility.main(
+            model=colmap_model_path, output=sfm_pairs_path, num_matched=20
+        )
+
+    checkpoints.run(
+        "pairs",
+        form_pairs,
+        inputs={"model": colmap_model_path},
+        outputs={"pairs": sfm_pairs_path},
+        config={"num_matched": 20},
     )
 
     ## Use the created pairs to match images and store the matching result in a match file
-    print("Matching features using SuperGlue")
     match_features_conf = match_features.confs[config.MATCHER]
-    sfm_matches_path = match_features.main(
-        conf=match_features_conf,
-        pairs=sfm_pairs_path,
-        features=local_feature_conf[
-            "output"
-        ],  # This contains the file name where lcoal features are stored
-        export_dir=hloc_output_dir,
+    sfm_matches_path = hloc_output_dir / (
+        f"{local_feature_conf['output']}_{match_features_conf['output']}"
+        f"_{sfm_pairs_path.stem}.h5"
     )
 
-    try:
-        ## Use the matches to reconstruct an SfM model
-        print("Reconstructing Model..")
-        reconstruction = triangulation.main(
-            sfm_dir=sfm_reconstruction_path,
-            reference_model=colmap_model_path,
-            image_dir=image_dir,
-            pairs=sfm_pairs_path,
-            features=local_features_path,
-            matches=sfm_matches_path,
-        )
-    # If the reconstruction fails, print the error trace
-    except Exception as e:
-        print("Reconstruction failed..Error trace:")
-        print(e)
-        return
-
-    if manhattan_align:
-        # Align the model using Manhattan
-        print("Aligning the model using Manhattan..")
-        map_aligner.align_colmap_model_manhattan(image_dir, sfm_reconstruction_path)
-
-    if elevate:
-        # Elevate the model to ground level
-        print("Elevate map to ground level..")
-        map_cleaner.elevate_existing_reconstruction(sfm_reconstruction_path)
-
-    # Clean the map by removing outliers and save it as a PCD
-    print("Cleaning the map..")
-    map_cleaner.clean_map(sfm_reconstruction_path)
+    def match_pairs():
+        print("Matching features using SuperGlue")
+        set_stage("matching")
+        if config.BATCHED_BUILD_MATCHING:
+            batched_matching.match_pairs_batched(
+                match_features_conf, sfm_pairs_path, local_features_path, sfm_matches_path
+            )
+        else:
+            match_features.main(
+                conf=match_features_conf,
+                pairs=sfm_pairs_path,
+                features=local_features_path,
+                matches=sfm_matches_path,
+            )
+
+    checkpoints.run(
+        "matching",
+        match_pairs,
+        inputs={"pairs": sfm_pairs_path, "features": local_features_path},
+        outputs={"matches": sfm_matches_path},
+        config=match_features_conf,
+    )
+
+    ## Triangulation, alignment, elevation and cleaning are one stage: the last three
+    ## modify the reconstruction in place and must not be applied twice
+    def reconstruct():
+        try:
+            ## Use the matches to reconstruct an SfM model
+            print("Reconstructing Model..")
+            set_stage("triangulation")
+            triangulation.main(
+                sfm_dir=sfm_reconstruction_path,
+                reference_model=colmap_model_path,
+                image_dir=image_dir,
+                pairs=sfm_pairs_path,
+                features=local_features_path,
+                matches=sfm_matches_path,
+            )
+        # If the reconstruction fails, print the error trace
+        except Exception as e:
+            print("Reconstruction failed..Error trace:")
+            print(e)
+            raise
+
+        if manhattan_align:
+            # Align the model using Manhattan
+            print("Aligning the model using Manhattan..")
+            set_stage("manhattan_alignment")
+            map_aligner.align_colmap_model_manhattan(image_dir, sfm_reconstruction_path)
+
+        if elevate:
+            # Elevate the model to ground level
+            print("Elevate map to ground level..")
+            set_stage("elevation")
+            map_cleaner.elevate_existing_reconstruction(sfm_reconstruction_path)
+
+        # Clean the map by removing outliers and save it as a PCD
+        print("Cleaning the map..")
+        set_stage("cleaning")
+        map_cleaner.clean_map(sfm_reconstruction_path)
+
+    # The reconstruction is run again if it was changed since, e.g. transformed after
+    # the build or scaled
+    checkpoints.run(
+        "reconstruction",
+        reconstruct,
+        inputs={
+            "model": colmap_model_path,
+            "images": image_dir,
+            "pairs": sfm_pairs_path,
+            "features": local_features_path,
+            "matches": sfm_matches_path,
+        },
+        outputs={
+            "reconstruction": sfm_reconstruction_path,
+            "point_cloud": hloc_output_dir / "points.pcd",
+        },
+        config={"manhattan_align": manhattan_align, "elevate": elevate},
+    )
 
 
 def create_map_from_reality_capture(data_dir):
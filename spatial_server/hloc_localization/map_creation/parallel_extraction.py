@@ -0,0 +1,258 @@
+"""
+Sharded feature extraction for map building on CPU-only machines.
+
+hloc's extract_features.main runs the model on one image at a time in one process, so
+most cores sit idle. Here the images are split across worker processes, each running
+the model with a bounded number of torch threads on batches of images that background
+threads decode ahead of it. Each worker writes a partial h5 file, and the partial files
+are merged into the standard hloc features h5 file.
+
+Several models can be run in one pass (fused extraction): each image is then read and
+decoded once, and each model's resize and grayscale preprocessing starts from the same
+decoded buffer. Map building extracts the SuperPoint features and NetVLAD descriptors
+this way, so that every image is read once from the (possibly network-backed) storage.
+
+Images already in the features file are skipped, like hloc does, and the partial files
+left by an interrupted run are merged before extracting the remaining images.
+"""
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
+import multiprocessing
+from pathlib import Path
+import shutil
+
+import h5py
+import numpy as np
+import torch
+
+from third_party.hloc.hloc import extract_features, extractors
+from third_party.hloc.hloc.utils.base_model import dynamic_load
+from third_party.hloc.hloc.utils.io import list_h5_names
+
+from .. import config, pipeline
+
+
+def get_parts_path(feature_path):
+    """
+    Directory of the partial h5 files of the workers extracting into feature_path
+    """
+    feature_path = Path(feature_path)
+    return feature_path.with_name(feature_path.name + ".parts")
+
+
+def _read_images(pool, image_dir, names, num_prefetched):
+    """
+    Yield the (name, RGB image) of the images in order, decoding up to num_prefetched
+    images ahead in the thread pool
+    """
+    names = iter(names)
+    pending = deque()
+    for name in names:
+        pending.append((name, pool.submit(pipeline.read_image, image_dir / name)))
+        if len(pending) < num_prefetched:
+            continue
+        name, future = pending.popleft()
+        yield name, future.result()
+    for name, future in pending:
+        yield name, future.result()
+
+
+def _resize_scale(image_size, preprocessing_conf):
+    # Scale from the preprocessed image to the original image, as in hloc's ImageDataset
+    conf = {**extract_features.ImageDataset.default_conf, **preprocessing_conf}
+    if conf["resize_max"] and (
+        conf["resize_force"] or max(image_size) > conf["resize_max"]
+    ):
+        return max(image_size) / conf["resize_max"]
+    return 1.0
+
+
+def _write_features(fd, name, features, as_half, uncertainty=None):
+    if name in fd:
+        del fd[name]
+    group = fd.create_group(name)
+    # image_size is written last: the merge only keeps the images that have it
+    items = sorted(features.items(), key=lambda item: item[0] == "image_size")
+    for key, value in items:
+        if as_half and value.dtype == np.float32:
+            value = value.astype(np.float16)
+        group.create_dataset(key, data=value)
+    if uncertainty is not None:
+        group["keypoints"].attrs["uncertainty"] = uncertainty
+
+
+def _extract_shard(
+    extractions, image_dir, names, part_paths, num_threads, num_prefetch_threads,
+    as_half,
+):
+    """
+    Extract the features of the images of a shard in a worker process. Each image is
+    decoded once and run through the model of every (conf, global_descriptors)
+    extraction, whose features are written to the matching partial file.
+    """
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    models = []
+    for conf, _ in extractions:
+        Model = dynamic_load(extractors, conf["model"]["name"])
+        models.append(Model(conf["model"]).eval().to(device))
+    batch_size = config.EXTRACTION_BATCH_SIZE
+
+    with ThreadPoolExecutor(num_prefetch_threads) as pool, ExitStack() as stack:
+        fds = [
+            stack.enter_context(h5py.File(str(part_path), "w", libver="latest"))
+            for part_path in part_paths
+        ]
+        images = _read_images(
+            pool, image_dir, names, num_prefetched=num_prefetch_threads + batch_size
+        )
+        batch = []
+        for i, (name, image) in enumerate(images):
+            batch.append((name, image))
+            if len(batch) < batch_size and i < len(names) - 1:
+                continue
+
+            batch_images = [image for _, image in batch]
+            for (conf, global_descriptors), model, fd in zip(extractions, models, fds):
+                if global_descriptors:
+                    descriptors = pipeline.extract_global_descriptors(
+                        batch_images, model, conf, device, batch_size
+                    )
+                    for (name, image), descriptor in zip(batch, descriptors):
+                        features = {
+                            "global_descriptor": descriptor.cpu().numpy(),
+                            "image_size": np.array(image.shape[:2][::-1]),
+                        }
+                        _write_features(fd, name, features, as_half)
+                else:
+                    local_features = pipeline.extract_local_features(
+                        batch_images, model, conf, device, batch_size
+                    )
+                    for (name, _), features in zip(batch, local_features):
+                        scale = _resize_scale(
+                            features["image_size"], conf["preprocessing"]
+                        )
+                        uncertainty = getattr(model, "detection_noise", 1) * scale
+                        _write_features(fd, name, features, as_half, uncertainty)
+            batch = []
+    return len(names)
+
+
+def _merge_parts(feature_path, parts_path):
+    """
+    Copy the complete images of the partial files into the features file and
+    delete the partial files
+    """
+    if not parts_path.exists():
+        return
+    with h5py.File(str(feature_path), "a", libver="latest") as fd:
+        for part_path in sorted(parts_path.glob("*.h5")):
+            try:
+                names = list_h5_names(part_path)
+                with h5py.File(str(part_path), "r", libver="latest") as part:
+                    for name in names:
+                        if "image_size" not in part[name]:
+                            continue
+                        if name in fd:
+                            del fd[name]
+                        parent = str(Path(name).parent)
+                        dest = fd if parent == "." else fd.require_group(parent)
+                        part.copy(part[name], dest, name=Path(name).name)
+            # A partial file whose worker was killed while writing can be unreadable
+            except OSError as e:
+                print(f"Skipping unreadable partial features file {part_path}: {e}")
+    shutil.rmtree(parts_path)
+
+
+def extract_features_parallel(
+    extractions,
+    image_dir,
+    export_dir,
+    num_workers=config.EXTRACTION_WORKERS,
+    num_threads=config.EXTRACTION_THREADS_PER_WORKER,
+    num_prefetch_threads=config.EXTRACTION_PREFETCH_THREADS,
+    as_half=True,
+):
+    """
+    Extract the features of the images in image_dir for each (hloc extraction conf,
+    global_descriptors) of extractions into export_dir/<conf output>.h5, the file
+    written by extract_features.main, using num_workers processes. global_descriptors
+    is True for global descriptor models (NetVLAD). With several extractions, each
+    image is read and decoded once for all of them. num_threads None leaves torch's
+    default number of threads to the workers.
+    Returns the paths of the features files.
+    """
+    image_dir = Path(image_dir)
+    feature_paths = [
+        Path(export_dir, conf["output"] + ".h5") for conf, _ in extractions
+    ]
+    Path(export_dir).mkdir(parents=True, exist_ok=True)
+
+    # Keep the images extracted by the workers of an interrupted run
+    for feature_path in feature_paths:
+        _merge_parts(feature_path, get_parts_path(feature_path))
+    all_names = extract_features.ImageDataset(
+        image_dir, extractions[0][0]["preprocessing"]
+    ).names
+    done = None
+    for feature_path in feature_paths:
+        names = set(list_h5_names(feature_path)) if feature_path.exists() else set()
+        done = names if done is None else done & names
+    # Images missing from any of the files are extracted for all of them
+    names = [name for name in all_names if name not in done]
+    if len(names) == 0:
+        print("Skipping the extraction: all images are in " + ", ".join(
+            str(feature_path) for feature_path in feature_paths
+        ))
+        return feature_paths
+
+    num_workers = max(1, min(num_workers, len(names)))
+    model_names = ", ".join(conf["model"]["name"] for conf, _ in extractions)
+    print(
+        f"Extracting {model_names} features of {len(names)} images"
+        f" with {num_workers} workers"
+    )
+    for feature_path in feature_paths:
+        get_parts_path(feature_path).mkdir()
+    with ProcessPoolExecutor(
+        num_workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        futures = [
+            executor.submit(
+                _extract_shard,
+                extractions,
+                image_dir,
+                # Interleaved shards, so that workers get images of similar sizes
+                names[worker::num_workers],
+                [
+                    get_parts_path(feature_path) / f"{worker}.h5"
+                    for feature_path in feature_paths
+                ],
+                num_threads,
+                num_prefetch_threads,
+                as_half,
+            )
+            for worker in range(num_workers)
+        ]
+        for future in futures:
+            future.result()
+
+    for feature_path in feature_paths:
+        _merge_parts(feature_path, get_parts_path(feature_path))
+        print(f"Extracted features to {feature_path}")
+    return feature_paths
+
+
+def extract_features_sharded(
+    conf, image_dir, export_dir, global_descriptors=False, **kwargs
+):
+    """
+    Extract the features of one hloc extraction conf with extract_features_parallel.
+    Returns the path of the features file.
+    """
+    return extract_features_parallel(
+        [(conf, global_descriptors)], image_dir, export_dir, **kwargs
+    )[0]
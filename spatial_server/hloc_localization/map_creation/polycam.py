@@ -10,6 +10,7 @@ import numpy as np
 from scipy.spatial.transform import Rotation
 
 from . import map_creator
+from spatial_server.utils.job_queue import set_stage
 from spatial_server.utils.run_command import run_command
 from spatial_server.utils.print_log import print_log
 from spatial_server.hloc_localization.map_creation.map_transforms import transform_map_from_matrix
@@ -297,6 +298,7 @@ def build_map_from_polycam_output(polycam_data_directory, log_filepath=None, neg
     hloc_data_directory = Path(polycam_data_directory).parent / "hloc_data"
 
     # Call nsprocess data
+    set_stage("ns_process_data")
     run_command(
         [
             "ns-process-data",
@@ -329,6 +331,7 @@ def build_map_from_polycam_output(polycam_data_directory, log_filepath=None, neg
         os.remove(images_directory / img)
 
     # Extract features and create database
+    set_stage("colmap_features")
     os.makedirs(colmap_directory, exist_ok=True)
     extract_features_command = [
         "colmap",
@@ -380,6 +383,7 @@ def build_map_from_polycam_output(polycam_data_directory, log_filepath=None, neg
         f.write(points3D_file_str)
 
     # Run matching
+    set_stage("colmap_matching")
     os.makedirs(final_recon_output_directory, exist_ok=True)
     matcher_command = [
         "colmap",
@@ -398,6 +402,7 @@ def build_map_from_polycam_output(polycam_data_directory, log_filepath=None, neg
     )
 
     # Run triangulation
+    set_stage("colmap_triangulation")
     triangulation_command = [
         "colmap",
         "point_triangulator",
@@ -437,6 +442,7 @@ def build_map_from_polycam_output(polycam_data_directory, log_filepath=None, neg
 
             # Transform the map to the correct orientation using the mesh_info.json file
             print("Transforming the map using mesh_info.json...")
+            set_stage("mesh_alignment")
             # Read alignment transform
             with open(Path(polycam_data_directory) / "mesh_info.json") as f:
                 mesh_info = json.load(f)
@@ -452,5 +458,8 @@ def build_map_from_polycam_output(polycam_data_directory, log_filepath=None, neg
         except Exception as e:
             print("Map creation FAILED...ERROR:")
             print(e)
-    if log_filepath is not None:
-        output_file_obj.close()
+            # Fail the map building job
+            raise
+        finally:
+            if log_filepath is not None:
+                output_file_obj.close()
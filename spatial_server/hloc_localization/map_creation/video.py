@@ -6,6 +6,7 @@ import sys
 import ffmpeg
 
 from . import map_creator
+from spatial_server.utils.job_queue import set_stage
 from spatial_server.utils.run_command import run_command
 from spatial_server.utils.print_log import print_log
 from third_party.hloc.hloc import logger as hloc_logger, handler as hloc_default_handler
@@ -45,6 +46,7 @@ def create_map_from_video(video_path, num_frames_perc=25, log_filepath=None):
         str(num_frames_to_extract),
     ]
     print_log("Running ns-process-data (takes 10-15 mins)...", log_filepath)
+    set_stage("ns_process_data")
     run_command(
         ns_process_data_command,
         log_filepath=log_filepath,
@@ -72,5 +74,8 @@ def create_map_from_video(video_path, num_frames_perc=25, log_filepath=None):
         except Exception as e:
             print("Map creation from colmap FAILED...ERROR:")
             print(e)
-    if log_filepath is not None:
-        output_file_obj.close()
+            # Fail the map building job
+            raise
+        finally:
+            if log_filepath is not None:
+                output_file_obj.close()
@@ -0,0 +1,74 @@
+"""
+Lightweight watcher of the map directories. Polls the files that the map data is
+read from (see load_cache.get_map_data_paths) and reloads only the maps whose files
+were added or modified, e.g. by a map build or by copying a map in with other tools.
+"""
+
+import os
+import threading
+
+from . import load_cache
+
+
+def _get_map_signature(dataset_name):
+    signature = []
+    for path in load_cache.get_map_data_paths(dataset_name).values():
+        try:
+            stat = os.stat(path)
+            signature.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            signature.append(None)
+    return tuple(signature)
+
+
+def _get_map_signatures():
+    return {
+        dataset_name: _get_map_signature(dataset_name)
+        for dataset_name in load_cache.list_map_names()
+    }
+
+
+class MapWatcher(threading.Thread):
+    def __init__(self, shared_data, interval):
+        super().__init__(daemon=True)
+        self.shared_data = shared_data
+        self.interval = interval
+        self.stop_event = threading.Event()
+
+    def run(self):
+        # Signatures of the map files that the loaded data corresponds to
+        applied_signatures = _get_map_signatures()
+        previous_signatures = applied_signatures
+
+        while not self.stop_event.wait(self.interval):
+            signatures = _get_map_signatures()
+            for dataset_name, signature in signatures.items():
+                if signature == applied_signatures.get(dataset_name):
+                    continue
+                # Wait until the files stop changing so that a map that is being
+                # written is not read half way through
+                if signature != previous_signatures.get(dataset_name):
+                    continue
+                print(f"Map files changed for {dataset_name}")
+                load_cache.reload_map_data(self.shared_data, dataset_name)
+                applied_signatures[dataset_name] = signature
+
+            # Drop the maps whose directories were removed
+            for dataset_name in set(applied_signatures) - set(signatures):
+                self.shared_data["map_cache"].invalidate(dataset_name)
+                del applied_signatures[dataset_name]
+
+            previous_signatures = signatures
+
+    def stop(self):
+        self.stop_event.set()
+
+
+def start_map_watcher(shared_data, interval):
+    """
+    Start watching the map directories in a background thread.
+    interval is the polling interval in seconds.
+    """
+    watcher = MapWatcher(shared_data, interval)
+    watcher.start()
+    return watcher
@@ -0,0 +1,233 @@
+"""
+Localization metrics in the Prometheus text exposition format.
+
+Stage timings are recorded per map in histograms. The /metrics route renders them
+together with the state of the map cache, the result cache, the inference scheduler,
+the admission control and the query image store.
+
+The metrics are kept in memory by each process. In the production mode every gunicorn
+worker has its own counters and a scrape of /metrics reports those of the worker that
+served it, identified by spatial_server_worker_pid. Sum the series over the scrapes of
+all workers to get the totals of the server. The query image sizes are read from disk
+and are the same in every worker.
+"""
+
+from collections import defaultdict
+import os
+import threading
+
+# Upper bounds in seconds of the histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(label_names, label_values, extra=()):
+    labels = [
+        f'{name}="{_escape(value)}"'
+        for name, value in list(zip(label_names, label_values)) + list(extra)
+    ]
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Histogram:
+    def __init__(self, name, help, label_names, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # Label values to [count per bucket..., count in +Inf, sum]
+        self.values = defaultdict(lambda: [0] * (len(buckets) + 1) + [0.0])
+
+    def observe(self, label_values, value):
+        with self.lock:
+            values = self.values[tuple(label_values)]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[i] += 1
+            values[-2] += 1
+            values[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            items = sorted((k, list(v)) for k, v in self.values.items())
+        for label_values, values in items:
+            for bound, count in zip(self.buckets, values):
+                labels = _format_labels(self.label_names, label_values, [("le", bound)])
+                lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _format_labels(self.label_names, label_values, [("le", "+Inf")])
+            lines.append(f"{self.name}_bucket{labels} {values[-2]}")
+            labels = _format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}_count{labels} {values[-2]}")
+            lines.append(f"{self.name}_sum{labels} {values[-1]}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, label_names):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.lock = threading.Lock()
+        self.values = defaultdict(int)
+
+    def inc(self, label_values, value=1):
+        with self.lock:
+            self.values[tuple(label_values)] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            items = sorted(self.values.items())
+        for label_values, value in items:
+            labels = _format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}{labels} {value}")
+        return lines
+
+
+def _gauge(name, help, values):
+    """
+    values: list of (labels, value) where labels is a list of (name, value)
+    """
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+    for labels, value in values:
+        lines.append(f"{name}{_format_labels((), (), labels)} {value}")
+    return lines
+
+
+STAGE_SECONDS = Histogram(
+    "spatial_server_localization_stage_seconds",
+    "Time spent in each stage of the localization",
+    ("map", "stage"),
+)
+LOCALIZATION_SECONDS = Histogram(
+    "spatial_server_localization_seconds",
+    "Total time of the localization of a query image",
+    ("map",),
+)
+LOCALIZATIONS = Counter(
+    "spatial_server_localizations_total",
+    "Number of localized query images",
+    ("map", "success"),
+)
+
+REJECTIONS = Counter(
+    "spatial_server_localization_rejections_total",
+    "Number of query images rejected before matching",
+    ("map", "reason"),
+)
+
+
+def record_localization(dataset_name, timings, success):
+    """
+    Record the stage timings (in seconds) of one localized query image
+    """
+    for stage, seconds in timings.items():
+        STAGE_SECONDS.observe((dataset_name, stage), seconds)
+    LOCALIZATION_SECONDS.observe((dataset_name,), sum(timings.values()))
+    LOCALIZATIONS.inc((dataset_name, str(bool(success)).lower()))
+
+
+def render_metrics(shared_data):
+    lines = (
+        _gauge(
+            "spatial_server_worker_pid",
+            "Process id of the worker whose metrics are reported",
+            [([], os.getpid())],
+        )
+        + STAGE_SECONDS.render()
+        + LOCALIZATION_SECONDS.render()
+        + LOCALIZATIONS.render()
+        + REJECTIONS.render()
+    )
+
+    if "map_cache" in shared_data:
+        map_cache_info = shared_data["map_cache"].info()
+        lines += _gauge(
+            "spatial_server_map_cache_bytes",
+            "Size of the data of the maps loaded for localization",
+            [([("map", name)], nbytes) for name, nbytes in map_cache_info["maps"].items()],
+        )
+        lines += _gauge(
+            "spatial_server_map_cache_max_bytes",
+            "Memory budget of the map cache",
+            [([], map_cache_info["max_bytes"])],
+        )
+        for name in ("hits", "loads", "load_errors", "reloads", "evictions"):
+            lines += [
+                f"# TYPE spatial_server_map_cache_{name}_total counter",
+                f"spatial_server_map_cache_{name}_total {map_cache_info[name]}",
+            ]
+
+    scheduler = shared_data.get("inference_scheduler")
+    if scheduler is not None:
+        scheduler_info = scheduler.info()
+        lines += _gauge(
+            "spatial_server_scheduler_queue_depth",
+            "Localization requests waiting for a micro-batch",
+            [([], scheduler_info["queue_depth"])],
+        )
+        lines += [
+            "# TYPE spatial_server_scheduler_batches_total counter",
+            f"spatial_server_scheduler_batches_total {scheduler_info['num_batches']}",
+            "# TYPE spatial_server_scheduler_requests_total counter",
+            f"spatial_server_scheduler_requests_total {scheduler_info['num_requests']}",
+        ]
+
+    result_cache = shared_data.get("result_cache")
+    if result_cache is not None:
+        result_cache_info = result_cache.info()
+        for name in ("hits", "misses"):
+            lines += [
+                f"# TYPE spatial_server_result_cache_{name}_total counter",
+                f"spatial_server_result_cache_{name}_total {result_cache_info[name]}",
+            ]
+        lines += _gauge(
+            "spatial_server_result_cache_hit_rate",
+            "Fraction of the result cache lookups that were hits",
+            [([], result_cache_info["hit_rate"])],
+        )
+        lines += _gauge(
+            "spatial_server_result_cache_entries",
+            "Number of cached localization results",
+            [([], result_cache_info["entries"])],
+        )
+
+    admission_controller = shared_data.get("admission_controller")
+    if admission_controller is not None:
+        admission_info = admission_controller.info()
+        lines += _gauge(
+            "spatial_server_localization_in_flight",
+            "Localization requests being processed",
+            [([], admission_info["in_flight"])],
+        )
+        lines += _gauge(
+            "spatial_server_localization_queued",
+            "Localization requests waiting for admission",
+            [([], admission_info["queued"])],
+        )
+        for name in ("admitted", "rejected", "timed_out"):
+            lines += [
+                f"# TYPE spatial_server_localization_{name}_total counter",
+                f"spatial_server_localization_{name}_total {admission_info[name]}",
+            ]
+
+    query_image_store = shared_data.get("query_image_store")
+    if query_image_store is not None:
+        store_info = query_image_store.info()
+        lines += _gauge(
+            "spatial_server_query_images_bytes",
+            "Size of the saved query images",
+            [([("map", name)], info["nbytes"]) for name, info in store_info["maps"].items()],
+        )
+        for name in ("written", "dropped", "sampled_out", "write_errors"):
+            lines += [
+                f"# TYPE spatial_server_query_images_{name}_total counter",
+                f"spatial_server_query_images_{name}_total {store_info[name]}",
+            ]
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,742 @@
+"""
+Stage-wise localization pipeline. Runs SuperPoint, NetVLAD and SuperGlue on batches
+of query images so that a burst of frames shares one forward pass per model instead
+of calling the hloc localization once per image.
+"""
+
+from collections import defaultdict
+import time
+
+import cv2
+import numpy as np
+import pycolmap
+import torch
+
+from third_party.hloc.hloc import extract_features
+
+from . import config
+from .reconstruction_data import get_images_near, get_points3D_xyz
+
+# PnP configuration used by the hloc localization
+PNP_CONF = {
+    "estimation": {"ransac": {"max_error": 12}},
+    "refinement": {"refine_focal_length": True, "refine_extra_params": True},
+}
+
+
+def read_image(img_path):
+    """
+    Read an image from disk as an RGB uint8 array
+    """
+    image = cv2.imread(str(img_path), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError(f"Cannot read image {img_path}")
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+def decode_image(image_buffer):
+    """
+    Decode an encoded (JPEG/PNG/WebP) image buffer as an RGB uint8 array.
+    The buffer is wrapped without copying.
+    """
+    image = cv2.imdecode(np.frombuffer(image_buffer, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Cannot decode image buffer")
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+def preprocess_image(image, preprocessing_conf):
+    """
+    Resize and normalize an RGB uint8 image the same way hloc's ImageDataset does.
+    Returns the (C, H, W) float32 array and the original (width, height) of the image.
+    """
+    conf = {**extract_features.ImageDataset.default_conf, **preprocessing_conf}
+    if conf["grayscale"]:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    image = image.astype(np.float32)
+    size = image.shape[:2][::-1]
+    if conf["resize_max"] and (
+        conf["resize_force"] or max(size) > conf["resize_max"]
+    ):
+        scale = conf["resize_max"] / max(size)
+        size_new = tuple(int(round(x * scale)) for x in size)
+        image = extract_features.resize_image(image, size_new, conf["interpolation"])
+
+    if conf["grayscale"]:
+        image = image[None]
+    else:
+        image = image.transpose((2, 0, 1))  # HxWxC to CxHxW
+    return image / 255.0, np.array(size)
+
+
+def _add_time(timings, idxs, stage, start):
+    """
+    Add the time since start to the stage timing (in seconds) of each query in idxs.
+    Stages run once for a whole batch, so every query of the batch gets the batch time.
+    """
+    elapsed = time.perf_counter() - start
+    # A query matched against several maps has one timings dict for all its entries
+    for query_timings in {id(timings[i]): timings[i] for i in idxs}.values():
+        query_timings[stage] = query_timings.get(stage, 0.0) + elapsed
+
+
+def _batches(items, key, batch_size):
+    """
+    Group the indices of items by key and split each group into chunks of batch_size.
+    Only items with the same key can be stacked into one tensor batch.
+    """
+    groups = defaultdict(list)
+    for idx, item in enumerate(items):
+        groups[key(item)].append(idx)
+    for idxs in groups.values():
+        for start in range(0, len(idxs), batch_size):
+            yield idxs[start : start + batch_size]
+
+
+@torch.no_grad()
+def extract_local_features(
+    images, model, local_feature_conf, device, batch_size=config.EXTRACTION_BATCH_SIZE
+):
+    """
+    Extract local features (SuperPoint) from a list of RGB images.
+    Images that have the same size after preprocessing are run as one batch.
+    """
+    prepared = [
+        preprocess_image(image, local_feature_conf["preprocessing"]) for image in images
+    ]
+    features = [None] * len(images)
+    for idxs in _batches(prepared, lambda p: p[0].shape, batch_size):
+        batch = torch.from_numpy(np.stack([prepared[i][0] for i in idxs]))
+        pred = model({"image": batch.to(device, non_blocking=True)})
+        for b, i in enumerate(idxs):
+            image, original_size = prepared[i]
+            size = np.array(image.shape[-2:][::-1])
+            scales = (original_size / size).astype(np.float32)
+            keypoints = pred["keypoints"][b].cpu().numpy()
+            features[i] = {
+                "keypoints": (keypoints + 0.5) * scales[None] - 0.5,
+                "scores": pred["scores"][b].cpu().numpy(),
+                "descriptors": pred["descriptors"][b].cpu().numpy(),
+                "image_size": original_size,
+            }
+    return features
+
+
+@torch.no_grad()
+def extract_global_descriptors(
+    images,
+    model,
+    global_descriptor_conf,
+    device,
+    batch_size=config.EXTRACTION_BATCH_SIZE,
+):
+    """
+    Extract global descriptors (NetVLAD) from a list of RGB images.
+    Returns a (N, D) tensor on the device.
+    """
+    prepared = [
+        preprocess_image(image, global_descriptor_conf["preprocessing"])[0]
+        for image in images
+    ]
+    descriptors = [None] * len(images)
+    for idxs in _batches(prepared, lambda p: p.shape, batch_size):
+        batch = torch.from_numpy(np.stack([prepared[i] for i in idxs]))
+        pred = model({"image": batch.to(device, non_blocking=True)})
+        for b, i in enumerate(idxs):
+            descriptors[i] = pred["global_descriptor"][b]
+    return torch.stack(descriptors, 0)
+
+
+def retrieve(query_descriptors, retrieval_index, db_image_names, num_matched):
+    """
+    Return the names and similarity scores of the num_matched most similar db images
+    for each query descriptor, by decreasing score
+    """
+    scores, db_idxs = retrieval_index.search(query_descriptors, num_matched)
+    return [
+        (list(db_image_names[row]), list(row_scores))
+        for row, row_scores in zip(db_idxs, scores)
+    ]
+
+
+def retrieve_near(query_descriptor, map_data, position, radius, num_matched):
+    """
+    Return the names and similarity scores of the num_matched most similar db images
+    among the db images whose camera centers are within radius of the position,
+    or None if there are none
+    """
+    db_idxs = [
+        map_data["db_image_idxs"][name]
+        for name in get_images_near(map_data["reconstruction"], position, radius)
+        if name in map_data["db_image_idxs"]
+    ]
+    if len(db_idxs) == 0:
+        return None
+
+    db_global_descriptors = map_data["db_global_descriptors"]
+    db_idxs = torch.tensor(db_idxs, device=db_global_descriptors.device)
+    similarity = db_global_descriptors[db_idxs] @ query_descriptor.to(
+        db_global_descriptors.device
+    )
+    top = torch.topk(similarity, min(num_matched, len(db_idxs)))
+    return (
+        list(map_data["db_image_names"][db_idxs[top.indices].cpu().numpy()]),
+        list(top.values.cpu().numpy()),
+    )
+
+
+def cut_retrieved(
+    names,
+    scores,
+    margin=config.ADAPTIVE_RETRIEVAL_MARGIN,
+    min_retrieved=config.ADAPTIVE_MIN_RETRIEVED,
+):
+    """
+    Keep the retrieved db images whose score is within margin of the best score,
+    and at least min_retrieved of them. Names and scores are by decreasing score.
+    """
+    num_kept = sum(score >= scores[0] - margin for score in scores) if scores else 0
+    num_kept = max(num_kept, min_retrieved)
+    return names[:num_kept], scores[:num_kept]
+
+
+def _pair_key(pair):
+    """
+    Batch key of a (features0, features1) pair: the image sizes and keypoint counts.
+    SuperGlue normalizes keypoints with a single image size per batch, and pairs with
+    the same keypoint counts stack without padding. Padded keypoints would take part in
+    the attention and the optimal transport and change the matches of the real keypoints.
+    """
+    features0, features1 = pair
+    return (
+        tuple(features0["image_size"]),
+        tuple(features1["image_size"]),
+        len(features0["keypoints"]),
+        len(features1["keypoints"]),
+    )
+
+
+@torch.no_grad()
+def match_pairs(matcher_model, pairs, device, batch_size=config.MATCHER_BATCH_SIZE):
+    """
+    Match a list of (features0, features1) pairs with SuperGlue in batches.
+    Only pairs with the same image sizes and keypoint counts share a batch, so the
+    matches of each pair are the same as matching it on its own.
+    Returns a list of (matches0, matching_scores0) arrays, one per pair.
+    """
+    results = [None] * len(pairs)
+    for idxs in _batches(pairs, _pair_key, batch_size):
+        data = {}
+        for side in (0, 1):
+            feats = [pairs[i][side] for i in idxs]
+            for name in ("keypoints", "scores", "descriptors"):
+                stacked = np.stack([f[name] for f in feats])
+                data[f"{name}{side}"] = (
+                    torch.from_numpy(stacked).float().to(device, non_blocking=True)
+                )
+            # SuperGlue only uses the shape of the image
+            width, height = (int(x) for x in feats[0]["image_size"])
+            data[f"image{side}"] = torch.empty((1, 1, height, width)).expand(
+                len(idxs), -1, -1, -1
+            )
+
+        pred = matcher_model(data)
+        for b, i in enumerate(idxs):
+            matches = pred["matches0"][b].cpu().numpy().astype(np.int64)
+            scores = pred["matching_scores0"][b].cpu().numpy()
+            results[i] = (matches, scores)
+    return results
+
+
+def infer_query_camera(image_size):
+    """
+    Camera prior for a query image without EXIF data.
+    Same as pycolmap.infer_camera_from_image: SIMPLE_RADIAL with a focal length of 1.2 * max(width, height).
+    """
+    width, height = (int(x) for x in image_size)
+    focal_length = 1.2 * max(width, height)
+    return pycolmap.Camera(
+        model="SIMPLE_RADIAL",
+        width=width,
+        height=height,
+        params=[focal_length, width / 2, height / 2, 0.0],
+    )
+
+
+def calibrate_rejection_thresholds(
+    db_global_descriptors,
+    retrieval_index,
+    db_local_features,
+    num_images=config.EARLY_REJECTION_CALIBRATION_IMAGES,
+):
+    """
+    Thresholds of the early rejection of a map, from its own db images: the minimum number
+    of query keypoints and the minimum best retrieval score
+    """
+    num_keypoints = np.diff(db_local_features.offsets)
+    min_keypoints = config.EARLY_REJECTION_KEYPOINT_RATIO * np.percentile(
+        num_keypoints, 5
+    )
+
+    # Best score of a sample of db images against the other db images
+    min_score = 0.0
+    if len(db_global_descriptors) > 1:
+        rng = np.random.default_rng(0)
+        idxs = rng.choice(
+            len(db_global_descriptors),
+            min(num_images, len(db_global_descriptors)),
+            replace=False,
+        )
+        scores, db_idxs = retrieval_index.search(
+            db_global_descriptors[torch.from_numpy(idxs).to(db_global_descriptors.device)],
+            2,
+        )
+        best_scores = [
+            next((s for s, j in zip(row_scores, row) if j != i), 0.0)
+            for i, row_scores, row in zip(idxs, scores, db_idxs)
+        ]
+        min_score = config.EARLY_REJECTION_SCORE_RATIO * np.percentile(best_scores, 5)
+
+    return {"min_keypoints": float(min_keypoints), "min_retrieval_score": float(min_score)}
+
+
+def get_rejection_thresholds(map_data):
+    """
+    Early rejection thresholds of a map, calibrated on their first use. The calibration
+    searches the retrieval index, so it must not run when a map is preloaded before the
+    gunicorn workers fork. Concurrent first uses compute the same thresholds.
+    """
+    thresholds = map_data.get("rejection_thresholds")
+    if thresholds is None:
+        thresholds = calibrate_rejection_thresholds(
+            map_data["db_global_descriptors"],
+            map_data["retrieval_index"],
+            map_data["db_local_features"],
+        )
+        map_data["rejection_thresholds"] = thresholds
+    return thresholds
+
+
+def _get_rejection_reason(query_features, retrieved, map_data, check_score=True):
+    """
+    Reason to reject a query before matching, or None.
+    retrieved has the (names, scores) of its retrieved db images.
+    """
+    thresholds = get_rejection_thresholds(map_data)
+    if len(query_features["keypoints"]) < thresholds["min_keypoints"]:
+        return "too_few_keypoints"
+    _, scores = retrieved
+    if check_score and (
+        len(scores) == 0 or scores[0] < thresholds["min_retrieval_score"]
+    ):
+        return "not_in_map"
+    return None
+
+
+def _rejected_result(query_features, reason):
+    ret = {"success": False, "num_inliers": 0, "rejected": reason}
+    log = {
+        "db": [],
+        "PnP_ret": ret,
+        "keypoints_query": np.zeros((0, 2)),
+        "points3D_ids": np.zeros((0,), dtype=np.int64),
+        "num_matches": 0,
+        "rejected": reason,
+    }
+    return ret, log
+
+
+def _gather_correspondences(reconstruction_data, db_names, matches_list):
+    """
+    Unique (query keypoint index, 3D point id) correspondences from the matches against
+    each db image. Also returns the ids of the db images and the number of matches.
+    """
+    db_ids = []
+    correspondences = []
+    num_matches = 0
+    for db_name, (matches, _) in zip(db_names, matches_list):
+        image_id = reconstruction_data["image_ids"].get(db_name)
+        if image_id is None:
+            continue
+        db_ids.append(image_id)
+        points3D_ids = reconstruction_data["image_point3D_ids"][image_id]
+        if len(points3D_ids) == 0:
+            continue
+        query_idxs = np.where(matches > -1)[0]
+        query_idxs = query_idxs[points3D_ids[matches[query_idxs]] != -1]
+        num_matches += len(query_idxs)
+        correspondences.append(
+            np.stack([query_idxs, points3D_ids[matches[query_idxs]]], axis=1)
+        )
+
+    # Each (query keypoint, 3D point) correspondence is used once
+    if correspondences:
+        correspondences = np.unique(np.concatenate(correspondences), axis=0)
+    else:
+        correspondences = np.zeros((0, 2), dtype=np.int64)
+    return db_ids, correspondences, num_matches
+
+
+def estimate_pose(
+    reconstruction_data, query_features, query_camera, db_names, matches_list
+):
+    """
+    Gather the 2D-3D correspondences from the matches against each retrieved db image and
+    estimate the query pose with PnP. Follows hloc's localize_sfm.pose_from_cluster but
+    works on the in-memory matches and the parsed reconstruction arrays.
+    """
+    kpq = query_features["keypoints"] + 0.5  # COLMAP coordinates
+    db_ids, correspondences, num_matches = _gather_correspondences(
+        reconstruction_data, db_names, matches_list
+    )
+    mkp_idxs = correspondences[:, 0]
+    mp3d_ids = correspondences[:, 1]
+
+    ret = None
+    if len(mkp_idxs) >= 4:
+        ret = pycolmap.absolute_pose_estimation(
+            kpq[mkp_idxs],
+            get_points3D_xyz(reconstruction_data, mp3d_ids),
+            query_camera,
+            estimation_options=PNP_CONF["estimation"],
+            refinement_options=PNP_CONF["refinement"],
+        )
+    if not ret or not ret.get("success", False):
+        ret = {"success": False, "num_inliers": 0}
+
+    log = {
+        "db": db_ids,
+        "PnP_ret": ret,
+        "keypoints_query": kpq[mkp_idxs],
+        "points3D_ids": mp3d_ids,
+        "num_matches": num_matches,
+    }
+    return ret, log
+
+
+def _extract_queries(images, shared_data, device, timings):
+    """
+    Local features and global descriptors of the query images
+    """
+    local_feature_conf = extract_features.confs[config.LOCAL_FEATURE_EXTRACTOR]
+    global_descriptor_conf = extract_features.confs[config.GLOBAL_DESCRIPTOR_EXTRACTOR]
+    idxs = range(len(images))
+
+    start = time.perf_counter()
+    query_features = extract_local_features(
+        images,
+        shared_data["local_features_extractor_model"],
+        local_feature_conf,
+        device,
+    )
+    _add_time(timings, idxs, "superpoint", start)
+
+    start = time.perf_counter()
+    query_descriptors = extract_global_descriptors(
+        images,
+        shared_data["global_descriptor_model"],
+        global_descriptor_conf,
+        device,
+    )
+    _add_time(timings, idxs, "netvlad", start)
+    return query_features, query_descriptors
+
+
+def _match_in_score_order(
+    query_features,
+    retrieved_names,
+    map_datas,
+    matcher_model,
+    device,
+    chunk_size=config.ADAPTIVE_MATCH_CHUNK_SIZE,
+    min_correspondences=config.ADAPTIVE_MIN_CORRESPONDENCES,
+):
+    """
+    Match the queries against their retrieved db images in rounds of chunk_size db images,
+    in retrieval score order. A query stops being matched once its 2D-3D correspondences
+    reach min_correspondences. The pairs of all queries still matching share each round's
+    batched matcher run.
+    Returns the list of matches of each query, for the first db images of its retrieved names.
+    """
+    matches_lists = [[] for _ in retrieved_names]
+    active = list(range(len(retrieved_names)))
+    offset = 0
+    while active:
+        pairs, pair_queries = [], []
+        for i in active:
+            for name in retrieved_names[i][offset : offset + chunk_size]:
+                db_features = map_datas[i]["db_local_features"].get(name)
+                pairs.append((query_features[i], db_features))
+                pair_queries.append(i)
+        for i, matches in zip(pair_queries, match_pairs(matcher_model, pairs, device)):
+            matches_lists[i].append(matches)
+        offset += chunk_size
+
+        active = [
+            i
+            for i in active
+            if offset < len(retrieved_names[i])
+            and len(
+                _gather_correspondences(
+                    map_datas[i]["reconstruction"],
+                    retrieved_names[i],
+                    matches_lists[i],
+                )[1]
+            )
+            < min_correspondences
+        ]
+    return matches_lists
+
+
+def _match_and_estimate_poses(
+    query_features, retrieved_names, map_datas, shared_data, device, timings
+):
+    """
+    Match every query against its retrieved db images and estimate the pose of each query.
+    All pairs run in one batched matcher run, or in rounds in score order with early exit
+    in the adaptive mode.
+    """
+    start = time.perf_counter()
+    if config.ADAPTIVE_LOCALIZATION:
+        matches_lists = _match_in_score_order(
+            query_features,
+            retrieved_names,
+            map_datas,
+            shared_data["matcher_model"],
+            device,
+        )
+    else:
+        pairs = [
+            (query_features[i], map_datas[i]["db_local_features"].get(name))
+            for i, names in enumerate(retrieved_names)
+            for name in names
+        ]
+        matches = match_pairs(shared_data["matcher_model"], pairs, device)
+        matches_lists = []
+        offset = 0
+        for names in retrieved_names:
+            matches_lists.append(matches[offset : offset + len(names)])
+            offset += len(names)
+    _add_time(timings, range(len(retrieved_names)), "superglue", start)
+
+    results = []
+    for i, (names, matches_list) in enumerate(zip(retrieved_names, matches_lists)):
+        start = time.perf_counter()
+        results.append(
+            estimate_pose(
+                map_datas[i]["reconstruction"],
+                query_features[i],
+                infer_query_camera(query_features[i]["image_size"]),
+                names[: len(matches_list)],
+                matches_list,
+            )
+        )
+        _add_time(timings, [i], "pnp", start)
+    return results
+
+
+def _select_db_images(retrieved):
+    """
+    Names of the db images to match from the (names, scores) of the retrieval.
+    The adaptive mode cuts them by their score distribution.
+    """
+    names, scores = retrieved
+    if config.ADAPTIVE_LOCALIZATION:
+        names, scores = cut_retrieved(names, scores)
+    return names
+
+
+def _retrieve_global(query_descriptors, query_idxs, map_datas, num_matched):
+    """
+    Global retrieval for the given queries, run once per map.
+    Returns the (names, scores) of the retrieved db images of each query.
+    """
+    retrieved = {}
+    map_groups = defaultdict(list)
+    for i in query_idxs:
+        map_groups[id(map_datas[i])].append(i)
+    for idxs in map_groups.values():
+        map_data = map_datas[idxs[0]]
+        map_retrieved = retrieve(
+            query_descriptors[idxs],
+            map_data["retrieval_index"],
+            map_data["db_image_names"],
+            num_matched,
+        )
+        retrieved.update(zip(idxs, map_retrieved))
+    return [retrieved[i] for i in query_idxs]
+
+
+def localize_queries(
+    images,
+    map_datas,
+    shared_data,
+    priors=None,
+    num_matched=config.NUM_RETRIEVED_IMAGES,
+):
+    """
+    Localize a list of RGB images, each against its own map.
+    map_datas has the map data from load_cache.get_map_data for each image. The feature
+    extraction and matching of all images run in shared batches, whatever their map.
+    priors is an optional list with a (position, radius) pose prior in the hloc frame, or None,
+    for each image. Images with a prior only retrieve db images near the prior position and
+    fall back to global retrieval if the pose has fewer than POSE_PRIOR_MIN_INLIERS inliers.
+    Images that do not look at the map are rejected before matching, with the reason in
+    ret["rejected"].
+    Returns a list of (ret, log) tuples in the same format as hloc's localization.
+    log["timings"] has the time in seconds of each stage of the query.
+    """
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    if priors is None:
+        priors = [None] * len(images)
+    timings = [{} for _ in images]
+
+    query_features, query_descriptors = _extract_queries(
+        images, shared_data, device, timings
+    )
+
+    # Retrieve the candidate db images: near the prior if there is one, else in the whole map
+    start = time.perf_counter()
+    retrieved = [
+        None
+        if prior is None
+        else retrieve_near(query_descriptors[i], map_datas[i], *prior, num_matched)
+        for i, prior in enumerate(priors)
+    ]
+    global_idxs = [i for i, r in enumerate(retrieved) if r is None]
+    global_retrieved = _retrieve_global(
+        query_descriptors, global_idxs, map_datas, num_matched
+    )
+    for i, query_retrieved in zip(global_idxs, global_retrieved):
+        retrieved[i] = query_retrieved
+    retrieved_names = [_select_db_images(r) for r in retrieved]
+    _add_time(timings, range(len(images)), "retrieval", start)
+
+    # Reject the queries that do not look at the map before matching them. Low scores
+    # near a pose prior are left to the fallback to global retrieval.
+    rejection_reasons = [None] * len(images)
+    if config.EARLY_REJECTION:
+        rejection_reasons = [
+            _get_rejection_reason(
+                query_features[i],
+                retrieved[i],
+                map_datas[i],
+                check_score=i in global_idxs,
+            )
+            for i in range(len(images))
+        ]
+    idxs = [i for i, reason in enumerate(rejection_reasons) if reason is None]
+
+    results = [
+        None if reason is None else _rejected_result(query_features[i], reason)
+        for i, reason in enumerate(rejection_reasons)
+    ]
+    matched_results = _match_and_estimate_poses(
+        [query_features[i] for i in idxs],
+        [retrieved_names[i] for i in idxs],
+        [map_datas[i] for i in idxs],
+        shared_data,
+        device,
+        [timings[i] for i in idxs],
+    )
+    for i, result in zip(idxs, matched_results):
+        results[i] = result
+
+    # Fall back to global retrieval for the queries that did not localize near their prior
+    fallback_idxs = [
+        i
+        for i, prior in enumerate(priors)
+        if prior is not None
+        and i not in global_idxs
+        and rejection_reasons[i] is None
+        and results[i][0]["num_inliers"] < config.POSE_PRIOR_MIN_INLIERS
+    ]
+    if fallback_idxs:
+        start = time.perf_counter()
+        fallback_names = [
+            _select_db_images(query_retrieved)
+            for query_retrieved in _retrieve_global(
+                query_descriptors, fallback_idxs, map_datas, num_matched
+            )
+        ]
+        _add_time(timings, fallback_idxs, "retrieval", start)
+        fallback_results = _match_and_estimate_poses(
+            [query_features[i] for i in fallback_idxs],
+            fallback_names,
+            [map_datas[i] for i in fallback_idxs],
+            shared_data,
+            device,
+            [timings[i] for i in fallback_idxs],
+        )
+        for i, result in zip(fallback_idxs, fallback_results):
+            results[i] = result
+
+    for (_, log), query_timings in zip(results, timings):
+        log["timings"] = query_timings
+    return results
+
+
+def localize_images(images, shared_data, map_data, priors=None):
+    """
+    Localize a list of RGB images against one map
+    """
+    return localize_queries(
+        images, [map_data] * len(images), shared_data, priors=priors
+    )
+
+
+def localize_across_maps(
+    images,
+    stacked_index,
+    shared_data,
+    num_maps=config.CROSS_MAP_NUM_CANDIDATE_MAPS,
+    num_matched=config.NUM_RETRIEVED_IMAGES,
+):
+    """
+    Localize a list of RGB images without knowing their map.
+    The maps are ranked with one search in the stacked index of all maps, and matching
+    and PnP only run on the num_maps top-ranked maps of each image.
+    Returns a list of (map_name, ret, log) tuples with the map that gave the most PnP
+    inliers. map_name is None if no map was retrieved.
+    """
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    timings = [{} for _ in images]
+    query_features, query_descriptors = _extract_queries(
+        images, shared_data, device, timings
+    )
+    start = time.perf_counter()
+    ranked_maps = stacked_index.rank_maps(query_descriptors, num_maps)
+
+    # One (image, candidate map) query per candidate map of each image
+    candidates = [
+        (i, map_idx) for i, map_idxs in enumerate(ranked_maps) for map_idx in map_idxs
+    ]
+    candidate_map_datas = [stacked_index.map_datas[m] for _, m in candidates]
+    retrieved_names = [
+        _select_db_images(query_retrieved)
+        for query_retrieved in _retrieve_global(
+            query_descriptors[[i for i, _ in candidates]],
+            list(range(len(candidates))),
+            candidate_map_datas,
+            num_matched,
+        )
+    ]
+    _add_time(timings, range(len(images)), "retrieval", start)
+    candidate_results = _match_and_estimate_poses(
+        [query_features[i] for i, _ in candidates],
+        retrieved_names,
+        candidate_map_datas,
+        shared_data,
+        device,
+        [timings[i] for i, _ in candidates],
+    )
+
+    results = [
+        (None, {"success": False, "num_inliers": 0}, {"timings": query_timings})
+        for query_timings in timings
+    ]
+    for (i, map_idx), (ret, log) in zip(candidates, candidate_results):
+        if results[i][0] is None or ret["num_inliers"] > results[i][1]["num_inliers"]:
+            log["timings"] = timings[i]
+            results[i] = (stacked_index.map_names[map_idx], ret, log)
+    return results
@@ -0,0 +1,118 @@
+"""
+Parsed SfM reconstruction data needed for the 2D-3D lookup during localization.
+The reconstruction is parsed once per map and kept with the map data; it is parsed
+again when the model files change (rebuild, scale_map or rotate_map).
+"""
+
+import os
+from pathlib import Path
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from .scale_adjustment import read_write_model
+
+MODEL_FILES = ("cameras", "images", "points3D")
+
+
+def get_reconstruction_path(dataset_name):
+    dataset = Path(os.path.join("data", "map_data", dataset_name, "hloc_data"))
+    # Use the scaled reconstruction if it exists
+    db_reconstruction = dataset / "scaled_sfm_reconstruction"
+    if not db_reconstruction.exists():
+        db_reconstruction = dataset / "sfm_reconstruction"
+    return db_reconstruction
+
+
+def get_model_file_paths(model_path):
+    model_path = Path(model_path)
+    ext = ".txt" if (model_path / "images.txt").exists() else ".bin"
+    return [model_path / (name + ext) for name in MODEL_FILES]
+
+
+def get_reconstruction_version(model_path):
+    """
+    Version of the model files: their paths, modification times and sizes
+    """
+    version = []
+    for path in get_model_file_paths(model_path):
+        try:
+            stat = os.stat(path)
+            version.append((str(path), stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            version.append((str(path), None, None))
+    return tuple(version)
+
+
+def load_reconstruction_data(model_path):
+    """
+    Parse the COLMAP model into arrays:
+        image_ids: db image name -> image id
+        image_point3D_ids: image id -> point3D id of each 2D point (-1 if none)
+        point3D_ids: sorted point3D ids
+        points3D_xyz: (N, 3) coordinates in the order of point3D_ids
+        camera_names, camera_centers: db image names and their camera centers
+        camera_tree: spatial index (KD-tree) over the camera centers
+    """
+    version = get_reconstruction_version(model_path)
+    _, images, points3D = read_write_model.read_model(model_path)
+
+    point3D_ids = np.array(sorted(points3D), dtype=np.int64)
+    points3D_xyz = np.array(
+        [points3D[point3D_id].xyz for point3D_id in point3D_ids], dtype=np.float64
+    ).reshape(-1, 3)
+
+    # Camera center of each db image: -R^T t
+    camera_names = np.array([image.name for image in images.values()])
+    camera_centers = np.array(
+        [-image.qvec2rotmat().T @ image.tvec for image in images.values()],
+        dtype=np.float64,
+    ).reshape(-1, 3)
+
+    reconstruction_data = {
+        "model_path": str(model_path),
+        "version": version,
+        "image_ids": {image.name: image_id for image_id, image in images.items()},
+        "image_point3D_ids": {
+            image_id: np.asarray(image.point3D_ids, dtype=np.int64)
+            for image_id, image in images.items()
+        },
+        "point3D_ids": point3D_ids,
+        "points3D_xyz": points3D_xyz,
+        "camera_names": camera_names,
+        "camera_centers": camera_centers,
+        "camera_tree": cKDTree(camera_centers),
+    }
+    reconstruction_data["nbytes"] = (
+        point3D_ids.nbytes
+        + points3D_xyz.nbytes
+        + camera_names.nbytes
+        # The KD-tree keeps a copy of the centers plus its index
+        + 2 * camera_centers.nbytes
+        + sum(ids.nbytes for ids in reconstruction_data["image_point3D_ids"].values())
+    )
+    return reconstruction_data
+
+
+def get_points3D_xyz(reconstruction_data, point3D_ids):
+    """
+    Coordinates of the given point3D ids
+    """
+    rows = np.searchsorted(reconstruction_data["point3D_ids"], point3D_ids)
+    return reconstruction_data["points3D_xyz"][rows]
+
+
+def get_images_near(reconstruction_data, position, radius):
+    """
+    Names of the db images whose camera centers are within radius of the position
+    """
+    idxs = reconstruction_data["camera_tree"].query_ball_point(position, radius)
+    return reconstruction_data["camera_names"][np.asarray(idxs, dtype=np.int64)]
+
+
+def is_stale(reconstruction_data, dataset_name):
+    """
+    The model files were rewritten, or a scaled model was created, since they were parsed
+    """
+    model_path = get_reconstruction_path(dataset_name)
+    return get_reconstruction_version(model_path) != reconstruction_data["version"]
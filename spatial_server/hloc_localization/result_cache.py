@@ -0,0 +1,85 @@
+"""
+Cache of localization results for repeated or near-identical query frames.
+
+Frames are keyed by a 64-bit difference hash (dHash) of the decoded image, the map
+name and the version of the loaded map data. A frame whose hash is within
+max_distance bits of a cached frame of the same map gets the cached result; with the
+default of 0 only frames with the same hash do. Entries
+expire after ttl seconds and the least recently added entries are dropped beyond
+max_entries.
+"""
+
+from collections import OrderedDict
+import threading
+import time
+
+import cv2
+import numpy as np
+
+
+def image_hash(image):
+    """
+    64-bit difference hash of an RGB image: the signs of the horizontal gradients of
+    a 9x8 grayscale thumbnail. Robust to sensor noise and compression, not to motion.
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    thumbnail = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+    bits = (thumbnail[:, 1:] > thumbnail[:, :-1]).flatten()
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+class ResultCache:
+    def __init__(self, ttl, max_entries, max_distance=0):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self.lock = threading.Lock()
+        # (map name, map version, hash) to (time added, result), oldest first
+        self.entries = OrderedDict()
+        self.counts = {"hits": 0, "misses": 0}
+
+    def _expire(self, now):
+        while self.entries:
+            key, (added, _) = next(iter(self.entries.items()))
+            if now - added <= self.ttl and len(self.entries) <= self.max_entries:
+                break
+            del self.entries[key]
+
+    def get(self, dataset_name, map_version, frame_hash):
+        now = time.monotonic()
+        with self.lock:
+            self._expire(now)
+            entry = self.entries.get((dataset_name, map_version, frame_hash))
+            if entry is None and self.max_distance > 0:
+                # Near-identical frames: scan the live entries of the map
+                for (name, version, cached_hash), cached_entry in self.entries.items():
+                    if (
+                        name == dataset_name
+                        and version == map_version
+                        and bin(cached_hash ^ frame_hash).count("1") <= self.max_distance
+                    ):
+                        entry = cached_entry
+                        break
+            if entry is None:
+                self.counts["misses"] += 1
+                return None
+            self.counts["hits"] += 1
+            return entry[1]
+
+    def put(self, dataset_name, map_version, frame_hash, result):
+        with self.lock:
+            key = (dataset_name, map_version, frame_hash)
+            self.entries.pop(key, None)
+            self.entries[key] = (time.monotonic(), result)
+            self._expire(time.monotonic())
+
+    def info(self):
+        with self.lock:
+            lookups = self.counts["hits"] + self.counts["misses"]
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hit_rate": self.counts["hits"] / lookups if lookups else 0.0,
+                **self.counts,
+            }
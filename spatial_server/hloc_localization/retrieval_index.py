@@ -0,0 +1,166 @@
+"""
+Indexes for the global descriptor (NetVLAD) retrieval.
+
+Small maps use an exact index that scores the query against every db descriptor.
+Large maps use an inverted file (IVF) index: the db descriptors are clustered with
+spherical k-means and a query is only scored against the descriptors in the lists of
+its num_probes closest centroids. num_probes trades recall for speed.
+"""
+
+import math
+import threading
+
+import numpy as np
+import torch
+
+from . import config
+
+
+class ExactIndex:
+    def __init__(self, descriptors):
+        self.descriptors = descriptors
+        self.nbytes = 0  # Only references the descriptors
+
+    def search(self, query_descriptors, k):
+        """
+        Returns the (Q, k) similarity scores and db indices of the k most similar db
+        descriptors for each query, sorted by decreasing similarity
+        """
+        similarity = query_descriptors.to(self.descriptors.device) @ self.descriptors.T
+        k = min(k, len(self.descriptors))
+        top = torch.topk(similarity, k, dim=1)
+        return top.values.cpu().numpy(), top.indices.cpu().numpy()
+
+
+def _assign(descriptors, centroids, chunk_size=8192):
+    """
+    Index of the most similar centroid for each descriptor, computed in chunks
+    to bound the memory of the similarity matrix
+    """
+    return torch.cat(
+        [
+            (descriptors[start : start + chunk_size] @ centroids.T).argmax(1)
+            for start in range(0, len(descriptors), chunk_size)
+        ]
+    )
+
+
+def _spherical_kmeans(descriptors, num_clusters, num_iterations, seed):
+    generator = torch.Generator().manual_seed(seed)
+    init = torch.randperm(len(descriptors), generator=generator)[:num_clusters]
+    centroids = descriptors[init.to(descriptors.device)].clone()
+    for _ in range(num_iterations):
+        assignments = _assign(descriptors, centroids)
+        sums = torch.zeros_like(centroids).index_add_(0, assignments, descriptors)
+        counts = torch.bincount(assignments, minlength=num_clusters)
+        # Keep the previous centroid for empty clusters
+        non_empty = counts > 0
+        centroids[non_empty] = torch.nn.functional.normalize(sums[non_empty], dim=1)
+    return centroids, _assign(descriptors, centroids)
+
+
+def _get_num_lists(num_descriptors, num_lists=None):
+    if num_lists is None:
+        num_lists = int(math.sqrt(num_descriptors) * config.RETRIEVAL_IVF_LISTS_FACTOR)
+    return max(1, min(num_lists, num_descriptors))
+
+
+class IVFIndex:
+    def __init__(
+        self,
+        descriptors,
+        num_lists=None,
+        num_probes=config.RETRIEVAL_IVF_NUM_PROBES,
+        num_iterations=config.RETRIEVAL_IVF_NUM_ITERATIONS,
+        seed=0,
+    ):
+        self.descriptors = descriptors
+        self.num_lists = _get_num_lists(len(descriptors), num_lists)
+        self.num_probes = num_probes
+        self.centroids, assignments = _spherical_kmeans(
+            descriptors, self.num_lists, num_iterations, seed
+        )
+
+        # db indices sorted by list, and the offsets of each list
+        assignments = assignments.cpu().numpy()
+        self.list_ids = np.argsort(assignments, kind="stable")
+        self.list_offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(assignments, minlength=self.num_lists))]
+        )
+        self.nbytes = (
+            self.centroids.element_size() * self.centroids.nelement()
+            + self.list_ids.nbytes
+            + self.list_offsets.nbytes
+        )
+
+    def search(self, query_descriptors, k, num_probes=None):
+        """
+        Returns the (Q, k) similarity scores and db indices of the approximately k most
+        similar db descriptors for each query, sorted by decreasing similarity
+        """
+        num_probes = self.num_probes if num_probes is None else num_probes
+        device = self.descriptors.device
+        query_descriptors = query_descriptors.to(device)
+        k = min(k, len(self.descriptors))
+
+        probes = torch.topk(
+            query_descriptors @ self.centroids.T, min(num_probes, self.num_lists), dim=1
+        ).indices.cpu().numpy()
+
+        all_scores, all_ids = [], []
+        for query, lists in zip(query_descriptors, probes):
+            candidates = np.concatenate(
+                [
+                    self.list_ids[self.list_offsets[l] : self.list_offsets[l + 1]]
+                    for l in lists
+                ]
+            )
+            # Fall back to exact search if the probed lists have too few descriptors
+            if len(candidates) < k:
+                candidates = np.arange(len(self.descriptors))
+            candidates = torch.from_numpy(candidates).to(device)
+            top = torch.topk(self.descriptors[candidates] @ query, k)
+            all_scores.append(top.values.cpu().numpy())
+            all_ids.append(candidates[top.indices].cpu().numpy())
+        return np.stack(all_scores), np.stack(all_ids)
+
+
+class LazyIVFIndex:
+    """
+    IVF index that runs its k-means on the first search instead of when the map is loaded.
+    Maps preloaded in the gunicorn master must not use torch's thread pools before the
+    workers fork, so the clustering runs in each worker.
+    """
+
+    def __init__(self, descriptors):
+        self.descriptors = descriptors
+        self.lock = threading.Lock()
+        self._index = None
+        # Size of the built index: centroids, sorted db indices and list offsets
+        num_lists = _get_num_lists(len(descriptors))
+        self.nbytes = (
+            num_lists * descriptors.shape[1] * descriptors.element_size()
+            + len(descriptors) * np.dtype(np.int64).itemsize
+            + (num_lists + 1) * np.dtype(np.int64).itemsize
+        )
+
+    def build(self):
+        with self.lock:
+            if self._index is None:
+                self._index = IVFIndex(self.descriptors)
+        return self._index
+
+    def search(self, query_descriptors, k, num_probes=None):
+        return self.build().search(query_descriptors, k, num_probes)
+
+
+def build_retrieval_index(descriptors):
+    """
+    Exact index for small maps, IVF index for maps with at least
+    RETRIEVAL_IVF_MIN_IMAGES db images. The IVF index is built on its first search.
+    """
+    if config.RETRIEVAL_IVF_MIN_IMAGES and (
+        len(descriptors) >= config.RETRIEVAL_IVF_MIN_IMAGES
+    ):
+        return LazyIVFIndex(descriptors)
+    return ExactIndex(descriptors)
@@ -55,42 +55,6 @@ def get_scale_two_images(img_path_1, img_path_2, dataset_name, shared_data, pose
     return scale
 
 
-def get_scale_from_query_dir(query_dir, dataset_name):
-    all_queries_dirs = glob.glob(query_dir + "/*")
-    img_paths = []
-    for dir in all_queries_dirs:
-        img_paths.append(dir + "/query_image.png")
-
-    # Load ML models
-    shared_data = {}
-    load_cache.load_ml_models(shared_data)
-    load_cache.load_db_data(shared_data)
-
-    # Get scale for each pair of images
-    scales = []
-    pose_cache = {}
-    for i in range(len(img_paths)):
-        for j in range(i + 1, len(img_paths)):
-            scales.append(
-                get_scale_two_images(
-                    img_paths[i], img_paths[j], dataset_name, shared_data, pose_cache
-                )
-            )
-
-    print("Scales: ", scales)
-
-    # Get the median scale
-    scale = np.median(scales)
-
-    # Save the scale to a file
-    dataset_path = Path(os.path.join("data", "map_data", dataset_name))
-    scale_file = dataset_path / "scale.pkl"
-    with open(scale_file, "wb") as f:
-        pickle.dump(scales, f)
-
-    return scale
-
-
 def get_scale_from_image_pose_data(mapname, shared_data=None):
     # Load the image pose data
     map_path = Path(os.path.join("data", "map_data", mapname))
@@ -0,0 +1,106 @@
+"""
+Global descriptor retrieval over several maps at once.
+
+The db descriptors of the maps are stacked into one retrieval index so that a query
+is compared against all maps in one search. The maps are then ranked by the summed
+similarity of their db images among the retrieved ones.
+"""
+
+from collections import OrderedDict
+import threading
+
+import numpy as np
+import torch
+
+from . import config
+from .retrieval_index import build_retrieval_index
+
+
+class StackedIndex:
+    def __init__(self, map_names, map_datas):
+        self.map_names = list(map_names)
+        self.map_datas = list(map_datas)
+        descriptors = torch.cat(
+            [map_data["db_global_descriptors"] for map_data in self.map_datas]
+        )
+        # Index of the map of each stacked db descriptor
+        self.map_idxs = np.repeat(
+            np.arange(len(self.map_datas)),
+            [len(map_data["db_image_names"]) for map_data in self.map_datas],
+        )
+        self.index = build_retrieval_index(descriptors)
+
+    def is_built_from(self, map_names, map_datas):
+        """
+        True if the index was built from these maps and their data was not reloaded since
+        """
+        return self.map_names == list(map_names) and all(
+            a is b for a, b in zip(self.map_datas, map_datas)
+        )
+
+    def rank_maps(
+        self,
+        query_descriptors,
+        num_maps=config.CROSS_MAP_NUM_CANDIDATE_MAPS,
+        num_retrieved=config.CROSS_MAP_NUM_RETRIEVED_IMAGES,
+    ):
+        """
+        Return for each query the indices of the num_maps maps with the highest summed
+        similarity among the num_retrieved most similar db images of all maps
+        """
+        scores, db_idxs = self.index.search(query_descriptors, num_retrieved)
+        ranked = []
+        for query_scores, query_db_idxs in zip(scores, db_idxs):
+            map_scores = np.bincount(
+                self.map_idxs[query_db_idxs],
+                weights=query_scores,
+                minlength=len(self.map_datas),
+            )
+            map_idxs = np.argsort(-map_scores)[:num_maps]
+            ranked.append([int(i) for i in map_idxs if map_scores[i] > 0])
+        return ranked
+
+
+class StackedIndexCache:
+    """
+    Stacked indexes of the most recently used sets of maps
+    """
+
+    def __init__(self, max_size=config.CROSS_MAP_INDEX_CACHE_SIZE):
+        self.max_size = max_size
+        self.indexes = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, map_names, map_datas):
+        key = tuple(sorted(map_names))
+        order = sorted(range(len(map_names)), key=lambda i: map_names[i])
+        map_names = [map_names[i] for i in order]
+        map_datas = [map_datas[i] for i in order]
+
+        with self.lock:
+            index = self.indexes.get(key)
+            if index is not None and index.is_built_from(map_names, map_datas):
+                self.indexes.move_to_end(key)
+                return index
+
+        # Built outside the lock; concurrent requests may build the same index twice
+        index = StackedIndex(map_names, map_datas)
+        with self.lock:
+            self.indexes[key] = index
+            self.indexes.move_to_end(key)
+            while len(self.indexes) > self.max_size:
+                self.indexes.popitem(last=False)
+        return index
+
+    def invalidate(self, map_name):
+        """
+        Drop the indexes that stack the descriptors of a map, e.g. after the map cache
+        evicted or reloaded it, so that they do not hold its data outside the cache's budget
+        """
+        with self.lock:
+            for key in [key for key in self.indexes if map_name in key]:
+                del self.indexes[key]
+
+    def clear(self):
+        with self.lock:
+            self.indexes.clear()
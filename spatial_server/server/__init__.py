@@ -1,23 +1,72 @@
-from concurrent.futures import ProcessPoolExecutor
-import multiprocessing
 import os
 
 from flask import Flask
 from flask_cors import CORS
 
 from .config import Config
-from spatial_server.hloc_localization import load_cache
+from spatial_server.hloc_localization import load_cache, map_watcher
+from spatial_server.hloc_localization.inference_scheduler import InferenceScheduler
+from spatial_server.hloc_localization.result_cache import ResultCache
+from spatial_server.utils.admission_control import AdmissionController
+from spatial_server.utils.job_queue import JobQueue
+from spatial_server.utils.query_store import QueryImageStore
 from third_party.hloc.hloc import logger
 
-# Create an executor to run map building in the background
-executor = ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn"))
+# Functions run by the background jobs, by job kind
+JOB_TASKS = {
+    "video": "spatial_server.hloc_localization.map_creation.map_creator:create_map_from_video",
+    "images": "spatial_server.hloc_localization.map_creation.map_creator:create_map_from_images",
+    "polycam": "spatial_server.hloc_localization.map_creation.map_creator:create_map_from_polycam_output",
+    "scale_map": "spatial_server.server.routes.scale_map:scale_map_task",
+    "rotate_map": "spatial_server.server.routes.rotate_map:rotate_map_task",
+}
 
 # Shared data - data that is shared between requests.
 # TODO: This is a hack. Find a better way to do this.
 shared_data = {}
 
 
-def create_app(test_config=None):
+def start_background_services(app):
+    """
+    Start the background threads: map watcher, inference scheduler, query image writer and
+    job runner, and warm up the models and the preloaded maps. Threads do not survive a fork,
+    and torch's thread pools must not be used before one, so the gunicorn workers run this
+    after forking.
+    """
+    load_cache.warm_up_models(shared_data)
+    load_cache.warm_up_maps(shared_data)
+    if app.config["MAP_WATCH_INTERVAL"] > 0:
+        map_watcher.start_map_watcher(shared_data, app.config["MAP_WATCH_INTERVAL"])
+    if app.config["LOCALIZATION_BATCH_WINDOW_MS"] > 0:
+        shared_data["inference_scheduler"] = InferenceScheduler(
+            shared_data,
+            max_batch_size=app.config["LOCALIZATION_MAX_BATCH_SIZE"],
+            max_wait_ms=app.config["LOCALIZATION_BATCH_WINDOW_MS"],
+        )
+    if app.config["SAVE_QUERY_IMAGES"]:
+        shared_data["query_image_store"] = QueryImageStore(
+            os.path.join("data", "query_data"),
+            sample_rate=app.config["QUERY_IMAGE_SAMPLE_RATE"],
+            max_bytes=app.config["QUERY_IMAGE_MAX_BYTES_PER_MAP"],
+            max_age=app.config["QUERY_IMAGE_MAX_AGE_DAYS"] * 24 * 3600,
+        )
+    # Only one process runs the jobs, the others stand by
+    shared_data["job_queue"].start()
+
+
+def _reload_map_of_job(job):
+    # Reload the data of the rebuilt, scaled or rotated map. Runs in the process that runs
+    # the jobs; the marker makes the other processes reload it on its next use.
+    if job["map_name"] is not None:
+        load_cache.mark_map_changed(job["map_name"])
+        load_cache.reload_map_data(shared_data, job["map_name"])
+
+
+def create_app(test_config=None, start_services=True):
+    """
+    start_services=False leaves the background threads to start_background_services,
+    for servers that fork workers after creating the app
+    """
     # create and configure the app
     app = Flask(__name__, instance_relative_config=True)
     app.config.from_mapping(SECRET_KEY="dev", **Config)
@@ -31,6 +80,30 @@ def create_app(test_config=None):
 
     load_cache.load_ml_models(shared_data)
     load_cache.load_db_data(shared_data)
+    if app.config["PRELOAD_MAPS"]:
+        load_cache.preload_maps(shared_data, app.config["PRELOAD_MAPS"])
+    if app.config["RESULT_CACHE_TTL"] > 0:
+        shared_data["result_cache"] = ResultCache(
+            ttl=app.config["RESULT_CACHE_TTL"],
+            max_entries=app.config["RESULT_CACHE_MAX_ENTRIES"],
+            max_distance=app.config["RESULT_CACHE_MAX_DISTANCE"],
+        )
+    if app.config["LOCALIZATION_MAX_CONCURRENCY"] > 0:
+        shared_data["admission_controller"] = AdmissionController(
+            max_concurrency=app.config["LOCALIZATION_MAX_CONCURRENCY"],
+            max_queue=app.config["LOCALIZATION_MAX_QUEUE"],
+            max_wait=app.config["LOCALIZATION_MAX_QUEUE_WAIT"],
+            fair_queuing=app.config["LOCALIZATION_FAIR_QUEUING"],
+        )
+    shared_data["job_queue"] = JobQueue(
+        app.config["JOB_QUEUE_PATH"],
+        JOB_TASKS,
+        max_concurrency=app.config["JOB_QUEUE_MAX_CONCURRENCY"],
+        max_attempts=app.config["JOB_QUEUE_MAX_ATTEMPTS"],
+        on_success=_reload_map_of_job,
+    )
+    if start_services:
+        start_background_services(app)
 
     from .routes import index
 
@@ -39,6 +112,12 @@ def create_app(test_config=None):
     from .routes import localize
 
     app.register_blueprint(localize.bp)
+    app.register_blueprint(localize.cross_map_bp)
+
+    from .routes import localize_stream
+
+    localize_stream.sock.init_app(app)
+    app.register_blueprint(localize_stream.bp)
 
     from .routes import create_map
 
@@ -92,6 +171,26 @@ def create_app(test_config=None):
 
     app.register_blueprint(static_files.bp)
 
+    from .routes import map_cache
+
+    app.register_blueprint(map_cache.bp)
+
+    from .routes import inference_scheduler
+
+    app.register_blueprint(inference_scheduler.bp)
+
+    from .routes import metrics
+
+    app.register_blueprint(metrics.bp)
+
+    from .routes import admission_control
+
+    app.register_blueprint(admission_control.bp)
+
+    from .routes import jobs
+
+    app.register_blueprint(jobs.bp)
+
     # Read the BEHIND_PROXY environment variable
     behind_proxy = os.getenv("BEHIND_PROXY", "false").lower() == "true"
     print("BEHIND_PROXY:", behind_proxy)
@@ -1,3 +1,46 @@
+import os
+
 Config = {
     "SERVER_DISCOVERY_URL": "https://172.26.61.146:5000",
+    # Save the uploaded query images to data/query_data in the background
+    "SAVE_QUERY_IMAGES": True,
+    # Fraction of the query images that are saved
+    "QUERY_IMAGE_SAMPLE_RATE": 1.0,
+    # Per map caps on the saved query images. The oldest images are deleted first.
+    "QUERY_IMAGE_MAX_BYTES_PER_MAP": 1024**3,
+    "QUERY_IMAGE_MAX_AGE_DAYS": 30,
+    # Comma separated names of the maps loaded at startup, or "*" for all maps. With the
+    # gunicorn server they are loaded once before the workers are forked and shared by them.
+    "PRELOAD_MAPS": os.getenv("PRELOAD_MAPS", ""),
+    # Interval in seconds at which the map directories are polled for changed maps. 0 disables it.
+    "MAP_WATCH_INTERVAL": 10,
+    # Concurrent localization requests are run in micro-batches of up to LOCALIZATION_MAX_BATCH_SIZE
+    # images, collected for at most LOCALIZATION_BATCH_WINDOW_MS. 0 disables the micro-batching. Every
+    # request waits up to the window, so it only pays off when requests often arrive together.
+    "LOCALIZATION_BATCH_WINDOW_MS": 0,
+    "LOCALIZATION_MAX_BATCH_SIZE": 8,
+    # Successful results of effectively unchanged frames are reused for RESULT_CACHE_TTL seconds.
+    # Frames whose perceptual hashes differ by at most RESULT_CACHE_MAX_DISTANCE bits (of 64) are
+    # considered unchanged; the coarse hash of different views of a map can be a few bits apart, so
+    # only raise it for static cameras. A reused result is the pose of an earlier frame: a device that
+    # moved without changing its view (e.g. facing a plain wall) gets a stale pose for up to the TTL.
+    # 0 disables the result cache.
+    "RESULT_CACHE_TTL": 0,
+    "RESULT_CACHE_MAX_ENTRIES": 1024,
+    "RESULT_CACHE_MAX_DISTANCE": 0,
+    # Admission control: at most LOCALIZATION_MAX_CONCURRENCY localization requests run at the same
+    # time and at most LOCALIZATION_MAX_QUEUE wait, for up to LOCALIZATION_MAX_QUEUE_WAIT seconds.
+    # Other requests get a 503 with Retry-After. 0 disables the admission control. The right
+    # concurrency depends on the hardware and the maps, so set it from a load test of the deployment.
+    "LOCALIZATION_MAX_CONCURRENCY": 0,
+    "LOCALIZATION_MAX_QUEUE": 16,
+    "LOCALIZATION_MAX_QUEUE_WAIT": 2.0,
+    # Admit the waiting requests round-robin across clients (X-Client-Id header or client address)
+    "LOCALIZATION_FAIR_QUEUING": True,
+    # Map building, scaling and rotation jobs are queued in JOB_QUEUE_PATH and run at most
+    # JOB_QUEUE_MAX_CONCURRENCY at a time. Jobs interrupted by a restart are run again, up to
+    # JOB_QUEUE_MAX_ATTEMPTS times in total.
+    "JOB_QUEUE_PATH": os.path.join("data", "jobs.sqlite"),
+    "JOB_QUEUE_MAX_CONCURRENCY": 1,
+    "JOB_QUEUE_MAX_ATTEMPTS": 3,
 }
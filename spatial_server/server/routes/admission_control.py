@@ -0,0 +1,16 @@
+from flask import Blueprint, jsonify
+
+from .. import shared_data
+
+bp = Blueprint("admission_control", __name__, url_prefix="/admission_control")
+
+
+@bp.route("/", methods=["GET"])
+def get_admission_control_info():
+    """
+    Localization requests in flight and waiting, and the admitted and refused counts
+    """
+    admission_controller = shared_data.get("admission_controller")
+    if admission_controller is None:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, **admission_controller.info()})
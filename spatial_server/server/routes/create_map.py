@@ -4,9 +4,7 @@ import re
 
 from flask import Blueprint, request, render_template, url_for
 
-from spatial_server.hloc_localization.map_creation import map_creator
-from spatial_server.hloc_localization import load_cache
-from spatial_server.server import executor, shared_data
+from spatial_server.server import shared_data
 from spatial_server.utils.run_command import run_command
 
 bp = Blueprint("create_map", __name__, url_prefix="/create_map")
@@ -106,6 +104,11 @@ def _save_and_extract_zip(request, extract_folder_name):
     return extract_folder_path, log_file_path
 
 
+def _job_started(message, job_id):
+    # The job's progress is at the Location URL
+    return message, 200, {"Location": url_for("jobs.get_job", job_id=job_id)}
+
+
 @bp.route("/", methods=["GET"])
 def show_map_upload_form():
     return render_template("map_upload.html")
@@ -123,15 +126,16 @@ def upload_video():
         log_filepath = os.path.join(folder_path, "log.txt")
         _create_localization_url_file(name)
 
-        # Call the map builder function
-        future = executor.submit(
-            map_creator.create_map_from_video, video_path, num_frames_perc, log_filepath
+        # Queue the map building. The map is reloaded when the job succeeds.
+        job_id = shared_data["job_queue"].submit(
+            "video",
+            map_name=name,
+            video_path=video_path,
+            num_frames_perc=num_frames_perc,
+            log_filepath=log_filepath,
         )
 
-        # Load the map data into the shared_data dictionary
-        future.add_done_callback(lambda f: load_cache.load_db_data(shared_data))
-
-        return "Video uploaded and map building started", 200
+        return _job_started("Video uploaded and map building started", job_id)
 
     except Exception as e:
         return f"Error uploading Polycam. See server logs for details.", 500
@@ -139,18 +143,23 @@ def upload_video():
 
 @bp.route("/images", methods=["POST"])
 def upload_images():
-    images_folder_path = _save_and_extract_zip(
+    images_folder_path, _ = _save_and_extract_zip(
         request, extract_folder_name="images_org"
     )
-    # Call the map builder function
-    executor.submit(map_creator.create_map_from_images, images_folder_path)
+    # Queue the map building
+    job_id = shared_data["job_queue"].submit(
+        "images",
+        map_name=request.form.get("name", default="default_map"),
+        image_dir=images_folder_path,
+    )
 
-    return "Images uploaded and map building started"
+    return _job_started("Images uploaded and map building started", job_id)
 
 
 @bp.route("/polycam", methods=["POST"])
 def upload_polycam():
     try:
+        name = request.form.get("name", default="default_map")
         polycam_directory, log_file_path = _save_and_extract_zip(
             request, extract_folder_name="polycam_data"
         )
@@ -160,13 +169,15 @@ def upload_polycam():
         else:
             negate_y_mesh_align = False
 
-        # Call the map builder function
-        future = executor.submit(
-            map_creator.create_map_from_polycam_output, polycam_directory, log_file_path, negate_y_mesh_align
+        # Queue the map building. The map is reloaded when the job succeeds.
+        job_id = shared_data["job_queue"].submit(
+            "polycam",
+            map_name=name,
+            data_dir=polycam_directory,
+            log_filepath=log_file_path,
+            negate_y_mesh_align=negate_y_mesh_align,
         )
-        # Load the map data into the shared_data dictionary
-        future.add_done_callback(lambda f: load_cache.load_db_data(shared_data))
-        return "Polycam output uploaded and map building started", 200
+        return _job_started("Polycam output uploaded and map building started", job_id)
 
     except Exception as e:
         return f"Error uploading Polycam. See server logs for details.", 500
@@ -174,12 +185,17 @@ def upload_polycam():
 
 @bp.route("/kiriengine", methods=["POST"])
 def upload_kiri_engine():
-    kiri_directory = _save_and_extract_zip(
+    kiri_directory, log_file_path = _save_and_extract_zip(
         request, extract_folder_name="kiriengine_data"
     )
-    # Call the map builder function
-    executor.submit(map_creator.create_map_from_polycam_output, kiri_directory)
-    return "Polycam output uploaded and map building started"
+    # Queue the map building
+    job_id = shared_data["job_queue"].submit(
+        "polycam",
+        map_name=request.form.get("name", default="default_map"),
+        data_dir=kiri_directory,
+        log_filepath=log_file_path,
+    )
+    return _job_started("Polycam output uploaded and map building started", job_id)
 
 @bp.route("/tileset", methods=["POST"])
 def upload_tileset():
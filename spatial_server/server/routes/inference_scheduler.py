@@ -0,0 +1,16 @@
+from flask import Blueprint, jsonify
+
+from .. import shared_data
+
+bp = Blueprint("inference_scheduler", __name__, url_prefix="/inference_scheduler")
+
+
+@bp.route("/", methods=["GET"])
+def get_inference_scheduler_info():
+    """
+    Queue depth, batch size distribution and wait times of the micro-batching scheduler
+    """
+    scheduler = shared_data.get("inference_scheduler")
+    if scheduler is None:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, **scheduler.info()})
@@ -0,0 +1,33 @@
+from flask import Blueprint, jsonify, request
+
+from .. import shared_data
+from spatial_server.utils.job_queue import JOB_STATES
+
+bp = Blueprint("jobs", __name__, url_prefix="/jobs")
+
+
+@bp.route("/", methods=["GET"])
+def list_jobs():
+    """
+    Job counts per state and the most recent jobs, optionally filtered by the state
+    and map query parameters
+    """
+    state = request.args.get("state")
+    if state is not None and state not in JOB_STATES:
+        return f"Unknown job state: {state}", 400
+    job_queue = shared_data["job_queue"]
+    jobs = job_queue.list(
+        state=state,
+        map_name=request.args.get("map"),
+        limit=request.args.get("limit", default=100, type=int),
+    )
+    return jsonify({**job_queue.info(), "jobs": jobs})
+
+
+@bp.route("/<int:job_id>", methods=["GET"])
+def get_job(job_id):
+    """State, current stage and stage start times of a job"""
+    job = shared_data["job_queue"].get(job_id)
+    if job is None:
+        return f"Job {job_id} not found", 404
+    return jsonify(job)
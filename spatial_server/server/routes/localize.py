@@ -1,30 +1,178 @@
+import functools
+import mimetypes
 import os
-import pickle
-import uuid
+import time
 
 from flask import Blueprint, request, jsonify
+import numpy as np
 
-from spatial_server.hloc_localization import localizer
+from spatial_server.hloc_localization import load_cache, localizer, pipeline
+from spatial_server.utils.admission_control import Overloaded
+from .. import shared_data
 
 bp = Blueprint("localize", __name__, url_prefix="/<name>/localize")
+# Localization when the map is not known in advance
+cross_map_bp = Blueprint("cross_map_localize", __name__, url_prefix="/localize")
 
 
-@bp.route("/image", methods=["POST"])
-def image_localize(name):
-    # Download an image, save it and localize it against the map
-    image = request.files["image"]
+def get_client_id():
+    return (
+        request.headers.get("X-Client-Id")
+        or request.args.get("client_id")
+        or request.remote_addr
+    )
+
+
+def admission_controlled(route):
+    """
+    Run the route only when the admission controller gives it a localization slot.
+    Refused requests get a 503 with Retry-After before their body is parsed.
+    """
+
+    @functools.wraps(route)
+    def wrapper(*args, **kwargs):
+        admission_controller = shared_data.get("admission_controller")
+        if admission_controller is None:
+            return route(*args, **kwargs)
+        try:
+            acquired_at = admission_controller.acquire(get_client_id())
+        except Overloaded as e:
+            return str(e), 503, {"Retry-After": str(e.retry_after)}
+        try:
+            return route(*args, **kwargs)
+        finally:
+            admission_controller.release(acquired_at)
+
+    return wrapper
+
+
+def _get_image_extension(image):
+    extension = mimetypes.guess_extension(image.mimetype or "")
+    if extension is None:
+        extension = os.path.splitext(image.filename or "")[1] or ".png"
+    return extension
+
+
+def _queue_query_image(name, image, image_buffer):
+    # Saved in the background by the query image store, without re-encoding
+    query_image_store = shared_data.get("query_image_store")
+    if query_image_store is not None:
+        query_image_store.submit(name, image_buffer, _get_image_extension(image))
+
+
+def _decode_query_image(image_buffer):
+    """
+    Decode the image and time it. Returns the image and its stage timings.
+    """
+    start = time.perf_counter()
+    image = pipeline.decode_image(image_buffer)
+    return image, {"decode": time.perf_counter() - start}
+
+
+def _read_query_image(name, image):
+    """
+    Read the uploaded image into memory, optionally queue it to be saved and decode it
+    """
+    image_buffer = image.read()
+    _queue_query_image(name, image, image_buffer)
+    return _decode_query_image(image_buffer)
+
 
-    # Create the folder if it doesn't exist
-    random_id = str(uuid.uuid4())
-    folder_path = os.path.join("data", "query_data", name, str(random_id))
-    if not os.path.exists(folder_path):
-        os.makedirs(folder_path)
+def _format_pose(pose):
+    # The per-stage timings are only returned if the request asks for them
+    if request.values.get("timings", "false").lower() not in ("1", "true"):
+        pose.pop("timings", None)
+    return pose
 
-    # Save the uploaded image
-    image_path = os.path.join(folder_path, "query_image.png")
-    image.save(image_path)
+
+def _read_pose_prior():
+    """
+    Optional pose prior from the form: "prior_pose" is the A-Frame camera matrix world as
+    16 comma separated values (column-major, as sent by three.js) and "prior_radius" the
+    search radius around its position.
+    Raises ValueError if they are malformed.
+    """
+    prior_pose = request.form.get("prior_pose")
+    if prior_pose is None:
+        return None, None
+    try:
+        prior_pose = np.array([float(value) for value in prior_pose.split(",")])
+    except ValueError:
+        raise ValueError("prior_pose must be 16 comma separated numbers")
+    if prior_pose.shape != (16,) or not np.all(np.isfinite(prior_pose)):
+        raise ValueError("prior_pose must be 16 comma separated numbers")
+    prior_pose = prior_pose.reshape((4, 4)).T
+
+    prior_radius = request.form.get("prior_radius")
+    if prior_radius is not None:
+        try:
+            prior_radius = float(prior_radius)
+        except ValueError:
+            raise ValueError("prior_radius must be a number")
+        if not (np.isfinite(prior_radius) and prior_radius > 0):
+            raise ValueError("prior_radius must be a finite positive number")
+    return prior_pose, prior_radius
+
+
+@bp.route("/image", methods=["POST"])
+@admission_controlled
+def image_localize(name):
+    # Decode the uploaded image in memory and localize it against the map
+    try:
+        prior_pose, prior_radius = _read_pose_prior()
+    except ValueError as e:
+        return str(e), 400
+    image, timings = _read_query_image(name, request.files["image"])
 
     # Call the localization function
-    pose = localizer.localize(image_path, name)
+    pose = localizer.localize_image(image, name, prior_pose, prior_radius, timings)
     # print("Localizer Result: ", pose)
-    return jsonify(pose)
+    return jsonify(_format_pose(pose))
+
+
+@bp.route("/batch", methods=["POST"])
+@admission_controlled
+def batch_localize(name):
+    # Decode a burst of uploaded images and localize them together against the map
+    uploaded_images = request.files.getlist("images")
+    if len(uploaded_images) == 0:
+        return "No images uploaded", 400
+    try:
+        prior_pose, prior_radius = _read_pose_prior()
+    except ValueError as e:
+        return str(e), 400
+
+    images, timings_list = zip(
+        *[_read_query_image(name, image) for image in uploaded_images]
+    )
+
+    # Call the batched localization function. Poses are in the order of the uploaded images.
+    poses = localizer.localize_batch(
+        list(images), name, prior_pose, prior_radius, list(timings_list)
+    )
+    return jsonify([_format_pose(pose) for pose in poses])
+
+
+@cross_map_bp.route("", methods=["POST"])
+@admission_controlled
+def cross_map_localize():
+    # Localize against the maps listed in the comma separated "maps" form field,
+    # or against all maps. The response has the name of the matched map.
+    map_names = request.form.get("maps")
+    map_names = [name for name in (map_names or "").split(",") if name]
+    unknown_map_names = set(map_names) - set(load_cache.list_map_names())
+    if unknown_map_names:
+        return f"Unknown maps: {', '.join(sorted(unknown_map_names))}", 404
+
+    uploaded_image = request.files["image"]
+    image_buffer = uploaded_image.read()
+    image, timings = _decode_query_image(image_buffer)
+    try:
+        pose = localizer.localize_image_across_maps(image, map_names, timings)
+    except load_cache.NoMapsError as e:
+        return str(e), 404
+
+    # The query image is saved with the map it was localized in
+    if pose["map_name"] is not None:
+        _queue_query_image(pose["map_name"], uploaded_image, image_buffer)
+    return jsonify(_format_pose(pose))
@@ -0,0 +1,191 @@
+"""
+WebSocket localization sessions for continuous AR clients.
+
+A client opens /<name>/localize/stream and sends one binary message per frame:
+    uint32 sequence id, uint8 flags,
+    if flags & FLAG_PRIOR: 16 float32 A-Frame prior pose (column-major, as three.js
+        matrix elements) and a float32 prior radius (0 for the default radius),
+    then the encoded (JPEG/PNG/WebP) image.
+The server answers each frame with:
+    uint32 sequence id, uint8 status, uint32 number of inliers,
+    if status == STATUS_SUCCESS: 16 float32 A-Frame pose (column-major).
+Frames refused by the admission control are answered with STATUS_OVERLOADED, and
+frames with a non-finite prior or a negative prior radius with STATUS_ERROR.
+
+Only the newest frame is localized: a frame that is still waiting when a newer one
+arrives is answered with STATUS_DROPPED, so a client never queues behind its own backlog.
+All integers and floats are little-endian.
+"""
+
+import struct
+import threading
+import time
+
+from flask import Blueprint
+from flask_sock import Sock
+import numpy as np
+from simple_websocket import ConnectionClosed
+
+from spatial_server.hloc_localization import localizer, pipeline
+from spatial_server.utils.admission_control import Overloaded
+from .. import shared_data
+from .localize import get_client_id
+
+bp = Blueprint("localize_stream", __name__, url_prefix="/<name>/localize")
+sock = Sock()
+
+FRAME_HEADER = struct.Struct("<IB")
+PRIOR = struct.Struct("<16ff")
+RESULT_HEADER = struct.Struct("<IBI")
+POSE = struct.Struct("<16f")
+
+FLAG_PRIOR = 1
+
+STATUS_FAILURE = 0
+STATUS_SUCCESS = 1
+STATUS_DROPPED = 2
+STATUS_ERROR = 3
+STATUS_OVERLOADED = 4
+
+
+def _parse_frame(message):
+    """
+    Returns the sequence id, the (4,4) prior pose or None, the prior radius or None
+    and the encoded image. Raises ValueError if the prior is not finite or its radius is
+    negative.
+    """
+    seq, flags = FRAME_HEADER.unpack_from(message)
+    offset = FRAME_HEADER.size
+    prior_pose, prior_radius = None, None
+    if flags & FLAG_PRIOR:
+        *prior_pose, prior_radius = PRIOR.unpack_from(message, offset)
+        offset += PRIOR.size
+        prior_pose = np.array(prior_pose, dtype=np.float64)
+        if not np.all(np.isfinite(prior_pose)):
+            raise ValueError("Prior pose is not finite")
+        if not (np.isfinite(prior_radius) and prior_radius >= 0):
+            raise ValueError("Prior radius must be a finite number, 0 or positive")
+        prior_pose = prior_pose.reshape((4, 4)).T
+        prior_radius = prior_radius or None
+    return seq, prior_pose, prior_radius, message[offset:]
+
+
+def _get_image_extension(image_buffer):
+    if image_buffer[:3] == b"\xff\xd8\xff":
+        return ".jpg"
+    if image_buffer[:4] == b"RIFF" and image_buffer[8:12] == b"WEBP":
+        return ".webp"
+    return ".png"
+
+
+def _format_result(seq, pose):
+    if not pose["success"]:
+        return RESULT_HEADER.pack(seq, STATUS_FAILURE, 0)
+    pose_elements = np.array(pose["pose"], dtype=np.float32).T.flatten()
+    return RESULT_HEADER.pack(
+        seq, STATUS_SUCCESS, pose["num_inliers"]
+    ) + POSE.pack(*pose_elements)
+
+
+class _Session:
+    """
+    Receives the frames of one client in a background thread and keeps only the newest
+    """
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.send_lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.frame = None
+        self.closed = False
+        self.receiver = threading.Thread(target=self._receive, daemon=True)
+        self.receiver.start()
+
+    def send(self, message):
+        with self.send_lock:
+            self.ws.send(message)
+
+    def _receive(self):
+        try:
+            while True:
+                message = self.ws.receive()
+                if not isinstance(message, (bytes, bytearray)):
+                    continue
+                try:
+                    frame = _parse_frame(message)
+                except struct.error:
+                    print("Ignoring malformed stream frame")
+                    continue
+                except ValueError as e:
+                    seq = FRAME_HEADER.unpack_from(message)[0]
+                    print(f"Invalid stream frame {seq}: {e}")
+                    self.send(RESULT_HEADER.pack(seq, STATUS_ERROR, 0))
+                    continue
+                with self.condition:
+                    stale_frame, self.frame = self.frame, frame
+                    self.condition.notify()
+                if stale_frame is not None:
+                    self.send(RESULT_HEADER.pack(stale_frame[0], STATUS_DROPPED, 0))
+        except ConnectionClosed:
+            pass
+        finally:
+            with self.condition:
+                self.closed = True
+                self.condition.notify()
+
+    def next_frame(self):
+        """
+        Wait for the newest frame. Returns None when the connection is closed.
+        """
+        with self.condition:
+            while self.frame is None and not self.closed:
+                self.condition.wait()
+            frame, self.frame = self.frame, None
+            return frame
+
+
+def _localize_frame(name, seq, prior_pose, prior_radius, image_buffer):
+    try:
+        start = time.perf_counter()
+        image = pipeline.decode_image(image_buffer)
+        timings = {"decode": time.perf_counter() - start}
+        query_image_store = shared_data.get("query_image_store")
+        if query_image_store is not None:
+            query_image_store.submit(
+                name, image_buffer, _get_image_extension(image_buffer)
+            )
+        pose = localizer.localize_image(image, name, prior_pose, prior_radius, timings)
+        return _format_result(seq, pose)
+    except Exception as e:
+        print(f"Error localizing stream frame {seq} for {name}: {e}")
+        return RESULT_HEADER.pack(seq, STATUS_ERROR, 0)
+
+
+@sock.route("/stream", bp=bp)
+def localize_stream(ws, name):
+    client_id = get_client_id()
+    admission_controller = shared_data.get("admission_controller")
+    session = _Session(ws)
+    while True:
+        frame = session.next_frame()
+        if frame is None:
+            break
+        seq = frame[0]
+
+        if admission_controller is None:
+            result = _localize_frame(name, *frame)
+        else:
+            try:
+                acquired_at = admission_controller.acquire(client_id)
+            except Overloaded:
+                result = RESULT_HEADER.pack(seq, STATUS_OVERLOADED, 0)
+            else:
+                try:
+                    result = _localize_frame(name, *frame)
+                finally:
+                    admission_controller.release(acquired_at)
+
+        try:
+            session.send(result)
+        except ConnectionClosed:
+            break
@@ -0,0 +1,14 @@
+from flask import Blueprint, jsonify
+
+from .. import shared_data
+
+bp = Blueprint("map_cache", __name__, url_prefix="/map_cache")
+
+
+@bp.route("/", methods=["GET"])
+def get_map_cache_info():
+    """
+    Maps currently loaded for localization with their size in bytes,
+    and the cache hit, load and eviction counts.
+    """
+    return jsonify(shared_data["map_cache"].info())
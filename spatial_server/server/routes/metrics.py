@@ -0,0 +1,19 @@
+from flask import Blueprint, Response
+
+from spatial_server.hloc_localization import metrics
+from .. import shared_data
+
+bp = Blueprint("metrics", __name__, url_prefix="/metrics")
+
+
+@bp.route("", methods=["GET"])
+def get_metrics():
+    """
+    Localization stage timings per map and the state of the map cache, inference
+    scheduler and query image store, in the Prometheus text format.
+    The counters are those of the worker process that serves the request.
+    """
+    return Response(
+        metrics.render_metrics(shared_data),
+        mimetype="text/plain; version=0.0.4; charset=utf-8",
+    )
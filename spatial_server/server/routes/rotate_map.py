@@ -1,11 +1,11 @@
 import contextlib
 import os
 from pathlib import Path
-from threading import Thread
 
-from flask import Blueprint, render_template
+from flask import Blueprint, render_template, url_for
 
 from .. import shared_data
+from spatial_server.utils.job_queue import set_stage
 from spatial_server.hloc_localization.map_creation.map_transforms import (
     rotate_and_elevate,
 )
@@ -25,18 +25,24 @@ def rotate_map(mapname):
     """
     Rotate map by 180 degrees along the x axis and elevate it.
     """
-    Thread(target=rotate_map_task, args=(mapname,)).start()
-    return "Rotate map started in the background..See logs for result", 200
+    job_id = shared_data["job_queue"].submit(
+        "rotate_map", map_name=mapname, mapname=mapname
+    )
+    return "Rotate map started in the background..See logs for result", 200, {
+        "Location": url_for("jobs.get_job", job_id=job_id)
+    }
 
 
 def rotate_map_task(mapname):
+    """
+    Run by the job queue in a separate process, which reloads the map when it succeeds
+    """
     map_directory = Path(os.path.join("data", "map_data", mapname))
     log_filepath = map_directory / "log.txt"
-    output_file_obj = open(log_filepath, "a")
 
-    with contextlib.redirect_stdout(output_file_obj), contextlib.redirect_stderr(
+    with open(log_filepath, "a") as output_file_obj, contextlib.redirect_stdout(
         output_file_obj
-    ):
+    ), contextlib.redirect_stderr(output_file_obj):
         try:
             # If the scaled reconstruction already exists, the scale obtained is for that model, so scale that instead
             hloc_directory = map_directory / "hloc_data"
@@ -44,6 +50,7 @@ def rotate_map_task(mapname):
             if not model_path.exists():
                 model_path = hloc_directory / "sfm_reconstruction"
 
+            set_stage("rotate_and_elevate")
             print(
                 f"Rotating and elevating the existing model path at {model_path} map.."
             )
@@ -52,9 +59,8 @@ def rotate_map_task(mapname):
             )
             print("Map rotated successfully..")
 
-            return "Map scaled successfully", 200
-
         except Exception as e:
             print("Error when scaling the map..Error trace:")
             print(e)
-            return "Error occured when scaling. See logs for details", 500
+            # Fail the job
+            raise
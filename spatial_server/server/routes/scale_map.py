@@ -1,11 +1,11 @@
 import contextlib
 import os
 from pathlib import Path
-from threading import Thread
 
-from flask import Blueprint, jsonify, request, render_template
+from flask import Blueprint, render_template, url_for
 
 from .. import shared_data
+from spatial_server.utils.job_queue import set_stage
 from spatial_server.hloc_localization.scale_adjustment.get_scale import (
     get_scale_from_image_pose_data,
 )
@@ -28,22 +28,29 @@ def render_scale_map_select():
 
 @bp.route("/<mapname>", methods=["GET"])
 def scale_map(mapname):
-    Thread(target=scale_map_task, args=(mapname,)).start()
-    return "Scale map started in the background..See logs for result", 200
+    job_id = shared_data["job_queue"].submit(
+        "scale_map", map_name=mapname, mapname=mapname
+    )
+    return "Scale map started in the background..See logs for result", 200, {
+        "Location": url_for("jobs.get_job", job_id=job_id)
+    }
 
 
 def scale_map_task(mapname):
+    """
+    Run by the job queue in a separate process, which reloads the map when it succeeds
+    """
     map_directory = Path(os.path.join("data", "map_data", mapname))
     log_filepath = map_directory / "log.txt"
-    output_file_obj = open(log_filepath, "a")
 
-    with contextlib.redirect_stdout(output_file_obj), contextlib.redirect_stderr(
+    with open(log_filepath, "a") as output_file_obj, contextlib.redirect_stdout(
         output_file_obj
-    ):
+    ), contextlib.redirect_stderr(output_file_obj):
         try:
             # Get the scale factor
             print("Getting scale factor..")
-            get_scale_from_image_pose_data(mapname, shared_data)
+            set_stage("get_scale")
+            get_scale_from_image_pose_data(mapname)
 
             # If the scaled reconstruction already exists, the scale obtained is for that model, so scale that instead
             hloc_directory = map_directory / "hloc_data"
@@ -52,19 +59,20 @@ def scale_map_task(mapname):
                 model_path = hloc_directory / "sfm_reconstruction"
 
             # Scale the model with the scale factor
+            set_stage("scale_model")
             print(f"Scaling the existing model path at {model_path} map..")
             scale_existing_model(model_path)
 
             # Save the model as pcd file
+            set_stage("create_pcd")
             print("Saving PCD of the scaled map..")
             rotate_and_elevate(
                 model_path, rotation=None, elevate=False, create_pcd=True
             )
             print("Map scaled successfully..")
 
-            return "Map scaled successfully", 200
-
         except Exception as e:
             print("Error when scaling the map..Error trace:")
             print(e)
-            return "Error occured when scaling. See logs for details", 500
+            # Fail the job
+            raise
@@ -0,0 +1,113 @@
+"""
+Admission control for the localization requests.
+
+At most max_concurrency requests are localized at the same time and at most
+max_queue requests wait for a slot. Requests beyond that, or that wait longer than
+max_wait seconds, are refused right away with an estimate of when to retry, so that
+interactive clients get a fast refusal instead of a late pose.
+
+With fair queuing, the waiting requests are admitted round-robin across clients,
+so that one client sending a burst of frames does not delay the others.
+"""
+
+from collections import OrderedDict, deque
+import math
+import threading
+import time
+
+
+class Overloaded(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Server overloaded, retry after {retry_after} s")
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    def __init__(self):
+        self.event = threading.Event()
+        self.admitted = False
+
+
+class AdmissionController:
+    def __init__(self, max_concurrency, max_queue, max_wait, fair_queuing=True):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.fair_queuing = fair_queuing
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        # Waiting requests per client, in the order in which the clients are served
+        self.waiters = OrderedDict()
+        self.num_waiting = 0
+        # Moving average of the time a request holds its slot, for Retry-After
+        self.mean_service_time = 0.5
+        self.counts = {"admitted": 0, "rejected": 0, "timed_out": 0}
+
+    def _retry_after(self):
+        wait = (self.num_waiting + 1) * self.mean_service_time / self.max_concurrency
+        return max(1, math.ceil(wait))
+
+    def acquire(self, client_id):
+        """
+        Wait for a localization slot. Raises Overloaded if the request is refused.
+        Returns the time at which the slot was acquired, to be passed to release.
+        """
+        with self.lock:
+            if self.in_flight < self.max_concurrency and self.num_waiting == 0:
+                self.in_flight += 1
+                self.counts["admitted"] += 1
+                return time.monotonic()
+            if self.num_waiting >= self.max_queue:
+                self.counts["rejected"] += 1
+                raise Overloaded(self._retry_after())
+
+            waiter = _Waiter()
+            # Without fair queuing all requests share one FIFO queue
+            key = client_id if self.fair_queuing else None
+            self.waiters.setdefault(key, deque()).append(waiter)
+            self.num_waiting += 1
+
+        waiter.event.wait(self.max_wait)
+        with self.lock:
+            if waiter.admitted:
+                return time.monotonic()
+            # Timed out: leave the queue
+            self.waiters[key].remove(waiter)
+            if len(self.waiters[key]) == 0:
+                del self.waiters[key]
+            self.num_waiting -= 1
+            self.counts["timed_out"] += 1
+            raise Overloaded(self._retry_after())
+
+    def release(self, acquired_at):
+        with self.lock:
+            service_time = time.monotonic() - acquired_at
+            self.mean_service_time = 0.9 * self.mean_service_time + 0.1 * service_time
+            if self.num_waiting == 0:
+                self.in_flight -= 1
+                return
+
+            # Hand the slot to the first waiter of the next client and move that
+            # client to the back of the round-robin order
+            key, waiters = next(iter(self.waiters.items()))
+            waiter = waiters.popleft()
+            if len(waiters) == 0:
+                del self.waiters[key]
+            else:
+                self.waiters.move_to_end(key)
+            self.num_waiting -= 1
+            self.counts["admitted"] += 1
+            waiter.admitted = True
+            waiter.event.set()
+
+    def info(self):
+        with self.lock:
+            return {
+                "in_flight": self.in_flight,
+                "queued": self.num_waiting,
+                "queued_clients": len(self.waiters),
+                "max_concurrency": self.max_concurrency,
+                "max_queue": self.max_queue,
+                "mean_service_time": self.mean_service_time,
+                **self.counts,
+            }
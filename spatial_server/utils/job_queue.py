@@ -0,0 +1,346 @@
+"""
+Durable queue of the background jobs: map building, scaling and rotation.
+
+Jobs are rows of a SQLite database, so they survive restarts and can be listed from
+any server process. One process at a time, the one holding the lock file next to the
+database, runs the jobs: at most max_concurrency at once, each in a process of its
+own executor. Jobs that were running when that process died are queued again when
+the next one takes the lock, up to max_attempts times. Each job runs in a new process
+that leads a process group of its own. Its pid is recorded with the job, together with
+the boot id and the start time of the process, and the group is terminated before the
+job is queued again so that the same build never runs twice. A recorded pid whose boot
+id or start time does not match belongs to another process and is left alone.
+
+A job reports its progress with set_stage, which records the stage it is in and when
+each stage started.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
+import fcntl
+import functools
+import importlib
+import json
+import multiprocessing
+import os
+import signal
+import sqlite3
+import threading
+import time
+
+JOB_STATES = ("queued", "running", "succeeded", "failed")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    map_name TEXT,
+    args TEXT NOT NULL,
+    state TEXT NOT NULL,
+    stage TEXT,
+    stages TEXT NOT NULL DEFAULT '[]',
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    pid INTEGER,
+    process_token TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+)
+"""
+
+# (database path, job id) of the job run by this process, for set_stage
+_current_job = None
+
+# Time to wait for the processes of an interrupted job to exit after SIGTERM
+TERMINATE_TIMEOUT = 30
+
+
+def _migrate(connection):
+    # Databases created before the processes of the jobs were recorded
+    columns = [row["name"] for row in connection.execute("PRAGMA table_info(jobs)")]
+    if "pid" not in columns:
+        connection.execute("ALTER TABLE jobs ADD COLUMN pid INTEGER")
+    if "process_token" not in columns:
+        connection.execute("ALTER TABLE jobs ADD COLUMN process_token TEXT")
+
+
+def _get_process_token(pid):
+    """
+    Boot id and start time of a process, which identify it even after its pid is reused.
+    None if the process does not exist or /proc is not available.
+    """
+    try:
+        with open("/proc/sys/kernel/random/boot_id") as f:
+            boot_id = f.read().strip()
+        with open(f"/proc/{pid}/stat") as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # The command name in parentheses may contain spaces; the start time is the
+    # 22nd field, the 20th after the command name
+    start_time = stat[stat.rindex(")") + 2 :].split()[19]
+    return f"{boot_id}:{start_time}"
+
+
+def _connect(db_path):
+    connection = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute(_SCHEMA)
+    return connection
+
+
+def _to_dict(row):
+    job = dict(row)
+    job["args"] = json.loads(job["args"])
+    job["stages"] = json.loads(job["stages"])
+    return job
+
+
+def _run_job(db_path, job_id, task, args):
+    """Run a job in a process of the executor. task is "module:function"."""
+    global _current_job
+    # Lead a process group, so that the job and the processes it starts can be
+    # terminated together if the process running the jobs dies. Every job gets a new
+    # process (see JobQueue._start_job), so the group only has this job's processes.
+    os.setsid()
+    with closing(_connect(db_path)) as connection:
+        connection.execute(
+            "UPDATE jobs SET pid = ?, process_token = ? WHERE id = ?",
+            (os.getpid(), _get_process_token(os.getpid()), job_id),
+        )
+    module_name, function_name = task.split(":")
+    function = getattr(importlib.import_module(module_name), function_name)
+    _current_job = (db_path, job_id)
+    try:
+        function(**args)
+    finally:
+        _current_job = None
+
+
+def set_stage(stage):
+    """Record the stage of the running job. Does nothing outside of a job."""
+    if _current_job is None:
+        return
+    db_path, job_id = _current_job
+    with closing(_connect(db_path)) as connection:
+        row = connection.execute(
+            "SELECT stages FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        stages = json.loads(row["stages"])
+        stages.append({"name": stage, "started_at": time.time()})
+        connection.execute(
+            "UPDATE jobs SET stage = ?, stages = ? WHERE id = ?",
+            (stage, json.dumps(stages), job_id),
+        )
+
+
+class JobQueue:
+    def __init__(
+        self, db_path, tasks, max_concurrency=1, max_attempts=3, on_success=None,
+        poll_interval=1.0,
+    ):
+        """
+        tasks maps the job kinds to the "module:function" run for them, with the job's
+        arguments as keyword arguments. on_success is called with the finished job in
+        the process running the jobs.
+        """
+        self.db_path = str(db_path)
+        self.tasks = tasks
+        self.max_concurrency = max_concurrency
+        self.max_attempts = max_attempts
+        self.on_success = on_success
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        # Job id to future of the jobs run by this process
+        self.running = {}
+        self.is_runner = False
+
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        with closing(_connect(self.db_path)) as connection:
+            _migrate(connection)
+
+    def submit(self, kind, map_name=None, **args):
+        """Queue a job and return its id"""
+        if kind not in self.tasks:
+            raise ValueError(f"Unknown job kind: {kind}")
+        with closing(_connect(self.db_path)) as connection:
+            cursor = connection.execute(
+                "INSERT INTO jobs (kind, map_name, args, state, created_at)"
+                " VALUES (?, ?, ?, 'queued', ?)",
+                (kind, map_name, json.dumps(args), time.time()),
+            )
+        self.wakeup.set()
+        return cursor.lastrowid
+
+    def get(self, job_id):
+        with closing(_connect(self.db_path)) as connection:
+            row = connection.execute(
+                "SELECT * FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return None if row is None else _to_dict(row)
+
+    def list(self, state=None, map_name=None, limit=100):
+        """Most recent jobs first"""
+        query = "SELECT * FROM jobs WHERE 1 = 1"
+        params = []
+        if state is not None:
+            query += " AND state = ?"
+            params.append(state)
+        if map_name is not None:
+            query += " AND map_name = ?"
+            params.append(map_name)
+        query += " ORDER BY id DESC LIMIT ?"
+        params.append(limit)
+        with closing(_connect(self.db_path)) as connection:
+            return [_to_dict(row) for row in connection.execute(query, params)]
+
+    def info(self):
+        with closing(_connect(self.db_path)) as connection:
+            rows = connection.execute(
+                "SELECT state, COUNT(*) AS count FROM jobs GROUP BY state"
+            ).fetchall()
+        counts = {state: 0 for state in JOB_STATES}
+        counts.update({row["state"]: row["count"] for row in rows})
+        return {
+            "max_concurrency": self.max_concurrency,
+            "runs_jobs": self.is_runner,
+            **counts,
+        }
+
+    def start(self):
+        """
+        Start the thread that runs the jobs once this process holds the lock file.
+        Every server process can call it: the others stand by, and one of them takes
+        over if the process running the jobs dies.
+        """
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        lock_file = open(self.db_path + ".lock", "w")
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        self.is_runner = True
+        self._requeue_interrupted()
+
+        while True:
+            self.wakeup.wait(self.poll_interval)
+            self.wakeup.clear()
+            with self.lock:
+                num_free = self.max_concurrency - len(self.running)
+            for job in self._claim(num_free):
+                self._start_job(job)
+
+    def _create_executor(self):
+        # One process per job: pool processes are not reused, so the process group of
+        # a job never outlives it
+        return ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    def _terminate_job_processes(self, pid, process_token):
+        """
+        Terminate the process group of a job whose runner died, and wait for it to exit.
+        The job process may outlive the runner and would keep writing the map. Nothing is
+        signalled unless the pid is still the job's process, e.g. after a reboot.
+        """
+        if process_token is None or _get_process_token(pid) != process_token:
+            return
+        try:
+            os.killpg(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            return
+        print(f"Terminating the processes of interrupted job (process group {pid})")
+        deadline = time.monotonic() + TERMINATE_TIMEOUT
+        while time.monotonic() < deadline:
+            try:
+                os.killpg(pid, 0)
+            except ProcessLookupError:
+                return
+            time.sleep(0.5)
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            return
+        # SIGKILL cannot be caught; the group is gone once its processes are reaped
+        deadline = time.monotonic() + TERMINATE_TIMEOUT
+        while time.monotonic() < deadline:
+            try:
+                os.killpg(pid, 0)
+            except ProcessLookupError:
+                return
+            time.sleep(0.1)
+        print(f"Process group {pid} of interrupted job did not exit")
+
+    def _requeue_interrupted(self):
+        with closing(_connect(self.db_path)) as connection:
+            rows = connection.execute(
+                "SELECT pid, process_token FROM jobs"
+                " WHERE state = 'running' AND pid IS NOT NULL"
+            ).fetchall()
+        for row in rows:
+            self._terminate_job_processes(row["pid"], row["process_token"])
+
+        with closing(_connect(self.db_path)) as connection:
+            connection.execute(
+                "UPDATE jobs SET state = 'failed', error = 'Interrupted too many times',"
+                " finished_at = ? WHERE state = 'running' AND attempts >= ?",
+                (time.time(), self.max_attempts),
+            )
+            connection.execute(
+                "UPDATE jobs SET state = 'queued', stage = NULL, pid = NULL,"
+                " process_token = NULL WHERE state = 'running'"
+            )
+
+    def _claim(self, num_jobs):
+        if num_jobs <= 0:
+            return []
+        with closing(_connect(self.db_path)) as connection:
+            rows = connection.execute(
+                "SELECT * FROM jobs WHERE state = 'queued' ORDER BY id LIMIT ?",
+                (num_jobs,),
+            ).fetchall()
+            for row in rows:
+                connection.execute(
+                    "UPDATE jobs SET state = 'running', attempts = attempts + 1,"
+                    " started_at = ?, error = NULL, pid = NULL, process_token = NULL"
+                    " WHERE id = ?",
+                    (time.time(), row["id"]),
+                )
+        return [_to_dict(row) for row in rows]
+
+    def _start_job(self, job):
+        if job["kind"] not in self.tasks:
+            self._finish(job, ValueError(f"Unknown job kind: {job['kind']}"))
+            return
+        executor = self._create_executor()
+        with self.lock:
+            future = executor.submit(
+                _run_job, self.db_path, job["id"], self.tasks[job["kind"]], job["args"]
+            )
+            self.running[job["id"]] = future
+        future.add_done_callback(functools.partial(self._on_done, job, executor))
+
+    def _on_done(self, job, executor, future):
+        error = future.exception()
+        executor.shutdown(wait=False)
+        with self.lock:
+            del self.running[job["id"]]
+        try:
+            self._finish(job, error)
+        finally:
+            self.wakeup.set()
+
+    def _finish(self, job, error):
+        state = "succeeded" if error is None else "failed"
+        with closing(_connect(self.db_path)) as connection:
+            connection.execute(
+                "UPDATE jobs SET state = ?, error = ?, finished_at = ? WHERE id = ?",
+                (state, None if error is None else repr(error), time.time(), job["id"]),
+            )
+        if error is None and self.on_success is not None:
+            try:
+                self.on_success(job)
+            except Exception as e:
+                print(f"Error after job {job['id']} succeeded: {e!r}")
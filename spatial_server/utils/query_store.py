@@ -0,0 +1,297 @@
+"""
+Bounded store for the query images sent for localization.
+
+Images are appended by a background thread to segment files under
+data/query_data/<name>/, one record per image, instead of one directory per query.
+A new segment is started when the current one reaches segment_bytes. Each map keeps
+at most max_bytes of segments and no segments older than max_age seconds: the oldest
+segments are deleted first, like a ring buffer.
+
+Several processes (the gunicorn workers) can write to the same map directory. Each
+process appends to its own segments, named after their start time and the pid, and
+holds a shared lock on the segment it writes. The caps are enforced on all the
+segments of the map, under an exclusive lock of the map directory, and segments that
+another process is writing are never deleted.
+
+Record layout: a header with the timestamp (float64), the length of the file
+extension (uint16) and the length of the image (uint32), then the extension and the
+encoded image bytes as they were uploaded.
+"""
+
+import fcntl
+import os
+import queue
+import random
+import struct
+import threading
+import time
+
+RECORD_HEADER = struct.Struct("<dHI")
+SEGMENT_PREFIX = "segment_"
+SEGMENT_SUFFIX = ".bin"
+LOCK_FILENAME = ".lock"
+# Minimum time in seconds between two scans of a map's segments for eviction
+EVICTION_INTERVAL = 1.0
+
+
+def _get_segment_paths(map_dir):
+    """
+    Segment files of a map, from the oldest to the newest
+    """
+    if not os.path.isdir(map_dir):
+        return []
+    return [
+        os.path.join(map_dir, filename)
+        for filename in sorted(os.listdir(map_dir))
+        if filename.startswith(SEGMENT_PREFIX) and filename.endswith(SEGMENT_SUFFIX)
+    ]
+
+
+def read_query_images(map_dir):
+    """
+    Iterate over the (timestamp, extension, image_buffer) records of a map's query
+    images, from the oldest to the newest. A record truncated by a crash ends its segment.
+    """
+    for segment_path in _get_segment_paths(map_dir):
+        with open(segment_path, "rb") as f:
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                timestamp, extension_length, image_length = RECORD_HEADER.unpack(header)
+                extension = f.read(extension_length)
+                image_buffer = f.read(image_length)
+                if len(image_buffer) < image_length:
+                    break
+                yield timestamp, extension.decode(), image_buffer
+
+
+def _is_segment_in_use(path):
+    """
+    True if a process holds the lock of the segment, i.e. it is still appending to it
+    """
+    try:
+        with open(path, "rb") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            fcntl.flock(f, fcntl.LOCK_UN)
+    except FileNotFoundError:
+        pass
+    return False
+
+
+class _MapSegments:
+    """
+    The segment this process appends the new records of one map to
+    """
+
+    def __init__(self, map_dir):
+        self.map_dir = map_dir
+        os.makedirs(map_dir, exist_ok=True)
+        self.file = None
+        self.size = 0
+        self.last_eviction = 0.0
+        # Size and number of the segments of all processes at the last eviction scan
+        self.nbytes = 0
+        self.num_segments = 0
+
+    def open_segment(self):
+        # Always start a new segment so that records are never appended
+        # after a record truncated by a crash
+        path = os.path.join(
+            self.map_dir,
+            f"{SEGMENT_PREFIX}{time.time_ns():020d}_{os.getpid()}{SEGMENT_SUFFIX}",
+        )
+        self.file = open(path, "ab")
+        # Held until the segment is closed, so other processes do not evict it
+        fcntl.flock(self.file, fcntl.LOCK_SH)
+        self.size = 0
+
+    def close_segment(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def append(self, record):
+        if self.file is None:
+            self.open_segment()
+        self.file.write(record)
+        self.size += len(record)
+
+
+class QueryImageStore:
+    def __init__(
+        self,
+        root,
+        sample_rate=1.0,
+        max_bytes=1024**3,
+        max_age=None,
+        segment_bytes=64 * 1024**2,
+        queue_size=256,
+    ):
+        """
+        root: directory with one subdirectory of segments per map.
+        sample_rate: fraction of the submitted images that are kept.
+        max_bytes: maximum size of the segments of each map.
+        max_age: maximum age in seconds of the segments of each map. None keeps them
+            until max_bytes is reached.
+        segment_bytes: size at which a new segment is started.
+        queue_size: number of images waiting to be written. Images submitted while
+            the queue is full are dropped so that requests never wait for the disk.
+        """
+        self.root = root
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.segment_bytes = segment_bytes
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.maps = {}
+        self.stats_lock = threading.Lock()
+        self.counts = {
+            "submitted": 0,
+            "sampled_out": 0,
+            "dropped": 0,
+            "written": 0,
+            "write_errors": 0,
+            "evicted_segments": 0,
+        }
+
+        self.writer = threading.Thread(target=self._run, daemon=True)
+        self.writer.start()
+
+    def _count(self, name):
+        with self.stats_lock:
+            self.counts[name] += 1
+
+    def submit(self, name, image_buffer, extension):
+        """
+        Queue an encoded image sent for localization against the map to be saved.
+        Returns immediately; the image is written by the background thread.
+        """
+        self._count("submitted")
+        if random.random() >= self.sample_rate:
+            self._count("sampled_out")
+            return False
+        try:
+            self.queue.put_nowait((name, time.time(), image_buffer, extension))
+        except queue.Full:
+            self._count("dropped")
+            return False
+        return True
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                self._write(*item)
+                self._count("written")
+            except Exception as e:
+                print(f"Error saving query image for {item[0]}: {e}")
+                self._count("write_errors")
+
+            # Flush once the burst of queued images is written
+            if self.queue.empty():
+                for map_segments in self.maps.values():
+                    if map_segments.file is not None:
+                        map_segments.file.flush()
+
+    def _write(self, name, timestamp, image_buffer, extension):
+        map_segments = self.maps.get(name)
+        if map_segments is None:
+            map_segments = _MapSegments(os.path.join(self.root, name))
+            self.maps[name] = map_segments
+
+        extension = extension.encode()
+        record = (
+            RECORD_HEADER.pack(timestamp, len(extension), len(image_buffer))
+            + extension
+            + image_buffer
+        )
+        new_segment = map_segments.file is None
+        if map_segments.file is not None and (
+            map_segments.size + len(record) > self.segment_bytes
+        ):
+            map_segments.close_segment()
+            new_segment = True
+        map_segments.append(record)
+        if new_segment or timestamp - map_segments.last_eviction >= EVICTION_INTERVAL:
+            map_segments.file.flush()
+            self._evict(map_segments, timestamp)
+
+    def _evict(self, map_segments, now):
+        """
+        Delete the oldest segments of the map, written by any process, while the map is
+        over its size or age cap. Segments that a process is still writing are kept.
+        """
+        map_segments.last_eviction = now
+        with open(os.path.join(map_segments.map_dir, LOCK_FILENAME), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            segments = []
+            for path in _get_segment_paths(map_segments.map_dir):
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                segments.append([path, stat.st_size, stat.st_mtime])
+            nbytes = sum(size for _, size, _ in segments)
+
+            kept = []
+            for path, size, mtime in segments:
+                over_cap = nbytes > self.max_bytes or (
+                    self.max_age is not None and now - mtime > self.max_age
+                )
+                if not over_cap or _is_segment_in_use(path):
+                    kept.append(path)
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                nbytes -= size
+                self._count("evicted_segments")
+
+        map_segments.nbytes = nbytes
+        map_segments.num_segments = len(kept)
+
+    def info(self):
+        with self.stats_lock:
+            counts = dict(self.counts)
+        return {
+            "queue_depth": self.queue.qsize(),
+            "maps": {
+                name: {
+                    "nbytes": map_segments.nbytes,
+                    "segments": map_segments.num_segments,
+                }
+                for name, map_segments in list(self.maps.items())
+            },
+            **counts,
+        }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Export the saved query images of a map as image files"
+    )
+    parser.add_argument("--map_name", type=str, required=True, help="Name of the map")
+    parser.add_argument(
+        "--output_dir", type=str, required=True, help="Directory to write the images to"
+    )
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    num_images = 0
+    for timestamp, extension, image_buffer in read_query_images(
+        os.path.join("data", "query_data", args.map_name)
+    ):
+        image_path = os.path.join(
+            args.output_dir, f"query_image_{num_images:06d}_{int(timestamp)}{extension}"
+        )
+        with open(image_path, "wb") as f:
+            f.write(image_buffer)
+        num_images += 1
+    print(f"Exported {num_images} query images to {args.output_dir}")
@@ -1,5 +1,11 @@
 #!/bin/sh
 
+# Production mode: gunicorn with several worker processes (see gunicorn.conf.py)
+if [ "$SERVER_MODE" = "production" ]; then
+    echo "Starting gunicorn server..."
+    exec gunicorn -c gunicorn.conf.py
+fi
+
 # Check if the HTTPS environment variable is set to true
 if [ "$HTTPS" = "true" ]; then
     echo "Starting Flask server in HTTPS mode..."
@@ -7,4 +13,4 @@ if [ "$HTTPS" = "true" ]; then
 else
     echo "Starting Flask server in HTTP mode..."
     flask --app spatial_server/server run --host 0.0.0.0 --port 8001
-fi
\ No newline at end of file
+fi
@@ -0,0 +1,101 @@
+"""
+The admission controller hands freed slots to the waiting requests round-robin across
+clients, and refuses the requests that cannot get a slot in time
+"""
+
+import threading
+import time
+
+import pytest
+
+from spatial_server.utils.admission_control import AdmissionController, Overloaded
+
+
+def _wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "Timed out"
+        time.sleep(0.005)
+
+
+def _queue_request(controller, client_id, admitted):
+    """Start a request that waits for a slot, and wait until it is queued"""
+    num_waiting = controller.info()["queued"]
+
+    def request():
+        admitted.append((client_id, controller.acquire(client_id)))
+
+    threading.Thread(target=request, daemon=True).start()
+    _wait_until(lambda: controller.info()["queued"] == num_waiting + 1)
+
+
+def _release_and_wait(controller, acquired_at, admitted):
+    """Release a slot and return the request it was handed to"""
+    num_admitted = len(admitted)
+    controller.release(acquired_at)
+    _wait_until(lambda: len(admitted) == num_admitted + 1)
+    return admitted[-1]
+
+
+@pytest.mark.parametrize(
+    "fair_queuing, expected_order",
+    [(True, ["a", "b", "a", "a"]), (False, ["a", "a", "a", "b"])],
+)
+def test_freed_slots_are_handed_to_waiting_requests(fair_queuing, expected_order):
+    controller = AdmissionController(
+        max_concurrency=1, max_queue=10, max_wait=5, fair_queuing=fair_queuing
+    )
+    acquired_at = controller.acquire("holder")
+
+    admitted = []
+    # A burst from client a, then one request from client b
+    for client_id in ["a", "a", "a", "b"]:
+        _queue_request(controller, client_id, admitted)
+
+    order = []
+    for _ in expected_order:
+        client_id, acquired_at = _release_and_wait(controller, acquired_at, admitted)
+        order.append(client_id)
+        # The slot was handed over, not freed
+        assert controller.info()["in_flight"] == 1
+    assert order == expected_order
+
+    controller.release(acquired_at)
+    info = controller.info()
+    assert info["in_flight"] == 0
+    assert info["queued"] == 0
+    assert info["queued_clients"] == 0
+    assert info["admitted"] == 5
+
+
+def test_waiting_request_times_out():
+    controller = AdmissionController(max_concurrency=1, max_queue=10, max_wait=0.05)
+    acquired_at = controller.acquire("a")
+
+    with pytest.raises(Overloaded) as e:
+        controller.acquire("b")
+    assert e.value.retry_after >= 1
+    info = controller.info()
+    assert info["timed_out"] == 1
+    assert info["queued"] == 0
+    assert info["queued_clients"] == 0
+
+    # The timed out request did not take the freed slot
+    controller.release(acquired_at)
+    assert controller.info()["in_flight"] == 0
+    controller.release(controller.acquire("b"))
+
+
+def test_request_is_refused_when_the_queue_is_full():
+    controller = AdmissionController(max_concurrency=1, max_queue=1, max_wait=5)
+    acquired_at = controller.acquire("a")
+    admitted = []
+    _queue_request(controller, "b", admitted)
+
+    with pytest.raises(Overloaded):
+        controller.acquire("c")
+    assert controller.info()["rejected"] == 1
+
+    _, acquired_at = _release_and_wait(controller, acquired_at, admitted)
+    controller.release(acquired_at)
+    assert controller.info()["in_flight"] == 0
@@ -0,0 +1,84 @@
+"""
+The batched matching of a map build writes the same matches as hloc's match_features
+"""
+
+import pytest
+
+h5py = pytest.importorskip("h5py")
+np = pytest.importorskip("numpy")
+pytest.importorskip("torch")
+pytest.importorskip("third_party.hloc.hloc")
+
+from third_party.hloc.hloc import match_features
+from third_party.hloc.hloc.utils.io import get_matches
+
+from spatial_server.hloc_localization.map_creation.batched_matching import (
+    _order_pairs,
+    match_pairs_batched,
+)
+
+
+def _write_features(features_path, rng, keypoint_counts):
+    with h5py.File(str(features_path), "w") as fd:
+        for i, num_keypoints in enumerate(keypoint_counts):
+            descriptors = rng.standard_normal((256, num_keypoints)).astype(np.float32)
+            group = fd.create_group(f"db/{i}.jpg")
+            group.create_dataset(
+                "keypoints",
+                data=rng.uniform(0, 480, (num_keypoints, 2)).astype(np.float32),
+            )
+            group.create_dataset(
+                "scores", data=rng.uniform(0, 1, num_keypoints).astype(np.float32)
+            )
+            group.create_dataset(
+                "descriptors",
+                data=(descriptors / np.linalg.norm(descriptors, axis=0)).astype(
+                    np.float16
+                ),
+            )
+            group.create_dataset("image_size", data=np.array([640, 480]))
+
+
+def test_batched_matches_equal_hloc_matches(tmp_path):
+    rng = np.random.default_rng(0)
+    keypoint_counts = [300, 300, 300, 250, 300, 120]
+    features_path = tmp_path / "features.h5"
+    _write_features(features_path, rng, keypoint_counts)
+
+    names = [f"db/{i}.jpg" for i in range(len(keypoint_counts))]
+    pairs_path = tmp_path / "pairs.txt"
+    pairs_path.write_text(
+        "\n".join(
+            f"{name0} {name1}" for name0 in names for name1 in names if name0 < name1
+        )
+    )
+
+    conf = match_features.confs["superglue"]
+    hloc_path = tmp_path / "hloc_matches.h5"
+    batched_path = tmp_path / "batched_matches.h5"
+    match_features.main(conf, pairs_path, features_path, matches=hloc_path)
+    match_pairs_batched(conf, pairs_path, features_path, batched_path, batch_size=4)
+
+    for name0 in names:
+        for name1 in names:
+            if name0 >= name1:
+                continue
+            hloc_matches, _ = get_matches(hloc_path, name0, name1)
+            batched_matches, _ = get_matches(batched_path, name0, name1)
+            np.testing.assert_array_equal(batched_matches, hloc_matches)
+
+
+def test_pairs_are_grouped_by_image():
+    # A chain of images, each paired with its next three, with the pairs shuffled
+    names = [f"db/{i:02d}.jpg" for i in range(30)]
+    pairs = [
+        (names[i], names[j]) for i in range(30) for j in range(i + 1, min(30, i + 4))
+    ]
+    shuffled = list(pairs)
+    np.random.default_rng(0).shuffle(shuffled)
+
+    ordered = _order_pairs(shuffled)
+    assert sorted(ordered) == sorted(pairs)
+    # The pairs of an image are consecutive and come after the pairs of the previous one
+    first_images = [min(pair) for pair in ordered]
+    assert first_images == sorted(first_images)
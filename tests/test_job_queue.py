@@ -0,0 +1,115 @@
+"""
+Jobs move through the queue's states: claimed jobs run, jobs interrupted by a restart
+are queued again up to max_attempts times, and finished jobs record their result
+"""
+
+from contextlib import closing
+import os
+import sqlite3
+import time
+
+import pytest
+
+from spatial_server.utils.job_queue import JobQueue
+
+# Tasks run in a spawned process, so they must be importable functions
+TASKS = {"dump": "json:dumps", "load": "json:loads"}
+
+
+def _wait_for_state(queue, job_id, states, timeout=60):
+    deadline = time.monotonic() + timeout
+    while queue.get(job_id)["state"] not in states:
+        assert time.monotonic() < deadline, "Timed out"
+        time.sleep(0.1)
+    return queue.get(job_id)
+
+
+def test_jobs_are_claimed_in_order(tmp_path):
+    queue = JobQueue(tmp_path / "jobs.sqlite", TASKS, max_concurrency=2)
+    first = queue.submit("dump", map_name="a", obj=1)
+    second = queue.submit("dump", map_name="b", obj=2)
+
+    claimed = queue._claim(1)
+    assert [job["id"] for job in claimed] == [first]
+    assert claimed[0]["args"] == {"obj": 1}
+    job = queue.get(first)
+    assert job["state"] == "running"
+    assert job["attempts"] == 1
+    assert queue.get(second)["state"] == "queued"
+    assert queue._claim(0) == []
+
+    info = queue.info()
+    assert info["running"] == 1
+    assert info["queued"] == 1
+
+
+def test_unknown_kind_is_refused(tmp_path):
+    queue = JobQueue(tmp_path / "jobs.sqlite", TASKS)
+    with pytest.raises(ValueError):
+        queue.submit("build")
+
+
+def test_interrupted_job_fails_after_max_attempts(tmp_path):
+    queue = JobQueue(tmp_path / "jobs.sqlite", TASKS, max_attempts=2)
+    job_id = queue.submit("dump", obj=1)
+
+    queue._claim(1)
+    queue._requeue_interrupted()
+    job = queue.get(job_id)
+    assert job["state"] == "queued"
+    assert job["attempts"] == 1
+
+    queue._claim(1)
+    queue._requeue_interrupted()
+    job = queue.get(job_id)
+    assert job["state"] == "failed"
+    assert job["error"] == "Interrupted too many times"
+    assert queue._claim(1) == []
+
+
+def test_pid_of_another_process_is_not_signalled(tmp_path):
+    queue = JobQueue(tmp_path / "jobs.sqlite", TASKS)
+    job_id = queue.submit("dump", obj=1)
+    queue._claim(1)
+
+    # The recorded pid now belongs to this test process, which has another start time
+    with closing(sqlite3.connect(queue.db_path, isolation_level=None)) as connection:
+        connection.execute(
+            "UPDATE jobs SET pid = ?, process_token = ? WHERE id = ?",
+            (os.getpid(), "other-boot:0", job_id),
+        )
+    queue._requeue_interrupted()
+    assert queue.get(job_id)["state"] == "queued"
+
+
+def test_jobs_run_to_completion(tmp_path):
+    finished = []
+    queue = JobQueue(
+        tmp_path / "jobs.sqlite",
+        TASKS,
+        on_success=finished.append,
+        poll_interval=0.1,
+    )
+    succeeding = queue.submit("dump", obj=1)
+    failing = queue.submit("load", s="not json")
+    queue.start()
+
+    job = _wait_for_state(queue, succeeding, ("succeeded", "failed"))
+    assert job["state"] == "succeeded"
+    assert job["pid"] is not None
+    job = _wait_for_state(queue, failing, ("succeeded", "failed"))
+    assert job["state"] == "failed"
+    assert "JSONDecodeError" in job["error"]
+    assert [job["id"] for job in finished] == [succeeding]
+
+
+def test_error_after_success_does_not_stop_the_queue(tmp_path):
+    def on_success(job):
+        raise RuntimeError("Cannot reload the map")
+
+    queue = JobQueue(tmp_path / "jobs.sqlite", TASKS, on_success=on_success)
+    job_id = queue.submit("dump", obj=1)
+    job = queue._claim(1)[0]
+
+    queue._finish(job, None)
+    assert queue.get(job_id)["state"] == "succeeded"
@@ -0,0 +1,118 @@
+"""
+The map cache keeps the loaded maps within its byte budget and swaps in reloaded data
+"""
+
+import pytest
+
+from spatial_server.hloc_localization.map_cache import MapCache
+
+
+class _Loader:
+    """Loads maps of the given sizes, counting the loads of each map"""
+
+    def __init__(self, sizes):
+        self.sizes = sizes
+        self.loads = {}
+        self.fail = set()
+
+    def __call__(self, dataset_name):
+        if dataset_name in self.fail:
+            raise OSError(f"Cannot read {dataset_name}")
+        self.loads[dataset_name] = self.loads.get(dataset_name, 0) + 1
+        return {
+            "nbytes": self.sizes[dataset_name],
+            "version": self.loads[dataset_name],
+        }
+
+
+def test_least_recently_used_maps_are_evicted_over_the_budget():
+    loader = _Loader({"a": 40, "b": 40, "c": 40})
+    dropped = []
+    cache = MapCache(loader, max_bytes=100, on_drop=dropped.append)
+
+    cache.get("a")
+    cache.get("b")
+    # a is now more recently used than b
+    assert cache.get("a")["version"] == 1
+    cache.get("c")
+
+    assert [name for name, _ in cache.items()] == ["a", "c"]
+    assert dropped == ["b"]
+    info = cache.info()
+    assert info["nbytes"] == 80
+    assert info["hits"] == 1
+    assert info["loads"] == 3
+    assert info["evictions"] == 1
+
+
+def test_map_larger_than_the_budget_is_kept_alone():
+    loader = _Loader({"a": 40, "big": 200})
+    cache = MapCache(loader, max_bytes=100)
+
+    cache.get("a")
+    cache.get("big")
+    assert [name for name, _ in cache.items()] == ["big"]
+
+
+def test_reload_swaps_in_new_data():
+    loader = _Loader({"a": 40, "b": 40})
+    dropped = []
+    cache = MapCache(loader, max_bytes=100, on_drop=dropped.append)
+    cache.get("a")
+    cache.get("b")
+
+    assert cache.reload("a")
+    assert cache.get("a")["version"] == 2
+    # Reloading keeps the position of the map in the LRU order
+    assert [name for name, _ in cache.items()] == ["b", "a"]
+    assert dropped == ["a"]
+    assert cache.info()["reloads"] == 1
+
+    # Maps that are not loaded are read on their next use instead
+    assert not cache.reload("c")
+    assert "c" not in loader.loads
+
+
+def test_reload_only_reads_stale_data():
+    loader = _Loader({"a": 40})
+    cache = MapCache(loader, max_bytes=100)
+    cache.get("a")
+
+    def is_stale(map_data):
+        return map_data["version"] < 2
+
+    assert cache.reload("a", is_stale=is_stale)
+    # A second request that saw the stale data finds it already reloaded
+    assert cache.reload("a", is_stale=is_stale)
+    assert loader.loads["a"] == 2
+
+
+@pytest.mark.parametrize("keep_on_error", [True, False])
+def test_failed_reload(keep_on_error):
+    loader = _Loader({"a": 40})
+    dropped = []
+    cache = MapCache(loader, max_bytes=100, on_drop=dropped.append)
+    cache.get("a")
+
+    loader.fail.add("a")
+    assert not cache.reload("a", keep_on_error=keep_on_error)
+    assert cache.info()["load_errors"] == 1
+    if keep_on_error:
+        assert [name for name, _ in cache.items()] == ["a"]
+        assert dropped == []
+    else:
+        assert cache.items() == []
+        assert dropped == ["a"]
+
+
+def test_failed_load_is_not_cached():
+    loader = _Loader({"a": 40})
+    cache = MapCache(loader, max_bytes=100)
+
+    loader.fail.add("a")
+    with pytest.raises(OSError):
+        cache.get("a")
+    assert cache.loading_locks == {}
+
+    loader.fail.clear()
+    assert cache.get("a")["version"] == 1
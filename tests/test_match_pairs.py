@@ -0,0 +1,62 @@
+"""
+The batched SuperGlue matching gives the same matches as matching each pair on its own
+"""
+
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+pytest.importorskip("third_party.hloc.hloc")
+
+from third_party.hloc.hloc import match_features, matchers
+from third_party.hloc.hloc.utils.base_model import dynamic_load
+
+from spatial_server.hloc_localization import pipeline
+
+
+def _random_features(rng, num_keypoints, image_size=(640, 480)):
+    descriptors = rng.standard_normal((256, num_keypoints)).astype(np.float32)
+    return {
+        "keypoints": rng.uniform(0, min(image_size), (num_keypoints, 2)).astype(
+            np.float32
+        ),
+        "scores": rng.uniform(0, 1, num_keypoints).astype(np.float32),
+        "descriptors": descriptors / np.linalg.norm(descriptors, axis=0),
+        "image_size": np.array(image_size),
+    }
+
+
+@torch.no_grad()
+def _match_single_pair(matcher_model, features0, features1):
+    """
+    Match one pair the way hloc's match_features does, with a batch of one pair
+    """
+    data = {}
+    for side, features in ((0, features0), (1, features1)):
+        for name in ("keypoints", "scores", "descriptors"):
+            data[f"{name}{side}"] = torch.from_numpy(features[name]).float()[None]
+        width, height = (int(x) for x in features["image_size"])
+        data[f"image{side}"] = torch.empty((1, 1, height, width))
+    pred = matcher_model(data)
+    return pred["matches0"][0].numpy(), pred["matching_scores0"][0].numpy()
+
+
+@pytest.fixture(scope="module")
+def matcher_model():
+    conf = match_features.confs["superglue"]["model"]
+    return dynamic_load(matchers, conf["name"])(conf).eval()
+
+
+def test_batched_matches_equal_single_pair_matches(matcher_model):
+    rng = np.random.default_rng(0)
+    # Pairs with equal and different keypoint counts, so some pairs share a batch
+    pairs = [
+        (_random_features(rng, num0), _random_features(rng, num1))
+        for num0, num1 in [(200, 150), (200, 150), (120, 300), (200, 150), (80, 80)]
+    ]
+
+    batched = pipeline.match_pairs(matcher_model, pairs, "cpu", batch_size=4)
+    for pair, (matches, scores) in zip(pairs, batched):
+        single_matches, single_scores = _match_single_pair(matcher_model, *pair)
+        np.testing.assert_array_equal(matches, single_matches)
+        np.testing.assert_allclose(scores, single_scores, rtol=1e-4, atol=1e-5)